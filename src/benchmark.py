@@ -0,0 +1,267 @@
+# coding=UTF-8
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from profiler import Profiler, profiler
+
+PHASES = Profiler.PHASES
+VEHICLE_SIZES = (100, 1000, 10000, 100000)
+LANE_SIZES = (1, 3, 6)
+PRESSURES = ('low', 'high')
+HEADWAY = 30  # Distance between two vehicles in the same lane (m)
+
+
+def case_name(num_vehicles: int, num_lanes: int, pressure: str) -> str:
+	return '{}veh-{}lane-{}'.format(num_vehicles, num_lanes, pressure)
+
+
+def build_benchmark_scenario(num_vehicles: int, num_lanes: int, pressure: str, settings: dict):
+	"""
+	Builds a synthetic scenario with ``utils.generate_scenario``.
+
+	Vehicles are spread evenly over the lanes with a fixed headway. With low lane-change pressure all vehicles have
+	the same desired speed and drive at it; with high pressure slow and fast vehicles alternate, so the fast
+	vehicles keep looking for gaps in the neighboring lanes.
+
+	:param num_vehicles: total number of vehicles
+	:param num_lanes: number of lanes
+	:param pressure: 'low' or 'high' lane-change pressure
+	:param settings: the settings loaded from 'settings.json'
+	:return: list of lanes
+	"""
+	import utils
+	from vehicle import HV
+
+	num_per_lane = int(np.ceil(num_vehicles / num_lanes))
+	length = num_per_lane * HEADWAY + 1000
+	lane_list = utils.generate_scenario(num_lanes, length=length, start=0, end=length)
+	rng = np.random.default_rng(0)
+	slow = dict(settings['Vehicle']['HV'], desired_speed_main=15)
+	fast = dict(settings['Vehicle']['HV'], desired_speed_main=33)
+
+	count = 0
+	for i in range(num_per_lane):
+		for j, lane_curr in enumerate(lane_list):
+			if count == num_vehicles:
+				break
+			position = length - 500 - i * HEADWAY - j * HEADWAY / num_lanes  # Staggered between the lanes
+			if pressure == 'high':
+				configs = fast if rng.random() < 0.5 else slow
+				speed = configs['desired_speed_main'] * 0.8
+			else:
+				configs = settings['Vehicle']['HV']
+				speed = 15
+			vehicle = HV(speed, None, position, 0, **configs)
+			lane_curr.fleet.add_vehicle(vehicle, lane_curr.fleet.rear_vehicle)
+			count += 1
+	return lane_list
+
+
+def run_case(num_vehicles: int, num_lanes: int, pressure: str, num_epochs: int, num_warmup: int,
+             dt: float) -> dict:
+	"""
+	Runs one benchmark case and times each phase of an epoch.
+
+	:return: the results of the case
+	"""
+	from recorder import TrajectoryRecorder
+	from vehicle import Vehicle
+	import simulation
+
+	with open('settings.json', 'r') as f:
+		settings = json.load(f)
+	Vehicle.record_states = False
+	start_time = time.perf_counter()
+	lane_list = build_benchmark_scenario(num_vehicles, num_lanes, pressure, settings)
+	setup_time = time.perf_counter() - start_time
+	recorder = TrajectoryRecorder(lane_list)
+
+	profiler.enable()
+	for epoch in range(num_warmup + num_epochs):
+		if epoch == num_warmup:
+			profiler.reset()
+		simulation.step(lane_list, dt)
+		start = profiler.tic()
+		recorder.record(epoch)
+		profiler.toc('recording', start)
+	profiler.disable()
+
+	phase_time = dict(profiler.phase_seconds)
+	total_time = sum(phase_time.values())
+	return {
+		'name': case_name(num_vehicles, num_lanes, pressure),
+		'num_vehicles': num_vehicles,
+		'num_lanes': num_lanes,
+		'pressure': pressure,
+		'num_epochs': num_epochs,
+		'setup_seconds': setup_time,
+		'steps_per_second': num_epochs / total_time if total_time > 0 else float('inf'),
+		'vehicle_steps_per_second': num_epochs * num_vehicles / total_time if total_time > 0 else float('inf'),
+		'phase_seconds': phase_time,
+		'counters': dict(profiler.counters),
+		# Peak resident memory of the process running the case (kilobytes on Linux)
+		'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+	}
+
+
+def run_stepping_case(num_vehicles: int, num_lanes: int, pressure: str, duration: float = 60,
+                      dt: float = 0.1) -> dict:
+	"""
+	Compares the steppers of ``stepping`` with fixed steps on one case. Every method starts from the same scenario;
+	the accuracy of a method is the mean absolute deviation of the final vehicle positions from a run with fixed steps
+	of ``dt / 2``. On several lanes the positions also differ by lane changes taken at other times.
+
+	:return: wall time, speedup over fixed steps of ``dt``, number of steps, position error and mean speed per method
+	"""
+	import simulation
+	import stepping
+	from vehicle import Vehicle
+
+	with open('settings.json', 'r') as f:
+		settings = json.load(f)
+	Vehicle.record_states = False
+	num_epochs = int(round(duration / dt))
+	methods = {
+		'reference': lambda lane_list: simulation.run_simulation(lane_list, num_epochs * 2, dt / 2),
+		'fixed': lambda lane_list: simulation.run_simulation(lane_list, num_epochs, dt),
+		'fixed_coarse': lambda lane_list: simulation.run_simulation(lane_list, num_epochs // 5, dt * 5),
+		'multirate': lambda lane_list: stepping.run_stepped(lane_list, stepping.MultiRateStepper(dt, 5), duration),
+		'adaptive': lambda lane_list: stepping.run_stepped(lane_list, stepping.AdaptiveStepper(dt, dt * 10), duration),
+	}
+	num_steps = {'reference': num_epochs * 2, 'fixed': num_epochs, 'fixed_coarse': num_epochs // 5}
+	results = {}
+	positions = {}
+	for name, run in methods.items():
+		first_id = Vehicle.cnt
+		lane_list = build_benchmark_scenario(num_vehicles, num_lanes, pressure, settings)
+		start_time = time.perf_counter()
+		metrics = run(lane_list)
+		seconds = time.perf_counter() - start_time
+		position = np.zeros(num_vehicles)
+		for lane_curr in lane_list:
+			num = lane_curr.fleet.sync_state()
+			state = lane_curr.fleet.state
+			position[state.vehicle_id[:num] - first_id] = state.position[:num]
+		positions[name] = position
+		results[name] = {
+			'seconds': seconds,
+			'num_steps': metrics.get('num_steps', num_steps.get(name)),
+			'mean_speed': metrics['mean_speed'],
+			'position_error': float(np.abs(position - positions['reference']).mean()),
+		}
+	for result in results.values():
+		result['speedup'] = results['fixed']['seconds'] / result['seconds']
+	return {'name': case_name(num_vehicles, num_lanes, pressure), 'duration': duration, 'dt': dt, 'methods': results}
+
+
+def run_benchmark(vehicle_sizes=VEHICLE_SIZES, lane_sizes=LANE_SIZES, pressures=PRESSURES, num_epochs: int = 50,
+                  num_warmup: int = 5, dt: float = 0.1) -> dict:
+	"""
+	Runs every combination of vehicle count, lane count and lane-change pressure. Each case runs in a fresh process,
+	so that the peak memory of a case is not affected by the other cases.
+
+	:return: environment information and the results of the cases
+	"""
+	context = multiprocessing.get_context('spawn')
+	results = []
+	for num_vehicles in vehicle_sizes:
+		for num_lanes in lane_sizes:
+			for pressure in pressures:
+				with context.Pool(1) as pool:
+					result = pool.apply(run_case, (num_vehicles, num_lanes, pressure, num_epochs, num_warmup, dt))
+				results.append(result)
+				print('{:<24} {:>10.1f} steps/s  {}'.format(
+					result['name'], result['steps_per_second'],
+					'  '.join('{} {:.3f}s'.format(phase, result['phase_seconds'][phase]) for phase in PHASES)))
+	return {
+		'environment': {
+			'python': sys.version.split()[0],
+			'numpy': np.__version__,
+			'platform': platform.platform(),
+			'processor': platform.processor(),
+		},
+		'results': results,
+	}
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2) -> List[Dict]:
+	"""
+	Compares the steps per second of each case with the baseline.
+
+	:param results: the current benchmark results
+	:param baseline: the stored benchmark results
+	:param tolerance: relative slowdown which is accepted as noise
+	:return: one entry per case found in both results, with the speed ratio and whether it is a regression
+	"""
+	baseline_results = {result['name']: result for result in baseline['results']}
+	comparison = []
+	for result in results['results']:
+		reference = baseline_results.get(result['name'])
+		if reference is None:
+			continue
+		ratio = result['steps_per_second'] / reference['steps_per_second']
+		comparison.append({
+			'name': result['name'],
+			'ratio': ratio,
+			'regression': ratio < 1 - tolerance,
+		})
+	return comparison
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark steps per second of the simulation.')
+	parser.add_argument('--vehicles', type=int, nargs='+', default=list(VEHICLE_SIZES))
+	parser.add_argument('--lanes', type=int, nargs='+', default=list(LANE_SIZES))
+	parser.add_argument('--pressure', nargs='+', default=list(PRESSURES), choices=PRESSURES)
+	parser.add_argument('--epochs', type=int, default=50)
+	parser.add_argument('--output', default='benchmark_results.json')
+	parser.add_argument('--baseline', default=None, help='results to compare with')
+	parser.add_argument('--save-baseline', default=None, help='also store the results as a baseline')
+	parser.add_argument('--tolerance', type=float, default=0.2)
+	parser.add_argument('--stepping', action='store_true',
+	                    help='compare the multi-rate and adaptive steppers with fixed steps instead')
+	args = parser.parse_args()
+
+	if args.stepping:
+		results = []
+		for num_vehicles in args.vehicles:
+			for num_lanes in args.lanes:
+				for pressure in args.pressure:
+					result = run_stepping_case(num_vehicles, num_lanes, pressure)
+					results.append(result)
+					for name, method in result['methods'].items():
+						print('{:<24} {:<13} {:>7.2f}x {:>6} steps  error {:.3f} m  mean speed {:.3f} m/s'.format(
+							result['name'], name, method['speedup'], method['num_steps'], method['position_error'],
+							method['mean_speed']))
+		with open(args.output, 'w') as f:
+			json.dump({'stepping': results}, f, indent=2)
+		return
+
+	results = run_benchmark(args.vehicles, args.lanes, args.pressure, args.epochs)
+	with open(args.output, 'w') as f:
+		json.dump(results, f, indent=2)
+	if args.save_baseline:
+		with open(args.save_baseline, 'w') as f:
+			json.dump(results, f, indent=2)
+
+	if args.baseline:
+		with open(args.baseline, 'r') as f:
+			baseline = json.load(f)
+		comparison = compare(results, baseline, args.tolerance)
+		for entry in comparison:
+			flag = 'REGRESSION' if entry['regression'] else ''
+			print('{:<24} {:>6.2f}x {}'.format(entry['name'], entry['ratio'], flag))
+		if any(entry['regression'] for entry in comparison):
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
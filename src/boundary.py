@@ -0,0 +1,165 @@
+import random
+import numpy as np
+from vehicle import *
+from lane import Lane
+from state import DETACHED
+from demand import ArrivalStream
+from typing import Dict, List, Optional, Type
+
+
+class VehiclePool(object):
+	"""
+	Pool of retired vehicle objects.
+
+	A retired vehicle gives its slot back to ``DETACHED`` and waits in the pool until a new vehicle of the same type
+	is needed. Reusing the object runs ``__init__`` again, so the vehicle gets a new id, new states and parameters,
+	and takes a free slot of ``DETACHED`` instead of growing it.
+	"""
+
+	def __init__(self):
+		self._free: Dict[type, List[Vehicle]] = {}
+
+	def __len__(self):
+		return sum(len(vehicles) for vehicles in self._free.values())
+
+	def release(self, vehicle: Vehicle):
+		"""
+		Puts a vehicle which is not in any fleet into the pool.
+
+		:param vehicle: the retired vehicle
+		"""
+		if vehicle._state is not DETACHED:
+			raise ValueError('Vehicle {} is still in a fleet'.format(vehicle.id))
+		DETACHED.release(vehicle._slot)
+		vehicle._state = None
+		vehicle._slot = -1
+		vehicle._acc_cache = None
+		vehicle.lane = None
+		vehicle.platoon = None
+		vehicle.position_record = vehicle.speed_record = vehicle.acc_record = None
+		self._free.setdefault(type(vehicle), []).append(vehicle)
+
+	def acquire(self, vehicle_type: Type[Vehicle], init_speed: float, init_lane: Optional[Lane], init_pos: float,
+	            init_acc: float, **settings) -> Vehicle:
+		"""
+		Returns a vehicle of the given type, reusing a pooled object if there is one.
+
+		:param vehicle_type: the class of the vehicle, e.g. ``HV``
+		:return: the initialized vehicle, not added to any fleet yet
+		"""
+		free = self._free.get(vehicle_type)
+		if free:
+			vehicle = free.pop()
+			vehicle.__init__(init_speed, init_lane, init_pos, init_acc, **settings)
+			return vehicle
+		return vehicle_type(init_speed, init_lane, init_pos, init_acc, **settings)
+
+
+class OpenBoundary(object):
+	"""
+	Open boundaries of a road: vehicles which pass ``Lane.end`` leave the simulation and new vehicles enter at
+	``Lane.start``.
+
+	Retired vehicles are reported to the recorder with ``finalize`` and their objects are pooled for new arrivals. Every
+	arrival gets a new id, so ``Vehicle.cnt`` grows with the number of arrivals, but in steady state the following stay
+	bounded by the number of vehicles on the road and in the pool: the vehicle objects, the state slots of the fleets
+	and of ``DETACHED``, the tables by vehicle id of ``simulation.CrossSection``, ``metrics.OnlineMetrics`` and
+	``stepping.MultiRateStepper`` (see ``structure.VehicleTable``), and the width of the chunks of a
+	``TrajectoryRecorder``. The recorder still keeps the id and exit epoch of each recorded vehicle. Arrivals of each
+	lane are drawn by a ``demand.ArrivalStream``. An arrival waits at the entrance until the gap to the rear vehicle of
+	the lane is at least the jam distance of the new vehicle.
+	"""
+
+	def __init__(self, lane_list: List[Lane], configs: dict, inflow: float = 0, permeability: float = 0,
+	             recorder=None, max_queue: int = 100, distribution: str = 'poisson', **kwargs):
+		"""
+		Initializes the boundaries.
+
+		:param lane_list: the lanes, vehicles enter every main lane
+		:param configs: settings of the vehicle types, i.e. ``settings['Vehicle']``
+		:param inflow: arrival rate per lane in vehicles per hour, 0 for no arrivals
+		:param permeability: penetration rate of CAVs among the arrivals
+		:param recorder: ``TrajectoryRecorder`` or ``TrajectoryWriter`` to finalize retired vehicles, or None
+		:param max_queue: maximum number of arrivals waiting at the entrance of a lane, further arrivals are dropped
+		:param distribution: headway distribution of the arrivals, see ``demand.draw_headways``
+		:param kwargs: further arguments of ``demand.ArrivalStream``, e.g. ``min_headway`` or ``samples``
+		"""
+		self.lane_list = lane_list
+		self.configs = configs
+		self.inflow = inflow
+		self.permeability = permeability
+		self.recorder = recorder
+		self.max_queue = max_queue
+		self.pool = VehiclePool()
+		self.queue = [0] * len(lane_list)  # Number of arrivals waiting at the entrance of each lane
+		self.streams = [ArrivalStream(inflow, distribution, **kwargs) for _ in lane_list]
+		self.time = 0.0
+		self.num_retired = 0
+		self.num_inserted = 0
+		self.num_dropped = 0
+
+	def retire(self, epoch: int) -> int:
+		"""
+		Removes the vehicles past the end of their lane, finalizes them in the recorder and pools them.
+
+		:param epoch: the current epoch
+		:return: the number of retired vehicles
+		"""
+		retired = []
+		for lane_curr in self.lane_list:
+			retired.extend(lane_curr.fleet.retire_vehicles(lane_curr.end))
+		if not retired:
+			return 0
+		if self.recorder is not None:
+			self.recorder.finalize(np.array([vehicle.id for vehicle in retired], dtype=np.int64), epoch)
+		for vehicle in retired:
+			self.pool.release(vehicle)
+		self.num_retired += len(retired)
+		return len(retired)
+
+	def insert(self, dt: float) -> int:
+		"""
+		Draws the arrivals of one time step and inserts the waiting vehicles at the start of each lane.
+
+		:param dt: time step
+		:return: the number of inserted vehicles
+		"""
+		num_inserted = 0
+		self.time += dt
+		for i, lane_curr in enumerate(self.lane_list):
+			if lane_curr.type != 'Main':
+				continue
+			queue = self.queue[i] + self.streams[i].take(self.time)
+			self.num_dropped += max(0, queue - self.max_queue)
+			self.queue[i] = min(queue, self.max_queue)
+			if self.queue[i] == 0:
+				continue
+
+			if random.random() < self.permeability:
+				vehicle_type, configs = CAV, self.configs['CAV']
+			else:
+				vehicle_type, configs = HV, self.configs['HV']
+			last_vehicle = lane_curr.fleet.rear_vehicle
+			if last_vehicle is None:
+				speed = configs.get('desired_speed_main', 25)
+			else:
+				gap = last_vehicle.position - last_vehicle.length - lane_curr.start
+				if gap < configs.get('jam_distance', 10):
+					continue  # The entrance is blocked, the arrival keeps waiting
+				speed = last_vehicle.speed
+			vehicle = self.pool.acquire(vehicle_type, speed, None, lane_curr.start, 0, **configs)
+			lane_curr.fleet.add_vehicle(vehicle, last_vehicle)
+			self.queue[i] -= 1
+			num_inserted += 1
+		self.num_inserted += num_inserted
+		return num_inserted
+
+	def update(self, epoch: int, dt: float):
+		"""
+		Retires the vehicles which have left the road and inserts the new arrivals.
+
+		:param epoch: the current epoch
+		:param dt: time step
+		"""
+		self.retire(epoch)
+		self.insert(dt)
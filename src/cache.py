@@ -0,0 +1,55 @@
+class AccelerationCache(object):
+	"""
+	Memoization of car-following accelerations within a simulation step.
+
+	Every ``FleetState`` carries a version which changes whenever a state of one of its vehicles is written or a
+	vehicle is added or removed. Accelerations are stored together with the versions they were calculated from, so
+	an entry becomes invalid as soon as ``Vehicle.update``, ``Fleet.update_vehicles`` or ``Vehicle.move_to_lane``
+	changes the positions or the links it depends on. Hits and misses are counted per vehicle evaluation.
+	"""
+
+	def __init__(self):
+		self.enabled = True
+		self.hits = 0  # Number of accelerations taken from the cache
+		self.misses = 0  # Number of accelerations calculated
+
+	@property
+	def hit_rate(self) -> float:
+		total = self.hits + self.misses
+		return self.hits / total if total else 0.0
+
+	def reset(self):
+		"""Resets the counters."""
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, owner, key, count: int = 1):
+		"""
+		Returns the cached acceleration of the owner if it has been calculated for the same key.
+
+		:param owner: a vehicle or a fleet, the entry is stored in its ``_acc_cache`` attribute
+		:param key: the versions of the states the acceleration depends on
+		:param count: number of vehicle evaluations the entry stands for
+		:return: the cached acceleration, None if there is no valid entry
+		"""
+		entry = owner._acc_cache
+		if self.enabled and entry is not None and entry[0] == key:
+			self.hits += count
+			return entry[1]
+		self.misses += count
+		return None
+
+	def put(self, owner, key, acc):
+		"""
+		Stores the acceleration of the owner.
+
+		:param owner: a vehicle or a fleet
+		:param key: the versions of the states the acceleration depends on
+		:param acc: the acceleration, or the array of accelerations of a fleet
+		"""
+		if self.enabled:
+			owner._acc_cache = (key, acc)
+
+
+# Cache shared by all fleets and vehicles
+acceleration_cache = AccelerationCache()
@@ -0,0 +1,328 @@
+import json
+import random
+import numpy as np
+from vehicle import *
+from lane import Lane, MainLane, Ramp
+from fleet import Fleet
+from platoon import Platoon
+from state import FleetState
+from structure import VehicleList
+from parameters import VehicleParameters
+from integration import INTEGRATORS
+from boundary import OpenBoundary
+from models import LANE_CHANGE_LEFT, LANE_CHANGE_RIGHT
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+
+FORMAT_VERSION = 1
+LANE_TYPES = {'Main': MainLane, 'Ramp': Ramp}
+VEHICLE_TYPES = {'HV': HV, 'CAV': CAV, 'Truck': Truck}
+VEHICLE_TYPE_NAMES = tuple(VEHICLE_TYPES)
+LANE_CHANGE_DIRECTIONS = (LANE_CHANGE_LEFT, LANE_CHANGE_RIGHT)  # Stored as the index of the direction
+INTEGRATOR_NAMES = tuple(INTEGRATORS)
+# States of a vehicle which are stored, parameters are stored once per distinct parameter set
+STATE_FIELDS = ('position', 'speed', 'acc', 'obstacle_position')
+
+
+def get_lane_change_rows(lane_list: List[Lane]) -> np.ndarray:
+	"""
+	Collects the pending lane changes of all lanes, see ``Fleet.get_lane_change_intents``.
+
+	:param lane_list: the lanes of the simulation
+	:return: rows of lane, vehicle id, front vehicle id (-1 for None) and direction (0 for left, 1 for right)
+	"""
+	rows = []
+	for i, lane_curr in enumerate(lane_list):
+		index, direction, front = lane_curr.fleet.get_lane_change_intents()
+		vehicles = lane_curr.fleet.vehicles
+		for k, lc_direction, front_index in zip(index.tolist(), direction.tolist(), front.tolist()):
+			target_lane = lane_curr.left_lane if lc_direction == LANE_CHANGE_LEFT else lane_curr.right_lane
+			front_id = target_lane.fleet.vehicles[front_index].id if front_index >= 0 else -1
+			rows.append([i, vehicles[k].id, front_id, LANE_CHANGE_DIRECTIONS.index(lc_direction)])
+	return np.array(rows, dtype=np.int64).reshape(-1, 4)
+
+
+def save_checkpoint(file: Union[str, BinaryIO], lane_list: List[Lane], epoch: int = 0,
+                    boundary: Optional[OpenBoundary] = None, **metadata):
+	"""
+	Writes the full state of a simulation into one uncompressed ``.npz`` archive, see ``pack_state``.
+
+	:param file: path or binary file object
+	:param lane_list: the lanes of the simulation
+	:param epoch: the current epoch
+	:param boundary: the open boundaries of the simulation, if any
+	:param metadata: further JSON-serializable values stored with the checkpoint
+	"""
+	np.savez(file, **pack_state(lane_list, epoch, boundary, **metadata))
+
+
+def load_checkpoint(file: Union[str, BinaryIO], restore_rng: bool = True,
+                    boundary: Optional[OpenBoundary] = None) -> Tuple[List[Lane], int, dict]:
+	"""
+	Rebuilds a simulation from a checkpoint written by ``save_checkpoint``, see ``unpack_state``.
+
+	:param file: path or binary file object
+	:param restore_rng: whether to restore the states of the random number generators
+	:param boundary: open boundaries to restore the saved boundaries into, see ``unpack_state``
+	:return: the lanes, the epoch and the metadata passed to ``save_checkpoint``
+	"""
+	with np.load(file) as archive:
+		arrays = {name: archive[name] for name in archive.files}
+	return unpack_state(arrays, restore_rng, boundary)
+
+
+def pack_state(lane_list: List[Lane], epoch: int = 0, boundary: Optional[OpenBoundary] = None,
+               **metadata) -> Dict[str, np.ndarray]:
+	"""
+	Collects the full state of a simulation into arrays.
+
+	The arrays hold the lane topology, the states of the vehicles of each lane as arrays ordered from front to
+	rear, the distinct parameter sets, platoon membership and formation, pending lane changes, the obstacle tables and
+	the states of the random number generators of ``numpy`` and ``random``. Front and rear links are implied by the
+	order of the vehicles in their lane. Per-vehicle state records (``Vehicle.record_states``) are not stored.
+
+	With open boundaries, their time, counters and queues and the arrival times already drawn by each
+	``ArrivalStream`` are stored as well. Their settings (inflow, vehicle types, headway distribution) and the pooled
+	vehicle objects are not, the boundaries are restored into an ``OpenBoundary`` built with the same settings.
+
+	:param lane_list: the lanes of the simulation
+	:param epoch: the current epoch
+	:param boundary: the open boundaries of the simulation, if any
+	:param metadata: further JSON-serializable values stored with the state
+	:return: the arrays by name
+	"""
+	lane_index = {lane_curr: i for i, lane_curr in enumerate(lane_list)}
+	arrays = {}
+
+	# Lane topology, -1 for a missing neighboring lane
+	arrays['lane_type'] = np.array([lane_curr.type for lane_curr in lane_list])
+	arrays['lane_geometry'] = np.array([[lane_curr.length, lane_curr.start, lane_curr.end, lane_curr.max_speed,
+	                                     lane_curr.min_speed, lane_curr.capacity] for lane_curr in lane_list],
+	                                   dtype=float).reshape(-1, 6)
+	arrays['lane_neighbors'] = np.array([[lane_index.get(lane_curr.left_lane, -1),
+	                                      lane_index.get(lane_curr.right_lane, -1)] for lane_curr in lane_list],
+	                                    dtype=np.int64).reshape(-1, 2)
+
+	# Vehicles of all lanes, ordered from front to rear within each lane
+	vehicles = []
+	offsets = [0]
+	for lane_curr in lane_list:
+		vehicles.extend(lane_curr.fleet.vehicles)
+		offsets.append(len(vehicles))
+	arrays['lane_offsets'] = np.array(offsets, dtype=np.int64)
+	arrays['vehicle_id'] = np.array([vehicle.id for vehicle in vehicles], dtype=np.int64)
+	arrays['vehicle_type'] = np.array([VEHICLE_TYPE_NAMES.index(vehicle.type) for vehicle in vehicles],
+	                                  dtype=np.int8)
+	for field in STATE_FIELDS:
+		arrays[field] = np.array([getattr(vehicle, field) for vehicle in vehicles], dtype=float)
+	arrays['flags'] = np.array([[vehicle.in_platoon, vehicle.lane_change_indicator] for vehicle in vehicles],
+	                           dtype=bool).reshape(-1, 2)
+	params_index = {}
+	arrays['params_index'] = np.array([params_index.setdefault(vehicle.params, len(params_index))
+	                                   for vehicle in vehicles], dtype=np.int64)
+	arrays['params'] = np.array(list(params_index), dtype=float).reshape(-1, len(VehicleParameters._fields))
+
+	# Platoons as lane, size limit, minimum distance and members
+	platoons = [(i, platoon) for i, lane_curr in enumerate(lane_list) for platoon in lane_curr.fleet.platoons]
+	arrays['platoons'] = np.array([[i, platoon.max_size, platoon.MIN_DISTANCE] for i, platoon in platoons],
+	                              dtype=float).reshape(-1, 3)
+	arrays['platoon_offsets'] = np.cumsum([0] + [len(platoon) for _, platoon in platoons]).astype(np.int64)
+	arrays['platoon_members'] = np.array([vehicle.id for _, platoon in platoons for vehicle in platoon],
+	                                     dtype=np.int64)
+	# Platoon formation as the size limit of each lane (0 if disabled) and the vehicles still to be checked
+	arrays['platoon_size'] = np.array([lane_curr.fleet.platoon_size or 0 for lane_curr in lane_list], dtype=np.int64)
+	arrays['platoon_candidates'] = np.array([[i, vehicle_id] for i, lane_curr in enumerate(lane_list)
+	                                         for vehicle_id in lane_curr.fleet._platoon_candidates],
+	                                        dtype=np.int64).reshape(-1, 2)
+	# Integration scheme of each lane
+	arrays['integrators'] = np.array([INTEGRATOR_NAMES.index(lane_curr.fleet.integrator) for lane_curr in lane_list],
+	                                 dtype=np.int64)
+
+	# Obstacles as lane, position, start and end time, and the current time of the obstacle table of each lane
+	arrays['obstacles'] = np.array([[i, position, start, end] for i, lane_curr in enumerate(lane_list)
+	                                for position, start, end in zip(lane_curr.obstacles.position.tolist(),
+	                                                                lane_curr.obstacles.start.tolist(),
+	                                                                lane_curr.obstacles.end.tolist())],
+	                               dtype=float).reshape(-1, 4)
+	arrays['obstacle_time'] = np.array([lane_curr.obstacles.time for lane_curr in lane_list], dtype=float)
+
+	# Pending lane changes as lane, vehicle id, front vehicle id (-1 for None) and direction
+	arrays['lane_changes'] = get_lane_change_rows(lane_list)
+	arrays['num_lane_changes'] = np.array([lane_curr.fleet.num_lane_changes for lane_curr in lane_list],
+	                                      dtype=np.int64)
+
+	# Open boundaries as time, counters, queue of each lane and the pending arrival times of each stream
+	if boundary is not None:
+		arrays['boundary_time'] = np.array(boundary.time, dtype=float)
+		arrays['boundary_counters'] = np.array([boundary.num_retired, boundary.num_inserted, boundary.num_dropped],
+		                                       dtype=np.int64)
+		arrays['boundary_queue'] = np.array(boundary.queue, dtype=np.int64)
+		arrival_offsets = np.cumsum([0] + [len(stream._times) for stream in boundary.streams])
+		arrays['arrival_offsets'] = arrival_offsets.astype(np.int64)
+		arrays['arrival_times'] = np.concatenate([np.zeros(0)] + [stream._times for stream in boundary.streams])
+		arrays['arrival_last_time'] = np.array([stream._last_time for stream in boundary.streams], dtype=float)
+
+	# Random number generators
+	name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+	arrays['numpy_rng_keys'] = keys
+	version, internal_state, gauss_next = random.getstate()
+	arrays['random_state'] = np.array(internal_state, dtype=np.int64)
+
+	arrays['metadata'] = np.array(json.dumps({
+		'format_version': FORMAT_VERSION,
+		'epoch': epoch,
+		'vehicle_count': Vehicle.cnt,
+		'numpy_rng': [name, int(position), int(has_gauss), float(cached_gaussian)],
+		'random': [version, gauss_next],
+		'metadata': metadata,
+	}))
+	return arrays
+
+
+def unpack_state(arrays: Dict[str, np.ndarray], restore_rng: bool = True,
+                 boundary: Optional[OpenBoundary] = None) -> Tuple[List[Lane], int, dict]:
+	"""
+	Rebuilds a simulation from the arrays of ``pack_state``.
+
+	The state storage of each fleet is filled with array copies and the vehicle objects are created without running
+	their constructors, so restoring is cheap enough to fork many runs from one checkpoint.
+
+	:param arrays: the arrays by name
+	:param restore_rng: whether to restore the states of the random number generators
+	:param boundary: an ``OpenBoundary`` built with the settings of the saved one, which gets the saved state and is
+	                 moved to the restored lanes, None to ignore saved boundaries
+	:return: the lanes, the epoch and the metadata passed to ``pack_state``
+	"""
+	info = json.loads(str(arrays['metadata']))
+	if info['format_version'] != FORMAT_VERSION:
+		raise ValueError('Unsupported checkpoint format {}'.format(info['format_version']))
+
+	# Lanes
+	lane_list = []
+	for lane_type, (length, start, end, max_speed, min_speed, capacity) in zip(arrays['lane_type'].tolist(),
+	                                                                           arrays['lane_geometry'].tolist()):
+		lane_curr = LANE_TYPES[lane_type](length, start, end, max_speed=max_speed, min_speed=min_speed,
+		                                  capacity=capacity)
+		lane_curr.fleet = Fleet(lane_curr)
+		lane_list.append(lane_curr)
+	for lane_curr, (left, right) in zip(lane_list, arrays['lane_neighbors'].tolist()):
+		lane_curr.left_lane = lane_list[left] if left >= 0 else None
+		lane_curr.right_lane = lane_list[right] if right >= 0 else None
+
+	# Vehicles
+	params_list = [VehicleParameters(*row).intern() for row in arrays['params'].tolist()]
+	params_table = arrays['params'][:, [VehicleParameters._fields.index(field)
+	                                    for field in FleetState.PARAMETER_FIELDS]]
+	vehicle_of = {}
+	offsets = arrays['lane_offsets']
+	for i, lane_curr in enumerate(lane_list):
+		rows = slice(int(offsets[i]), int(offsets[i + 1]))
+		fleet = lane_curr.fleet
+		num = rows.stop - rows.start
+		state = FleetState(capacity=max(64, num))
+		state.size = num
+		state.vehicle_id[:num] = arrays['vehicle_id'][rows]
+		for field in STATE_FIELDS:
+			getattr(state, field)[:num] = arrays[field][rows]
+		params_index = arrays['params_index'][rows]
+		for j, field in enumerate(FleetState.PARAMETER_FIELDS):
+			getattr(state, field)[:num] = params_table[params_index, j]
+		fleet.state = state
+
+		front_vehicle = None
+		for slot, (vehicle_id, vehicle_type, index, (in_platoon, indicator)) in enumerate(zip(
+				arrays['vehicle_id'][rows].tolist(), arrays['vehicle_type'][rows].tolist(), params_index.tolist(),
+				arrays['flags'][rows].tolist())):
+			vehicle_class = VEHICLE_TYPES[VEHICLE_TYPE_NAMES[vehicle_type]]
+			vehicle = vehicle_class.__new__(vehicle_class)  # The states are already in the storage
+			vehicle._state = state
+			vehicle._slot = slot
+			vehicle._params = params_list[index]
+			vehicle._acc_cache = None
+			vehicle.id = vehicle_id
+			vehicle.lane = lane_curr
+			vehicle.front_vehicle = front_vehicle
+			vehicle.rear_vehicle = None
+			vehicle.platoon = None
+			if Vehicle.record_states:
+				vehicle.position_record = []
+				vehicle.speed_record = []
+				vehicle.acc_record = []
+			else:
+				vehicle.position_record = vehicle.speed_record = vehicle.acc_record = None
+			vehicle.in_platoon = in_platoon
+			vehicle.lane_change_indicator = indicator
+			if front_vehicle is not None:
+				front_vehicle.rear_vehicle = vehicle
+			fleet.append(vehicle)
+			vehicle_of[vehicle_id] = vehicle
+			front_vehicle = vehicle
+		fleet.num_lane_changes = int(arrays['num_lane_changes'][i])
+
+	# Platoons
+	members = arrays['platoon_members'].tolist()
+	platoon_offsets = arrays['platoon_offsets'].tolist()
+	for k, (i, max_size, min_distance) in enumerate(arrays['platoons'].tolist()):
+		platoon = Platoon.__new__(Platoon)
+		VehicleList.__init__(platoon)
+		platoon.MIN_DISTANCE = min_distance
+		platoon.max_size = int(max_size)
+		for vehicle_id in members[platoon_offsets[k]:platoon_offsets[k + 1]]:
+			platoon.append(vehicle_of[vehicle_id])
+			vehicle_of[vehicle_id].platoon = platoon
+		lane_list[int(i)].fleet.platoons.append(platoon)
+	if 'platoon_size' in arrays:
+		for lane_curr, platoon_size in zip(lane_list, arrays['platoon_size'].tolist()):
+			lane_curr.fleet.platoon_size = platoon_size or None
+		for i, vehicle_id in arrays['platoon_candidates'].tolist():
+			lane_list[i].fleet._platoon_candidates[vehicle_id] = vehicle_of[vehicle_id]
+	if 'integrators' in arrays:
+		for lane_curr, integrator in zip(lane_list, arrays['integrators'].tolist()):
+			lane_curr.fleet.integrator = INTEGRATOR_NAMES[integrator]
+
+	if 'obstacles' in arrays:
+		obstacles = arrays['obstacles']
+		for i, lane_curr in enumerate(lane_list):
+			lane_curr.obstacles.time = float(arrays['obstacle_time'][i])
+			rows = obstacles[obstacles[:, 0] == i]
+			if len(rows):
+				lane_curr.obstacles.add(rows[:, 1], rows[:, 2], rows[:, 3])
+
+	# Pending lane changes of vehicles which are still on the road
+	lane_changes = arrays['lane_changes']
+	for i, lane_curr in enumerate(lane_list):
+		rows = lane_changes[lane_changes[:, 0] == i]
+		if len(rows) == 0:
+			continue
+		fleet = lane_curr.fleet
+		direction = np.zeros(len(fleet), dtype=np.int8)
+		front = np.full(len(fleet), -1, dtype=np.intp)
+		for _, vehicle_id, front_id, code in rows.tolist():
+			vehicle = vehicle_of.get(vehicle_id)
+			if vehicle is None:
+				continue
+			direction[vehicle._slot] = LANE_CHANGE_DIRECTIONS[code]
+			front[vehicle._slot] = vehicle_of[front_id]._slot if front_id in vehicle_of else -1
+		fleet.set_lane_change_intention(direction, front, front)
+
+	if boundary is not None:
+		if 'boundary_queue' not in arrays:
+			raise ValueError('The checkpoint has no open boundaries')
+		if len(boundary.streams) != len(lane_list):
+			raise ValueError('The boundaries have {} lanes, the checkpoint {}'.format(len(boundary.streams),
+			                                                                         len(lane_list)))
+		boundary.lane_list = lane_list
+		boundary.time = float(arrays['boundary_time'])
+		boundary.num_retired, boundary.num_inserted, boundary.num_dropped = arrays['boundary_counters'].tolist()
+		boundary.queue = arrays['boundary_queue'].tolist()
+		arrival_offsets = arrays['arrival_offsets'].tolist()
+		for i, (stream, last_time) in enumerate(zip(boundary.streams, arrays['arrival_last_time'].tolist())):
+			stream._times = arrays['arrival_times'][arrival_offsets[i]:arrival_offsets[i + 1]].copy()
+			stream._last_time = last_time
+
+	Vehicle.cnt = max(Vehicle.cnt, info['vehicle_count'])
+	if restore_rng:
+		name, position, has_gauss, cached_gaussian = info['numpy_rng']
+		np.random.set_state((name, arrays['numpy_rng_keys'], position, has_gauss, cached_gaussian))
+		version, gauss_next = info['random']
+		random.setstate((version, tuple(arrays['random_state'].tolist()), gauss_next))
+	return lane_list, info['epoch'], info['metadata']
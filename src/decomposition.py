@@ -0,0 +1,498 @@
+import multiprocessing
+import traceback
+import numpy as np
+from multiprocessing import shared_memory
+from vehicle import *
+from lane import Lane
+from boundary import VehiclePool
+from obstacles import advance_obstacles
+from checkpoint import (pack_state, unpack_state, get_lane_change_rows, VEHICLE_TYPES, VEHICLE_TYPE_NAMES,
+                        STATE_FIELDS)
+from lane_change import LaneChangeIntents, resolve_conflicts
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Columns of a vehicle record exchanged between the coordinator and the workers
+RECORD_FIELDS = ('vehicle_id', 'vehicle_type', 'params_index', 'in_platoon', 'lane_change_indicator') + STATE_FIELDS
+# Columns of the shared state buffer of a worker, written after every step
+BUFFER_FIELDS = ('vehicle_id',) + STATE_FIELDS
+# Number of ghost leaders and ghost followers per lane. Two leaders are needed so that the acceleration of the
+# nearest ghost leader, which enters the lane-change incentive of the vehicles behind it, is exact. Each evaluation
+# of the accelerations within a step reaches one vehicle further back, so the four stages of the 'rk4' integrator
+# need four leaders.
+GHOST_DEPTH = 4
+
+
+class SegmentWorker(object):
+	"""
+	Owner of the vehicles of one segment of the road, running in a worker process.
+
+	The worker keeps the lanes of the whole road with only its own vehicles. Ghost vehicles of the neighboring
+	segments are inserted in front of and behind its vehicles for each phase and removed afterwards, so that the
+	lane-change intention and the car-following of its own vehicles see the same neighbors as in a single process.
+	"""
+
+	def __init__(self, arrays: Dict[str, np.ndarray], buffer_name: str, capacity: int):
+		"""
+		:param arrays: the state of the segment, see ``checkpoint.pack_state``
+		:param buffer_name: name of the shared memory the states are published to
+		:param capacity: number of rows of the shared memory
+		"""
+		Vehicle.record_states = False
+		self.lane_list, _, _ = unpack_state(arrays, restore_rng=False)
+		self.params_list = [VehicleParameters(*row).intern() for row in arrays['params'].tolist()]
+		self.vehicle_of = {vehicle.id: vehicle for lane_curr in self.lane_list for vehicle in lane_curr.fleet}
+		self.ghosts = []
+		self.pool = VehiclePool()
+		self.buffer = shared_memory.SharedMemory(name=buffer_name)
+		self.states = np.ndarray((capacity, len(BUFFER_FIELDS)), dtype=float, buffer=self.buffer.buf)
+
+	def close(self):
+		del self.states
+		self.buffer.close()
+
+	def _make_vehicle(self, record: List[float]) -> Vehicle:
+		"""Creates a detached vehicle from a record."""
+		vehicle_id, vehicle_type, params_index, in_platoon, indicator, position, speed, acc, obstacle = record
+		params = self.params_list[int(params_index)]
+		vehicle = self.pool.acquire(VEHICLE_TYPES[VEHICLE_TYPE_NAMES[int(vehicle_type)]], speed, None, position, acc,
+		                            **params._asdict())
+		vehicle.id = int(vehicle_id)
+		vehicle._state.vehicle_id[vehicle._slot] = vehicle.id
+		vehicle.obstacle_position = obstacle
+		vehicle.in_platoon = bool(in_platoon)
+		vehicle.lane_change_indicator = bool(indicator)
+		return vehicle
+
+	def _apply_moves(self, moves: tuple):
+		"""
+		Removes the vehicles which left their lane or the segment and inserts the vehicles which entered a lane of the
+		segment, see ``DecomposedSimulation._redistribute``.
+		"""
+		removals, lanes, fronts, records = moves
+		removed = {}
+		for vehicle_id in removals.tolist():
+			vehicle = self.vehicle_of[vehicle_id]
+			vehicle.lane.fleet.remove_vehicle(vehicle)
+			removed[vehicle_id] = vehicle
+		for lane_index, front_id, record in zip(lanes.tolist(), fronts.tolist(), records.tolist()):
+			vehicle_id = int(record[0])
+			vehicle = removed.pop(vehicle_id, None)
+			if vehicle is None:
+				vehicle = self._make_vehicle(record)
+				self.vehicle_of[vehicle_id] = vehicle
+			# The front vehicle is None if the vehicle is the first of the segment in its lane
+			self.lane_list[lane_index].fleet.add_vehicle(vehicle, self.vehicle_of.get(front_id))
+		# Vehicles handed off to other segments
+		for vehicle_id, vehicle in removed.items():
+			del self.vehicle_of[vehicle_id]
+			self.pool.release(vehicle)
+
+	def _insert_ghosts(self, ghosts: tuple):
+		"""Inserts the ghost leaders in front of and the ghost followers behind the vehicles of each lane."""
+		lanes, behind, records = ghosts
+		front_vehicles = [None] * len(self.lane_list)
+		for lane_index, is_follower, record in zip(lanes.tolist(), behind.tolist(), records.tolist()):
+			ghost = self._make_vehicle(record)
+			fleet = self.lane_list[lane_index].fleet
+			if is_follower:
+				fleet.add_vehicle(ghost, fleet.rear_vehicle)
+			else:
+				fleet.add_vehicle(ghost, front_vehicles[lane_index])
+				front_vehicles[lane_index] = ghost
+			self.ghosts.append(ghost)
+
+	def _remove_ghosts(self):
+		for ghost in self.ghosts:
+			ghost.lane.fleet.remove_vehicle(ghost)
+			self.pool.release(ghost)
+		self.ghosts = []
+
+	def intention(self, moves: tuple, ghosts: tuple) -> np.ndarray:
+		"""
+		Computes the lane-change intentions of the vehicles of the segment.
+
+		:return: the intentions as rows of lane, vehicle id, front vehicle id (-1 for None) and direction
+		"""
+		self._apply_moves(moves)
+		self._insert_ghosts(ghosts)
+		adjacent_list = [lane_curr.fleet.get_adjacent_vehicle_list(lane_curr.left_lane) +
+		                 lane_curr.fleet.get_adjacent_vehicle_list(lane_curr.right_lane)
+		                 for lane_curr in self.lane_list]
+		for lane_curr, adjacent in zip(self.lane_list, adjacent_list):
+			front_veh_list_left, rear_veh_list_left, front_veh_list_right, rear_veh_list_right = adjacent
+			lane_curr.fleet.get_lane_change_intention(front_veh_list_left, front_veh_list_right,
+			                                          rear_veh_list_left, rear_veh_list_right)
+		intentions = get_lane_change_rows(self.lane_list)
+		intentions = intentions[~np.isin(intentions[:, 1], [ghost.id for ghost in self.ghosts])]
+		self._remove_ghosts()
+		return intentions
+
+	def update(self, moves: tuple, ghosts: tuple, dt: float) -> List[int]:
+		"""
+		Updates the vehicles of the segment by one time step and publishes their states to the shared memory, lane by
+		lane and ordered from front to rear.
+
+		:return: the number of vehicles of each lane
+		"""
+		self._apply_moves(moves)
+		self._insert_ghosts(ghosts)
+		for lane_curr in self.lane_list:
+			lane_curr.fleet.update_vehicles(dt)
+		advance_obstacles(self.lane_list, dt)
+		self._remove_ghosts()
+
+		counts = []
+		row = 0
+		for lane_curr in self.lane_list:
+			num = lane_curr.fleet.sync_state()
+			state = lane_curr.fleet.state
+			for j, field in enumerate(BUFFER_FIELDS):
+				self.states[row:row + num, j] = getattr(state, field)[:num]
+			row += num
+			counts.append(num)
+		return counts
+
+
+def _serve(connection, arrays: Dict[str, np.ndarray], buffer_name: str, capacity: int):
+	"""Main loop of a worker process: runs the commands of the coordinator until it is closed."""
+	worker = SegmentWorker(arrays, buffer_name, capacity)
+	try:
+		while True:
+			command, args = connection.recv()
+			if command == 'close':
+				break
+			try:
+				connection.send((True, getattr(worker, command)(*args)))
+			except Exception:
+				connection.send((False, traceback.format_exc()))
+	finally:
+		worker.close()
+		connection.close()
+
+
+class DecomposedSimulation(object):
+	"""
+	Simulation of a closed road split along x into segments, each owned by a worker process.
+
+	Each step has two phases. Before the lane-change intention and again before the car-following update, the
+	coordinator splits every lane at the segment boundaries, hands off the vehicles which crossed a boundary or changed
+	their lane, and sends each worker the ghost leaders and followers next to its vehicles. Intentions are gathered
+	from all workers and performed together over the whole road, so lane changes across a boundary are resolved as in
+	a single process. After the update the workers publish the states of their vehicles to shared memory.
+
+	The run matches ``simulation.step`` in a single process as long as the vehicles of each lane stay ordered by
+	position. Platoons and open boundaries are not supported.
+	"""
+
+	def __init__(self, lane_list: List[Lane], num_workers: int = 2, boundaries: Optional[Sequence[float]] = None,
+	             context: str = 'spawn'):
+		"""
+		Distributes the vehicles to the workers and starts them.
+
+		:param lane_list: the lanes with their initial vehicles, they are not modified
+		:param num_workers: number of segments, ignored if ``boundaries`` is given
+		:param boundaries: positions between the segments, by default the segments start with equal numbers of vehicles
+		:param context: start method of the worker processes
+		"""
+		arrays = pack_state(lane_list)
+		if len(arrays['platoons']) or arrays['platoon_size'].any():
+			raise ValueError('Platoons are not supported by the decomposed simulation')
+		self.template = arrays
+		self.num_lanes = len(lane_list)
+		self.neighbors = arrays['lane_neighbors']
+		self.num_lane_changes = arrays['num_lane_changes'].copy()
+
+		# Tables of the vehicles by id
+		vehicle_id = arrays['vehicle_id']
+		size = int(vehicle_id.max()) + 1 if len(vehicle_id) else 0
+		self.vehicle_type = np.zeros(size, dtype=np.int8)
+		self.params_index = np.zeros(size, dtype=np.int64)
+		self.flags = np.zeros((size, 2), dtype=bool)
+		self.vehicle_type[vehicle_id] = arrays['vehicle_type']
+		self.params_index[vehicle_id] = arrays['params_index']
+		self.flags[vehicle_id] = arrays['flags']
+		self.states = {}
+		for field in STATE_FIELDS:
+			self.states[field] = np.zeros(size)
+			self.states[field][vehicle_id] = arrays[field]
+		self.index_of = np.zeros(size, dtype=np.int64)  # Index of each vehicle in its lane
+
+		# Vehicle ids of each lane ordered from front to rear
+		offsets = arrays['lane_offsets']
+		self.lists = [vehicle_id[offsets[i]:offsets[i + 1]].copy() for i in range(self.num_lanes)]
+
+		if boundaries is None:
+			boundaries = np.quantile(arrays['position'], np.arange(1, num_workers) / num_workers) \
+				if len(vehicle_id) else np.zeros(num_workers - 1)
+		# Boundaries from downstream to upstream, segment 0 is the most downstream one
+		self.boundaries = np.sort(np.asarray(boundaries, dtype=float))[::-1]
+		self.num_workers = len(self.boundaries) + 1
+
+		self.owned = self._partition()
+		capacity = max(1, len(vehicle_id))
+		context = multiprocessing.get_context(context)
+		self.buffers = []
+		self.connections = []
+		self.processes = []
+		for k in range(self.num_workers):
+			buffer = shared_memory.SharedMemory(create=True, size=capacity * len(BUFFER_FIELDS) * 8)
+			connection, child_connection = context.Pipe()
+			process = context.Process(target=_serve, args=(child_connection, self._segment_arrays(self.owned[k]),
+			                                               buffer.name, capacity), daemon=True)
+			process.start()
+			child_connection.close()
+			self.buffers.append(buffer)
+			self.connections.append(connection)
+			self.processes.append(process)
+		self.views = [np.ndarray((capacity, len(BUFFER_FIELDS)), dtype=float, buffer=buffer.buf)
+		              for buffer in self.buffers]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback_):
+		self.close()
+
+	def close(self):
+		"""Stops the workers and frees the shared memory."""
+		for connection in self.connections:
+			try:
+				connection.send(('close', ()))
+			except (BrokenPipeError, OSError):
+				pass
+		for process in self.processes:
+			process.join()
+		for connection in self.connections:
+			connection.close()
+		self.views = []
+		for buffer in self.buffers:
+			buffer.close()
+			buffer.unlink()
+		self.buffers = []
+		self.connections = []
+		self.processes = []
+
+	def _records(self, vehicle_ids: np.ndarray) -> np.ndarray:
+		"""Records of the given vehicles, see ``RECORD_FIELDS``."""
+		return np.column_stack([vehicle_ids, self.vehicle_type[vehicle_ids], self.params_index[vehicle_ids],
+		                        self.flags[vehicle_ids, 0], self.flags[vehicle_ids, 1]] +
+		                       [self.states[field][vehicle_ids] for field in STATE_FIELDS]).astype(float)
+
+	def _segment_arrays(self, lists: List[np.ndarray]) -> Dict[str, np.ndarray]:
+		"""State of the given vehicles in the format of ``checkpoint.pack_state``."""
+		arrays = dict(self.template)
+		vehicle_id = np.concatenate(lists).astype(np.int64)
+		arrays['lane_offsets'] = np.cumsum([0] + [len(ids) for ids in lists]).astype(np.int64)
+		arrays['vehicle_id'] = vehicle_id
+		arrays['vehicle_type'] = self.vehicle_type[vehicle_id]
+		arrays['params_index'] = self.params_index[vehicle_id]
+		arrays['flags'] = self.flags[vehicle_id]
+		for field in STATE_FIELDS:
+			arrays[field] = self.states[field][vehicle_id]
+		arrays['lane_changes'] = np.zeros((0, 4), dtype=np.int64)
+		arrays['num_lane_changes'] = self.num_lane_changes.copy()
+		return arrays
+
+	def _partition(self) -> List[List[np.ndarray]]:
+		"""
+		Splits each lane at the boundaries. A segment gets the vehicles from the first vehicle behind its upstream
+		boundary on, so that the segments are contiguous in the order of the lane.
+
+		:return: the vehicle ids of each segment and lane
+		"""
+		owned = [[] for _ in range(self.num_workers)]
+		for ids in self.lists:
+			position = self.states['position'][ids]
+			if len(ids):
+				# First index behind each boundary, found on the running minimum which is non-increasing
+				lowest = np.minimum.accumulate(position)
+				splits = np.searchsorted(-lowest, -self.boundaries, side='right')
+			else:
+				splits = np.zeros(len(self.boundaries), dtype=np.intp)
+			edges = [0] + splits.tolist() + [len(ids)]
+			for k in range(self.num_workers):
+				owned[k].append(ids[edges[k]:edges[k + 1]])
+		return owned
+
+	def _redistribute(self) -> List[Tuple[tuple, tuple]]:
+		"""
+		Splits the lanes at the boundaries again and determines, for each worker, the vehicles to remove, the vehicles
+		to insert behind their front vehicle in the new order, and the ghost vehicles.
+
+		:return: the moves and ghosts of each worker
+		"""
+		owned = self._partition()
+		messages = []
+		for k in range(self.num_workers):
+			removals = []
+			lanes = []
+			fronts = []
+			inserted = []
+			ghost_lanes = []
+			ghost_behind = []
+			ghost_ids = []
+			for i in range(self.num_lanes):
+				old, new = self.owned[k][i], owned[k][i]
+				if len(old) != len(new) or not np.array_equal(old, new):
+					removals.append(old[~np.isin(old, new)])
+					index = np.flatnonzero(~np.isin(new, old))
+					lanes.append(np.full(len(index), i))
+					fronts.append(np.where(index > 0, new[index - 1], -1))
+					inserted.append(new[index])
+				# Position of the segment in the lane
+				start = sum(len(owned[j][i]) for j in range(k))
+				end = start + len(new)
+				leaders = self.lists[i][max(0, start - GHOST_DEPTH):start]
+				followers = self.lists[i][end:end + GHOST_DEPTH]
+				ghost_lanes.append(np.full(len(leaders) + len(followers), i))
+				ghost_behind.append(np.repeat([False, True], [len(leaders), len(followers)]))
+				ghost_ids.append(np.concatenate([leaders, followers]))
+			inserted = np.concatenate(inserted).astype(np.int64) if inserted else np.zeros(0, dtype=np.int64)
+			moves = (np.concatenate(removals).astype(np.int64) if removals else np.zeros(0, dtype=np.int64),
+			         np.concatenate(lanes).astype(np.int64) if lanes else np.zeros(0, dtype=np.int64),
+			         np.concatenate(fronts).astype(np.int64) if fronts else np.zeros(0, dtype=np.int64),
+			         self._records(inserted))
+			ghost_ids = np.concatenate(ghost_ids).astype(np.int64)
+			ghosts = (np.concatenate(ghost_lanes).astype(np.int64), np.concatenate(ghost_behind),
+			          self._records(ghost_ids))
+			messages.append((moves, ghosts))
+		self.owned = owned
+		return messages
+
+	def _call(self, command: str, args: List[tuple]) -> list:
+		"""Runs a command on all workers at once and returns their results."""
+		for connection, arg in zip(self.connections, args):
+			connection.send((command, arg))
+		results = []
+		for connection in self.connections:
+			success, result = connection.recv()
+			if not success:
+				raise RuntimeError('Worker failed:\n' + result)
+			results.append(result)
+		return results
+
+	def _change_lanes(self, intentions: List[np.ndarray]):
+		"""
+		Performs the lane changes of all workers together, the same as ``lane_change.change_lanes``: the gaps are
+		searched at the current positions, conflicts are resolved by ``lane_change.resolve_conflicts`` and the
+		vehicle ids of each lane are merged in one pass.
+		"""
+		rows = np.concatenate(intentions) if intentions else np.zeros((0, 4), dtype=np.int64)
+		if len(rows) == 0:
+			return
+		for ids in self.lists:
+			self.index_of[ids] = np.arange(len(ids))
+		position = self.states['position']
+		lane = rows[:, 0]
+		vehicle_id = rows[:, 1]
+		target = self.neighbors[lane, rows[:, 3]].astype(np.int64)
+		front = np.zeros(len(rows), dtype=np.int64)
+		for i in np.unique(target).tolist():
+			moving = target == i
+			front[moving] = np.searchsorted(-position[self.lists[i]], -position[vehicle_id[moving]], side='left') - 1
+		intents = LaneChangeIntents(lane, self.index_of[vehicle_id], target, front, position[vehicle_id])
+		accepted = resolve_conflicts(intents)
+
+		lists = list(self.lists)
+		for i, ids in enumerate(self.lists):
+			leaving = accepted & (lane == i)
+			arriving = accepted & (target == i)
+			if not leaving.any() and not arriving.any():
+				continue
+			# Staying vehicles keep their order, arriving vehicles follow the vehicle in front of their gap
+			stay = np.ones(len(ids), dtype=bool)
+			stay[intents.index[leaving]] = False
+			key = np.concatenate([2 * np.flatnonzero(stay) + 1, 2 * front[arriving] + 2])
+			lists[i] = np.concatenate([ids[stay], vehicle_id[arriving]])[np.argsort(key, kind='stable')]
+			self.num_lane_changes[i] += int(np.count_nonzero(leaving))
+		self.lists = lists
+
+	def _read_states(self, counts: List[List[int]]):
+		"""Reads the states published by the workers."""
+		offsets = [np.cumsum([0] + count) for count in counts]
+		for i in range(self.num_lanes):
+			rows = [view[offset[i]:offset[i + 1]] for view, offset in zip(self.views, offsets)]
+			rows = np.concatenate(rows) if rows else np.zeros((0, len(BUFFER_FIELDS)))
+			ids = rows[:, 0].astype(np.int64)
+			if not np.array_equal(ids, self.lists[i]):
+				raise RuntimeError('The vehicles of lane {} are out of sync with the workers'.format(i))
+			for j, field in enumerate(STATE_FIELDS):
+				self.states[field][ids] = rows[:, j + 1]
+
+	def step(self, dt: float):
+		"""
+		Advances the simulation by one epoch, the same as ``simulation.step``.
+
+		:param dt: time step
+		"""
+		messages = self._redistribute()
+		intentions = self._call('intention', messages)
+		self._change_lanes(intentions)
+		messages = self._redistribute()
+		counts = self._call('update', [(moves, ghosts, dt) for moves, ghosts in messages])
+		self._read_states(counts)
+
+	def lane_states(self, field: str) -> List[np.ndarray]:
+		"""
+		Returns a state of the vehicles of each lane ordered from front to rear.
+
+		:param field: 'vehicle_id' or one of ``checkpoint.STATE_FIELDS``
+		"""
+		if field == 'vehicle_id':
+			return [ids.copy() for ids in self.lists]
+		return [self.states[field][ids] for ids in self.lists]
+
+	def gather(self) -> List[Lane]:
+		"""
+		Rebuilds the whole road in this process.
+
+		:return: new lanes with the current vehicles
+		"""
+		arrays = self._segment_arrays(self.lists)
+		lane_list, _, _ = unpack_state(arrays, restore_rng=False)
+		return lane_list
+
+
+def run_decomposed(lane_list: List[Lane], num_epochs: int, dt: float, num_workers: int = 2,
+                   measure_position: Optional[float] = None, boundaries: Optional[Sequence[float]] = None,
+                   context: str = 'spawn') -> Tuple[dict, List[Lane]]:
+	"""
+	Runs the simulation with the road split into segments owned by worker processes, see ``DecomposedSimulation``.
+
+	:param lane_list: list of lanes with their initial vehicles, they are not modified
+	:param num_epochs: number of epochs
+	:param dt: time step
+	:param num_workers: number of worker processes
+	:param measure_position: position of the cross-section where the throughput is counted, the middle of the first
+	                         lane if None
+	:param boundaries: positions between the segments, see ``DecomposedSimulation``
+	:param context: start method of the worker processes
+	:return: the metrics of ``simulation.run_simulation`` and the lanes at the end of the run
+	"""
+	if measure_position is None:
+		measure_position = lane_list[0].start + lane_list[0].length / 2
+	num_passed = 0
+	speed_sum = 0.0
+	speed_count = 0
+	with DecomposedSimulation(lane_list, num_workers, boundaries, context) as simulation:
+		downstream = np.zeros(len(simulation.vehicle_type), dtype=bool)
+		for ids, position in zip(simulation.lists, simulation.lane_states('position')):
+			downstream[ids[position >= measure_position]] = True
+
+		for epoch in range(num_epochs):
+			simulation.step(dt)
+			for ids, position, speed in zip(simulation.lists, simulation.lane_states('position'),
+			                                simulation.lane_states('speed')):
+				speed_sum += float(speed.sum())
+				speed_count += len(ids)
+				passed_id = ids[position >= measure_position]
+				num_passed += int(np.count_nonzero(~downstream[passed_id]))
+				downstream[passed_id] = True
+
+		metrics = {
+			'throughput': num_passed / (num_epochs * dt) * 3600,
+			'mean_speed': speed_sum / speed_count if speed_count else float('nan'),
+			'lane_changes': int(simulation.num_lane_changes.sum()),
+			'num_vehicles': sum(len(ids) for ids in simulation.lists),
+		}
+		return metrics, simulation.gather()
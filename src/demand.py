@@ -0,0 +1,192 @@
+import numpy as np
+from vehicle import *
+from lane import Lane
+from typing import List, Optional, Sequence, Tuple
+
+HEADWAY_DISTRIBUTIONS = ('poisson', 'shifted_exponential', 'empirical')
+
+
+def draw_headways(size: int, flow: float, distribution: str = 'poisson', min_headway: float = 1.0,
+                  samples: Optional[Sequence[float]] = None, rng=np.random) -> np.ndarray:
+	"""
+	Draws time headways between consecutive arrivals of one entry.
+
+	:param size: number of headways
+	:param flow: mean arrival rate in vehicles per hour, there are no arrivals (infinite headways) if it is not positive
+	:param distribution: 'poisson' for exponential headways, 'shifted_exponential' for exponential headways shifted by
+	                     ``min_headway``, or 'empirical' to resample ``samples``
+	:param min_headway: minimum headway of the shifted exponential distribution in seconds
+	:param samples: observed headways in seconds for the empirical distribution
+	:param rng: random number generator, ``np.random`` by default so that ``np.random.seed`` applies
+	:return: headways in seconds
+	"""
+	if distribution not in HEADWAY_DISTRIBUTIONS:
+		raise ValueError('Unknown headway distribution {}'.format(distribution))
+	if flow <= 0:
+		return np.full(size, np.inf)
+	mean = 3600 / flow
+	if distribution == 'poisson':
+		return rng.exponential(mean, size)
+	elif distribution == 'shifted_exponential':
+		if mean <= min_headway:
+			raise ValueError('Flow {} veh/h is not possible with a minimum headway of {} s'.format(flow, min_headway))
+		return min_headway + rng.exponential(mean - min_headway, size)
+	elif distribution == 'empirical':
+		if samples is None or len(samples) == 0:
+			raise ValueError('The empirical distribution needs samples of headways')
+		return rng.choice(np.asarray(samples, dtype=float), size)
+
+
+def draw_vehicle_types(size: int, permeability: float, rng=np.random) -> np.ndarray:
+	"""
+	Draws the type of each arrival.
+
+	:param size: number of arrivals
+	:param permeability: penetration rate of CAVs
+	:param rng: random number generator
+	:return: True for CAVs, False for HVs
+	"""
+	return rng.random(size) < permeability
+
+
+def safe_spacing(headways: np.ndarray, speed: float, is_cav: np.ndarray, configs: dict) -> np.ndarray:
+	"""
+	Converts time headways into distances between the fronts of consecutive vehicles and enlarges every distance
+	which would leave a gap smaller than the jam distance of the follower (the IDM ``s0``).
+
+	:param headways: time headways in seconds
+	:param speed: speed of the arrivals
+	:param is_cav: type of each vehicle, the first entry is the leader of the first headway
+	:param configs: settings of the vehicle types, i.e. ``settings['Vehicle']``
+	:return: distances between the front of each leader and the front of its follower
+	"""
+	length = np.where(is_cav, configs['CAV'].get('length', 5), configs['HV'].get('length', 5))
+	jam_distance = np.where(is_cav, configs['CAV'].get('jam_distance', 10), configs['HV'].get('jam_distance', 10))
+	# Gap of the follower of each headway = spacing - length of its leader
+	return np.maximum(headways * speed, length[:-1] + jam_distance[1:])
+
+
+def fill_lane(lane: Lane, configs: dict, flow: float, permeability: float = 0, speed: float = 15,
+              max_vehicles: Optional[int] = None, distribution: str = 'poisson', min_headway: float = 1.0,
+              samples: Optional[Sequence[float]] = None, rng=np.random) -> List[Vehicle]:
+	"""
+	Fills a lane from its rear vehicle (or its end if it is empty) back to its start with one arrival stream.
+
+	The whole stream is drawn at once. Vehicles are placed with the distance a vehicle drives at ``speed`` during its
+	headway, so that the density of the lane matches the flow; distances below the jam distance are enlarged.
+
+	:param lane: the lane to fill
+	:param configs: settings of the vehicle types, i.e. ``settings['Vehicle']``
+	:param flow: arrival rate in vehicles per hour, no vehicles are added if it is not positive
+	:param permeability: penetration rate of CAVs
+	:param speed: initial speed of the vehicles
+	:param max_vehicles: maximum number of vehicles to add, None to fill the whole lane
+	:param distribution: headway distribution, see ``draw_headways``
+	:param min_headway: minimum headway of the shifted exponential distribution in seconds
+	:param samples: observed headways in seconds for the empirical distribution
+	:param rng: random number generator
+	:return: the added vehicles ordered from front to rear
+	"""
+	fleet = lane.fleet
+	last_vehicle = fleet.rear_vehicle
+	front = last_vehicle.position if last_vehicle is not None else lane.end
+	# Upper bound of the number of vehicles that fit between the front position and the start of the lane
+	min_spacing = min(configs[vehicle_type].get('length', 5) + configs[vehicle_type].get('jam_distance', 10)
+	                  for vehicle_type in ('HV', 'CAV'))
+	size = max(0, int((front - lane.start) / min_spacing) + 1)
+	if max_vehicles is not None:
+		size = min(size, max_vehicles)
+	if size == 0 or flow <= 0:
+		return []
+
+	# Type of the leader of the first headway and of each new vehicle
+	is_cav = draw_vehicle_types(size + 1, permeability, rng)
+	if last_vehicle is not None:
+		is_cav[0] = isinstance(last_vehicle, CAV)
+		headways = draw_headways(size, flow, distribution, min_headway, samples, rng)
+		position = front - np.cumsum(safe_spacing(headways, speed, is_cav, configs))
+	else:
+		# The first vehicle is placed at the end of the lane
+		headways = draw_headways(size - 1, flow, distribution, min_headway, samples, rng)
+		position = front - np.concatenate([[0], np.cumsum(safe_spacing(headways, speed, is_cav[1:], configs))])
+	is_cav = is_cav[1:]
+	keep = position >= lane.start
+	position = position[keep]
+	is_cav = is_cav[keep]
+
+	vehicles = [CAV(speed, None, pos, 0, **configs['CAV']) if cav else HV(speed, None, pos, 0, **configs['HV'])
+	            for pos, cav in zip(position.tolist(), is_cav.tolist())]
+	fleet.extend(vehicles)
+	return vehicles
+
+
+def fill_lanes(lane_list: List[Lane], configs: dict, flow: float, permeability: float = 0,
+               lane_types: Tuple[str, ...] = ('Main',), max_vehicles: Optional[int] = None,
+               **kwargs) -> List[Vehicle]:
+	"""
+	Fills every lane of the given types with an independent arrival stream.
+
+	:param lane_list: the lanes
+	:param configs: settings of the vehicle types, i.e. ``settings['Vehicle']``
+	:param flow: arrival rate per lane in vehicles per hour
+	:param permeability: penetration rate of CAVs
+	:param lane_types: types of the lanes to fill
+	:param max_vehicles: maximum number of vehicles to add over all lanes, shared evenly between the lanes
+	:param kwargs: further arguments of ``fill_lane``
+	:return: the added vehicles
+	"""
+	lanes = [lane_curr for lane_curr in lane_list if lane_curr.type in lane_types]
+	vehicles = []
+	for i, lane_curr in enumerate(lanes):
+		limit = None
+		if max_vehicles is not None:
+			limit = (max_vehicles - len(vehicles)) // (len(lanes) - i)
+		vehicles.extend(fill_lane(lane_curr, configs, flow, permeability, max_vehicles=limit, **kwargs))
+	return vehicles
+
+
+class ArrivalStream(object):
+	"""
+	Arrival times of one entry, drawn in batches of headways.
+	"""
+
+	def __init__(self, flow: float, distribution: str = 'poisson', min_headway: float = 1.0,
+	             samples: Optional[Sequence[float]] = None, batch_size: int = 1024, rng=np.random):
+		"""
+		:param flow: arrival rate in vehicles per hour
+		:param distribution: headway distribution, see ``draw_headways``
+		:param min_headway: minimum headway of the shifted exponential distribution in seconds
+		:param samples: observed headways in seconds for the empirical distribution
+		:param batch_size: number of headways drawn at once
+		:param rng: random number generator
+		"""
+		self.flow = flow
+		self.distribution = distribution
+		self.min_headway = min_headway
+		self.samples = samples
+		self.batch_size = batch_size
+		self.rng = rng
+		self._times = np.zeros(0)  # Arrival times which have not been taken yet
+		self._last_time = 0.0
+
+	def _draw(self):
+		headways = draw_headways(self.batch_size, self.flow, self.distribution, self.min_headway, self.samples,
+		                         self.rng)
+		times = self._last_time + np.cumsum(headways)
+		self._last_time = float(times[-1])
+		self._times = np.concatenate([self._times, times])
+
+	def take(self, time: float) -> int:
+		"""
+		Removes the arrivals up to the given time.
+
+		:param time: simulation time in seconds
+		:return: the number of arrivals since the last call
+		"""
+		if self.flow <= 0:
+			return 0
+		while self._last_time <= time:
+			self._draw()
+		num = int(np.searchsorted(self._times, time, side='right'))
+		self._times = self._times[num:]
+		return num
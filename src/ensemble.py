@@ -0,0 +1,344 @@
+import random
+import numpy as np
+from vehicle import Vehicle
+from models import VehicleArrays, MOBIL, follow_acceleration
+from fleet import Fleet
+from lane import Lane
+from boundary import OpenBoundary
+from cache import acceleration_cache
+from integration import INTEGRATORS
+from obstacles import advance_obstacles
+from profiler import profiler
+import lane_change
+import simulation
+import sweep
+from typing import Dict, List, Optional, Sequence
+
+
+def concatenate_arrays(arrays_list: Sequence[VehicleArrays]) -> VehicleArrays:
+	"""Concatenates groups of vehicles into one group, field by field."""
+	return VehicleArrays(*(np.concatenate(column) for column in zip(*arrays_list)))
+
+
+class FleetBatch(object):
+	"""
+	The vehicles of several non-empty fleets, e.g. the lanes of all replicas of an ensemble, concatenated along one
+	axis. The fleets are segments of the axis, ``offsets[k]`` is the first entry of the ``k``-th fleet, so the
+	car-following of all fleets is computed with one call of ``follow_acceleration``. Fleets do not interact: the
+	front vehicle of each fleet has no leader.
+	"""
+
+	def __init__(self, fleets: List[Fleet]):
+		"""
+		:param fleets: the fleets, with their states synchronized and their platoons updated
+		"""
+		self.fleets = fleets
+		arrays_list = [fleet.get_arrays() for fleet in fleets]
+		self.offsets = np.concatenate([[0], np.cumsum([len(arrays.position) for arrays in arrays_list])])
+		self.vehicles = concatenate_arrays(arrays_list)
+		num = int(self.offsets[-1])
+
+		# Platoons are controlled by ``Platoon.control``, see ``Fleet.compute_accelerations``
+		self.platoon_slots = [(platoon, slots + offset) for fleet, offset in zip(fleets, self.offsets[:-1].tolist())
+		                      for platoon, slots in fleet.get_platoon_slots()]
+		is_follower = np.zeros(num, dtype=bool)
+		for _, slots in self.platoon_slots:
+			is_follower[slots[1:]] = True
+		leader = np.arange(-1, num - 1)
+		leader[self.offsets[:-1]] = -1
+		self.index = np.flatnonzero(~is_follower)
+		self.leader_index = leader[self.index]
+
+	def compute_accelerations(self, vehicles: Optional[VehicleArrays] = None) -> np.ndarray:
+		"""
+		Calculates the accelerations of all vehicles of the batch like ``Fleet.compute_accelerations`` of each fleet.
+
+		:param vehicles: the vehicles of the batch at intermediate states, ``self.vehicles`` if None
+		:return: the accelerations of the vehicles
+		"""
+		if vehicles is None:
+			vehicles = self.vehicles
+		acc = np.empty(len(vehicles.position))
+		acc[self.index] = follow_acceleration(vehicles.take(self.index), vehicles.take(self.leader_index))
+		for platoon, slots in self.platoon_slots:
+			acc[slots[1:]] = platoon.control(acc[slots[0]], vehicles.take(slots))
+		return acc
+
+	def split(self, values: np.ndarray) -> List[np.ndarray]:
+		"""Splits an array over the batch into the arrays of the fleets."""
+		return [values[start:stop] for start, stop in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())]
+
+
+def get_accelerations(fleets: List[Fleet]) -> List[np.ndarray]:
+	"""
+	Returns ``Fleet.get_accelerations`` of each fleet. Accelerations which are not cached are calculated for all
+	fleets together in one ``FleetBatch``.
+
+	:param fleets: the fleets
+	:return: the accelerations of the vehicles of each fleet, shared and read-only
+	"""
+	acc_list = []
+	missing = []
+	for k, fleet in enumerate(fleets):
+		num = fleet.sync_state()
+		profiler.count('get_acceleration', num)
+		acc = acceleration_cache.get(fleet, fleet.get_cache_key(), num)
+		acc_list.append(acc)
+		if acc is None and num:
+			missing.append(k)
+		elif acc is None:
+			acc_list[k] = np.zeros(0)
+	if missing:
+		batch = FleetBatch([fleets[k] for k in missing])
+		for k, acc in zip(missing, batch.split(batch.compute_accelerations())):
+			acc.flags.writeable = False
+			acceleration_cache.put(fleets[k], fleets[k].get_cache_key(), acc)
+			acc_list[k] = acc
+	return acc_list
+
+
+class Replica(object):
+	"""
+	One stochastic replica of an ensemble: its lanes, open boundaries and cross-section, and the states of the random
+	number generators it draws from. The generators are global, so their states are swapped in whenever the replica
+	draws random numbers.
+	"""
+
+	def __init__(self, lane_list: List[Lane], boundary: Optional[OpenBoundary] = None,
+	             measure_position: Optional[float] = None):
+		"""
+		:param lane_list: list of lanes with their initial vehicles
+		:param boundary: open boundaries of the replica, None for a closed road
+		:param measure_position: position of the cross-section, the middle of the first lane if None
+		"""
+		self.lane_list = lane_list
+		self.boundary = boundary
+		if measure_position is None:
+			measure_position = lane_list[0].start + lane_list[0].length / 2
+		self.cross_section = simulation.CrossSection(lane_list, measure_position)
+		self.save_rngs()
+
+	def save_rngs(self):
+		"""Takes over the current states of the global random number generators."""
+		self.rng_states = (np.random.get_state(), random.getstate())
+
+	def restore_rngs(self):
+		"""Sets the global random number generators to the states of the replica."""
+		np.random.set_state(self.rng_states[0])
+		random.setstate(self.rng_states[1])
+
+	def get_metrics(self, num_epochs: int, dt: float) -> dict:
+		"""Summary metrics of the run, see ``simulation.run_simulation``."""
+		return {
+			'throughput': self.cross_section.num_passed / (num_epochs * dt) * 3600,
+			'mean_speed': self.cross_section.mean_speed,
+			'lane_changes': sum(lane_curr.fleet.num_lane_changes for lane_curr in self.lane_list),
+			'num_vehicles': sum(len(lane_curr.fleet) for lane_curr in self.lane_list),
+		}
+
+
+class Ensemble(object):
+	"""
+	Replicas of the same scenario advanced together. Each phase of ``simulation.step`` is performed for the lanes of
+	all replicas at once: the MOBIL model evaluates the vehicles of all lanes with one call per side, the lane changes
+	are resolved in one ``lane_change.change_lanes`` and the car-following and the integration of all lanes with the
+	same integrator are one ``FleetBatch``. Arrivals and the random numbers stay with each replica, so every replica
+	gives the same results as a run of its own with ``simulation.run_simulation``.
+	"""
+
+	def __init__(self, replicas: List[Replica]):
+		self.replicas = replicas
+		self.lane_list = [lane_curr for replica in replicas for lane_curr in replica.lane_list]
+		self.mobil = MOBIL()
+
+	def change_lanes(self) -> List[Vehicle]:
+		"""
+		Lane-changing phases of an epoch for all replicas, see ``simulation.change_lanes``.
+
+		:return: the vehicles which have changed lanes
+		"""
+		start = profiler.tic()
+		adjacent_list = [tuple(None if target_lane is None else lane_curr.fleet.get_adjacent_index(target_lane)
+		                       for target_lane in (lane_curr.left_lane, lane_curr.right_lane))
+		                 for lane_curr in self.lane_list]
+		profiler.toc('neighbor_search', start)
+
+		start = profiler.tic()
+		fleets = []
+		for lane_curr, adjacent in zip(self.lane_list, adjacent_list):
+			fleet = lane_curr.fleet
+			fleet.lc_rows = 0
+			if any(index is not None for index in adjacent) and fleet.sync_state():
+				fleets.append((fleet, adjacent))
+		if fleets:
+			self._set_lane_change_intentions(fleets)
+		profiler.toc('intention', start)
+
+		start = profiler.tic()
+		moved = lane_change.change_lanes([lane_curr.fleet for lane_curr in self.lane_list])
+		profiler.toc('change_lane', start)
+		return moved
+
+	def _set_lane_change_intentions(self, fleets: list):
+		"""
+		Evaluates the MOBIL model for the vehicles of the given fleets like ``Fleet.get_lane_change_intention``. The
+		fleets and their adjacent fleets are concatenated into one group of vehicles, so the vehicles and each of
+		their neighbors are gathered with one index array and each side is checked with one call.
+
+		:param fleets: the fleets with vehicles and adjacent lanes, with the indices of the front and rear vehicles
+		               in the left and right lane (see ``Fleet.get_adjacent_index``)
+		"""
+		involved = {id(fleet): fleet for fleet, _ in fleets}
+		for fleet, _ in fleets:
+			for target_lane in (fleet.lane.left_lane, fleet.lane.right_lane):
+				if target_lane is not None:
+					involved.setdefault(id(target_lane.fleet), target_lane.fleet)
+		involved = list(involved.values())
+		acc_list = get_accelerations(involved)
+		offset_of = {}
+		offset = 0
+		for fleet, acc in zip(involved, acc_list):
+			offset_of[id(fleet)] = offset
+			offset += len(acc)
+		vehicles = concatenate_arrays([fleet.get_arrays(acc) for fleet, acc in zip(involved, acc_list)])
+
+		# Index of each vehicle, of its front and rear vehicle and of its neighbors in the adjacent lanes, -1 for none
+		ego, leader, follower = [], [], []
+		target = {'left': ([], [], []), 'right': ([], [], [])}
+		num_rows = 0
+		for fleet, adjacent in fleets:
+			offset = offset_of[id(fleet)]
+			num = len(fleet.vehicles)
+			index = np.arange(offset, offset + num)
+			ego.append(index)
+			leader.append(np.where(index > offset, index - 1, -1))
+			follower.append(np.where(index < offset + num - 1, index + 1, -1))
+			for (front_index, rear_index), target_lane, (rows, fronts, rears) in \
+					((index_pair, lane_curr, target[side]) for index_pair, lane_curr, side in
+					 zip(adjacent, (fleet.lane.left_lane, fleet.lane.right_lane), ('left', 'right'))
+					 if index_pair is not None):
+				target_offset = offset_of[id(target_lane.fleet)]
+				rows.append(np.arange(num_rows, num_rows + num))
+				fronts.append(np.where(front_index >= 0, front_index + target_offset, -1))
+				rears.append(np.where(rear_index >= 0, rear_index + target_offset, -1))
+			num_rows += num
+		ego, leader, follower = (np.concatenate(index) for index in (ego, leader, follower))
+
+		safe = {}
+		incentive = {}
+		for side, (rows, fronts, rears) in target.items():
+			safe[side] = np.zeros(num_rows, dtype=bool)
+			incentive[side] = np.zeros(num_rows)
+			if not rows:
+				continue
+			rows = np.concatenate(rows)
+			# One call for the vehicles of all lanes with a lane on this side
+			safe[side][rows], incentive[side][rows] = self.mobil.check_lane_changing_batch(
+				vehicles.take(ego[rows]), vehicles.take(leader[rows]), vehicles.take(follower[rows]),
+				vehicles.take(np.concatenate(fronts)), vehicles.take(np.concatenate(rears)))
+		direction = self.mobil.choose_direction(safe['left'], incentive['left'], safe['right'],
+		                                        incentive['right']).direction
+
+		num_rows = 0
+		for fleet, (left_index, right_index) in fleets:
+			num = len(fleet.vehicles)
+			fleet.set_lane_change_intention(direction[num_rows:num_rows + num],
+			                                None if left_index is None else left_index[0],
+			                                None if right_index is None else right_index[0])
+			num_rows += num
+
+	def update_vehicles(self, dt: float):
+		"""
+		Advances the vehicles of all replicas by one time step like ``Fleet.update_vehicles`` of each lane, with one
+		integration step per integrator.
+
+		:param dt: time step
+		"""
+		fleets = [lane_curr.fleet for lane_curr in self.lane_list if lane_curr.fleet.vehicles]
+		for fleet in fleets:
+			fleet.update_platoons()
+		acc_list = get_accelerations(fleets)
+
+		groups: Dict[str, List[int]] = {}
+		for k, fleet in enumerate(fleets):
+			groups.setdefault(fleet.integrator, []).append(k)
+		for integrator, members in groups.items():
+			batch = FleetBatch([fleets[k] for k in members])
+			vehicles = batch.vehicles
+			max_speed = np.repeat([fleets[k].lane.max_speed for k in members], np.diff(batch.offsets))
+
+			def get_acc(position: np.ndarray, speed: np.ndarray) -> np.ndarray:
+				return batch.compute_accelerations(vehicles._replace(position=position, speed=speed))
+
+			acc = np.concatenate([acc_list[k] for k in members])
+			position, speed = INTEGRATORS[integrator](get_acc, vehicles.position, vehicles.speed, acc, dt, max_speed)
+			for k, fleet_position, fleet_speed in zip(members, batch.split(position), batch.split(speed)):
+				fleet = fleets[k]
+				num = len(fleet_position)
+				state = fleet.state
+				state.position[:num] = fleet_position
+				state.speed[:num] = fleet_speed
+				state.acc[:num] = acc_list[k]
+				state.touch()
+				if Vehicle.record_states:
+					for vehicle in fleet.vehicles:
+						vehicle._restore_states()
+
+	def step(self, dt: float):
+		"""
+		Advances all replicas by one epoch, see ``simulation.step``.
+
+		:param dt: time step
+		"""
+		self.change_lanes()
+		start = profiler.tic()
+		self.update_vehicles(dt)
+		profiler.toc('update', start)
+		advance_obstacles(self.lane_list, dt)
+		simulation.count_epoch(self.lane_list)
+
+	def run(self, num_epochs: int, dt: float) -> List[dict]:
+		"""
+		Runs all replicas, see ``simulation.run_simulation``.
+
+		:param num_epochs: number of epochs
+		:param dt: time step
+		:return: the summary metrics of each replica
+		"""
+		for epoch in range(num_epochs):
+			self.step(dt)
+			for replica in self.replicas:
+				if replica.boundary is not None:
+					start = profiler.tic()
+					replica.restore_rngs()
+					replica.boundary.update(epoch, dt)
+					replica.save_rngs()
+					profiler.toc('boundary', start)
+				replica.cross_section.update(replica.lane_list)
+		return [replica.get_metrics(num_epochs, dt) for replica in self.replicas]
+
+
+def build_ensemble(settings: dict, seeds: Sequence[int], base_seed: int = 0, inflow: float = 0,
+                   measure_position: Optional[float] = None, **scenario_params) -> Ensemble:
+	"""
+	Builds one replica of a scenario per seed. The random numbers of each replica are seeded like a run of a sweep,
+	see ``sweep.seed_rngs``.
+
+	:param settings: the settings loaded from 'settings.json'
+	:param seeds: the seed of each replica
+	:param base_seed: seed of the ensemble
+	:param inflow: arrival rate per lane of open boundaries in vehicles per hour, 0 for a closed road
+	:param measure_position: position of the cross-section where the throughput is counted
+	:param scenario_params: further arguments of ``simulation.build_scenario``
+	:return: the ensemble
+	"""
+	replicas = []
+	for seed in seeds:
+		sweep.seed_rngs(base_seed, seed)
+		lane_list = simulation.build_scenario(settings, **scenario_params)
+		boundary = None
+		if inflow:
+			boundary = OpenBoundary(lane_list, settings['Vehicle'], inflow,
+			                        scenario_params.get('permeability', 0))
+		replicas.append(Replica(lane_list, boundary, measure_position))
+	return Ensemble(replicas)
@@ -0,0 +1,186 @@
+import numpy as np
+from vehicle import *
+from lane import Lane
+from parameters import VehicleParameters
+from demand import draw_vehicle_types
+from typing import Dict, List, Optional
+
+VEHICLE_CLASSES = ('HV', 'CAV')
+
+
+def class_parameters(configs: dict) -> Dict[str, VehicleParameters]:
+	"""
+	Returns the parameters of each vehicle class.
+
+	:param configs: settings of the vehicle types, i.e. ``settings['Vehicle']``
+	:return: parameters by class name
+	"""
+	return {name: VehicleParameters.from_settings(**configs[name]) for name in VEHICLE_CLASSES}
+
+
+def mean_spacing(speed: float, params: Dict[str, VehicleParameters], permeability: float = 0,
+                 lane_type: str = 'Main') -> float:
+	"""
+	Mean distance between the fronts of consecutive vehicles in equilibrium at the given speed.
+
+	:param speed: the common speed of all vehicles
+	:param params: parameters of each vehicle class
+	:param permeability: fraction of CAVs
+	:param lane_type: type of the lane, selects the desired speed
+	:return: the mean spacing in meters
+	"""
+	spacing = 0.0
+	for name, fraction in (('HV', 1 - permeability), ('CAV', permeability)):
+		if fraction == 0:
+			continue
+		p = params[name]
+		desired_speed = p.desired_speed_main if lane_type == 'Main' else p.desired_speed_ramp
+		spacing += fraction * (p.length + idm_equilibrium_gap(speed, desired_speed, p.reaction_time, p.jam_distance))
+	return float(spacing)
+
+
+def _max_equilibrium_speed(params: Dict[str, VehicleParameters], permeability: float, lane_type: str,
+                           max_speed: float) -> float:
+	"""Highest speed at which all classes present have a finite equilibrium gap."""
+	names = [name for name, fraction in (('HV', 1 - permeability), ('CAV', permeability)) if fraction > 0]
+	desired_speed = min(params[name].desired_speed_main if lane_type == 'Main' else params[name].desired_speed_ramp
+	                    for name in names)
+	return min(desired_speed * (1 - 1e-6), max_speed)
+
+
+def _bisect(function, low: float, high: float, num_iterations: int = 100) -> float:
+	"""Finds the root of a function which is increasing on [low, high]."""
+	for _ in range(num_iterations):
+		middle = (low + high) / 2
+		if function(middle) < 0:
+			low = middle
+		else:
+			high = middle
+	return (low + high) / 2
+
+
+def equilibrium_speed(configs: dict, density: Optional[float] = None, flow: Optional[float] = None,
+                      permeability: float = 0, lane_type: str = 'Main', max_speed: float = np.inf,
+                      branch: str = 'free') -> float:
+	"""
+	Solves for the speed of the homogeneous IDM equilibrium with the given density or flow per lane.
+
+	At a density below the equilibrium density of ``max_speed`` the vehicles drive at ``max_speed`` with larger gaps.
+	A flow has two solutions below the capacity, one on the free and one on the congested branch of the fundamental
+	diagram.
+
+	:param configs: settings of the vehicle types, i.e. ``settings['Vehicle']``
+	:param density: density in vehicles per kilometer
+	:param flow: flow in vehicles per hour, used if ``density`` is None
+	:param permeability: fraction of CAVs
+	:param lane_type: type of the lane, selects the desired speed
+	:param max_speed: speed limit of the lane
+	:param branch: 'free' or 'congested', the branch of the solution for a flow
+	:return: the equilibrium speed in meters per second
+	"""
+	params = class_parameters(configs)
+	speed_limit = _max_equilibrium_speed(params, permeability, lane_type, max_speed)
+
+	def spacing(speed):
+		return mean_spacing(speed, params, permeability, lane_type)
+
+	if density is not None:
+		target_spacing = 1000 / density
+		if target_spacing < spacing(0):
+			raise ValueError('Density {} veh/km is above the jam density {:.1f} veh/km'.format(
+				density, 1000 / spacing(0)))
+		if target_spacing >= spacing(speed_limit):
+			return speed_limit
+		return _bisect(lambda speed: spacing(speed) - target_spacing, 0, speed_limit)
+
+	if flow is None:
+		raise ValueError('Either a density or a flow is needed')
+
+	def get_flow(speed):
+		return 3600 * speed / spacing(speed)
+
+	# The flow increases up to the capacity and decreases afterwards
+	speeds = np.linspace(0, speed_limit, 2001)
+	speed_capacity = float(speeds[np.argmax([get_flow(speed) for speed in speeds])])
+	if flow > get_flow(speed_capacity):
+		raise ValueError('Flow {} veh/h is above the capacity {:.0f} veh/h'.format(flow, get_flow(speed_capacity)))
+	if branch == 'free':
+		if flow <= get_flow(speed_limit):
+			return speed_limit  # The flow is reached at the speed limit with larger gaps
+		return _bisect(lambda speed: flow - get_flow(speed), speed_capacity, speed_limit)
+	elif branch == 'congested':
+		return _bisect(lambda speed: get_flow(speed) - flow, 0, speed_capacity)
+	raise ValueError('Unknown branch {}'.format(branch))
+
+
+def initialize_equilibrium(lane_list: List[Lane], configs: dict, density: Optional[float] = None,
+                           flow: Optional[float] = None, permeability: float = 0, branch: str = 'free',
+                           gap_noise: float = 0, speed_noise: float = 0, rng=np.random) -> dict:
+	"""
+	Fills every main lane and ramp from its end to its start with vehicles in the IDM equilibrium of the given density
+	or flow, so that measurements can start without a warm-up. Each vehicle keeps the equilibrium gap of its own class
+	at the common speed of its lane type; ramps use the desired speeds on ramps. Lanes of the same type are shifted
+	against each other by a fraction of the spacing.
+
+	:param lane_list: the lanes, their main lanes and ramps must be empty
+	:param configs: settings of the vehicle types, i.e. ``settings['Vehicle']``
+	:param density: density per lane in vehicles per kilometer
+	:param flow: flow per lane in vehicles per hour, used if ``density`` is None
+	:param permeability: fraction of CAVs
+	:param branch: branch of the fundamental diagram for a flow, 'free' or 'congested'
+	:param gap_noise: standard deviation of a normal perturbation of each gap in meters, gaps stay above the jam
+	                  distance
+	:param speed_noise: standard deviation of a normal perturbation of each speed in meters per second
+	:param rng: random number generator
+	:return: equilibrium speed, density and flow of the main lanes (of the ramps if there are no main lanes), the same
+	         for each lane type under 'lane_types', and the number of added vehicles
+	"""
+	for lane_curr in lane_list:
+		if lane_curr.type in ('Main', 'Ramp') and len(lane_curr.fleet):
+			raise ValueError('{} lane at {} already has {} vehicles'.format(lane_curr.type, lane_curr.start,
+			                                                               len(lane_curr.fleet)))
+	params = class_parameters(configs)
+	length = np.array([params[name].length for name in VEHICLE_CLASSES])
+	jam_distance = np.array([params[name].jam_distance for name in VEHICLE_CLASSES])
+	lane_types = {}
+	num_vehicles = 0
+	for lane_type in ('Main', 'Ramp'):
+		lanes = [lane_curr for lane_curr in lane_list if lane_curr.type == lane_type]
+		if not lanes:
+			continue
+		max_speed = min(lane_curr.max_speed for lane_curr in lanes)
+		speed = equilibrium_speed(configs, density, flow, permeability, lane_type, max_speed, branch)
+		spacing = mean_spacing(speed, params, permeability, lane_type)
+		# Gaps are widened evenly if the vehicles drive at the speed limit below the equilibrium density
+		extra_gap = 0.0
+		if density is not None:
+			extra_gap = max(0.0, 1000 / density - spacing)
+		elif speed >= max_speed and flow is not None:
+			extra_gap = max(0.0, 3600 * speed / flow - spacing)
+		spacing += extra_gap
+
+		gap = np.array([idm_equilibrium_gap(speed, params[name].desired_speed_main if lane_type == 'Main' else
+		                                    params[name].desired_speed_ramp, params[name].reaction_time,
+		                                    params[name].jam_distance) + extra_gap for name in VEHICLE_CLASSES])
+		for j, lane_curr in enumerate(lanes):
+			size = int((lane_curr.end - lane_curr.start) / (length.min() + jam_distance.min())) + 1
+			kind = draw_vehicle_types(size, permeability, rng).astype(np.intp)  # Index in VEHICLE_CLASSES
+			lane_gap = gap[kind[1:]]
+			if gap_noise > 0:
+				lane_gap = np.maximum(lane_gap + rng.normal(0, gap_noise, size - 1), jam_distance[kind[1:]])
+			offset = j * spacing / len(lanes)
+			position = lane_curr.end - offset - np.concatenate([[0], np.cumsum(length[kind[:-1]] + lane_gap)])
+			lane_speed = np.full(size, speed)
+			if speed_noise > 0:
+				lane_speed = np.clip(lane_speed + rng.normal(0, speed_noise, size), 0, lane_curr.max_speed)
+			keep = position >= lane_curr.start
+			vehicles = [CAV(v, None, x, 0, **configs['CAV']) if k else HV(v, None, x, 0, **configs['HV'])
+			            for x, v, k in zip(position[keep].tolist(), lane_speed[keep].tolist(), kind[keep].tolist())]
+			lane_curr.fleet.extend(vehicles)
+			num_vehicles += len(vehicles)
+		lane_types[lane_type] = {'speed': speed, 'density': 1000 / spacing, 'flow': 3600 * speed / spacing}
+
+	result = dict(lane_types.get('Main', lane_types.get('Ramp', {})))
+	result['lane_types'] = lane_types
+	result['num_vehicles'] = num_vehicles
+	return result
@@ -1,235 +1,442 @@
 from vehicle import *
 from models import *
 from platoon import *
+from state import FleetState, DETACHED
+from structure import VehicleList
+from cache import acceleration_cache
+from profiler import profiler
+from integration import INTEGRATORS
+import lane_change
+from typing import Tuple
 
 
-class Fleet(object):
+class Fleet(VehicleList):
 	def __init__(self, lane=None):
 		"""
 		Initializes a fleet of vehicles.
+
+		The vehicles form a doubly linked list ordered from front to rear. Besides the list, the car-following
+		links ``front_vehicle`` and ``rear_vehicle`` of the vehicles are kept consistent with the order of the fleet.
 		"""
-		self.front_vehicle = None  # Placeholder for the front vehicle
+		super().__init__()
 		self.lane = lane  # Placeholder for the lane the fleet is in
-		self.rear_vehicle = None  # Placeholder for the rear vehicle
-		self.vehicles = []  # List to store the vehicles in the fleet
-		self.lc_vehicle_list = []  # List to store the vehicles that want to change lanes
-		self.lc_front_vehicle_list = []  # List to store the front vehicles of the vehicles that want to change lanes
-		self.lc_direction_list = []  # List to store the direction of the lane change for each vehicle
+		# Lane changes chosen in the current epoch, one row per vehicle in the order of the fleet when they were chosen
+		self.lc_direction = np.zeros(64, dtype=np.int8)  # Direction of each vehicle, see ``LaneChangeDecision``
+		self.lc_front = np.full(64, -1, dtype=np.intp)  # Index of the front vehicle in the target lane, -1 if none
+		self.lc_rows = 0  # Number of valid rows, 0 if no lane changes are pending
 		self.platoons = []  # List to store the platoons in the fleet
+		self.platoon_size = None  # Maximum size of the platoons formed in the fleet, None to disable formation
+		self._platoon_candidates = {}  # Vehicles whose front or rear vehicle has changed by id, see update_platoons
+		self.integrator = 'ballistic'  # Name of the integration scheme of the vehicle updates, see ``INTEGRATORS``
+		self.num_lane_changes = 0  # Number of lane changes performed by vehicles of the fleet
+		self.state = FleetState()  # Struct-of-arrays states of the vehicles, ordered from front to rear
+		self._acc_cache = None  # Memoized accelerations of the vehicles, see ``AccelerationCache``
+
+	@property
+	def front_vehicle(self) -> Optional[Vehicle]:
+		"""The front vehicle of the fleet."""
+		return self.head
+
+	@property
+	def rear_vehicle(self) -> Optional[Vehicle]:
+		"""The rear vehicle of the fleet."""
+		return self.tail
 
 	def add_vehicle(self, vehicle: Vehicle, front_vehicle: Optional[Vehicle] = None):
 		"""
-		Adds a vehicle to the fleet if there is space.
+		Adds a vehicle to the fleet.
 
-		If target_front_vehicle is None, adds the vehicle as the front vehicle in the fleet.
+		If front_vehicle is None, adds the vehicle as the front vehicle in the fleet.
 
 		:param front_vehicle: The vehicle to add the new vehicle behind.
 		:param vehicle: The vehicle to add.
 		:return:
 		"""
-		if len(self.vehicles) == 0:  # Fleet is empty
-			self.vehicles.append(vehicle)
-			self.front_vehicle = vehicle
-			self.rear_vehicle = vehicle
-			vehicle.lane = self.lane
-			return
-
-		target_front_vehicle = front_vehicle
+		self.insert_after(vehicle, front_vehicle)
+		self.state.attach(vehicle)  # Move the states of the vehicle into the storage of the fleet
+		self.lc_rows = 0  # The pending lane changes refer to the previous order of the fleet
 		vehicle.lane = self.lane  # Update the lane of the vehicle.
-		if target_front_vehicle is None:  # No target front vehicle
-			# Add the vehicle as the front vehicle of the fleet
-			self.vehicles.insert(0, vehicle)
-
-			self.front_vehicle.front_vehicle = vehicle  # Placeholder for setting the front vehicle property
-			vehicle.last_vehicle = self.front_vehicle  # Placeholder for setting the last vehicle property
-			self.front_vehicle = vehicle  # Update the front vehicle
-		else:  # Add the vehicle behind the target front vehicle
-			# Insert the new vehicle behind the target front vehicle
-			index = self.vehicles.index(target_front_vehicle)
-			self.vehicles.insert(index + 1, vehicle)
-
-			target_rear_vehicle = target_front_vehicle.rear_vehicle  # Placeholder for the target front vehicle's rear vehicle
-			target_front_vehicle.rear_vehicle = vehicle  # Update the rear vehicle of the target front vehicle
-			vehicle.front_vehicle = target_front_vehicle  # Update the front vehicle of the added vehicle
-			if target_rear_vehicle is None:
-				# If the target front vehicle has no rear vehicle, set the new vehicle as the rear vehicle
-				self.rear_vehicle = vehicle
-			else:
-				# If the target front vehicle has a rear vehicle, insert the new vehicle between them
-				target_rear_vehicle.front_vehicle = vehicle
-				vehicle.rear_vehicle = target_rear_vehicle  # Update the rear vehicle of the added vehicle
+
+		# Insert the vehicle between its front and rear vehicle
+		vehicle.front_vehicle = front_vehicle
+		vehicle.rear_vehicle = self.rear_of(vehicle)
+		if front_vehicle is not None:
+			front_vehicle.rear_vehicle = vehicle
+		if vehicle.rear_vehicle is not None:
+			vehicle.rear_vehicle.front_vehicle = vehicle
+
+		rear_vehicle = vehicle.rear_vehicle
+		if front_vehicle is not None and rear_vehicle is not None and front_vehicle.platoon is not None and \
+				front_vehicle.platoon is rear_vehicle.platoon:
+			# The vehicle has cut into a platoon
+			platoon = rear_vehicle.platoon
+			self.__add_platoon(platoon.split(rear_vehicle))
+			self.__discard_platoon(platoon)
+		if self.platoon_size is not None:
+			self._platoon_candidates[vehicle.id] = vehicle
+
+	def extend(self, vehicles: List[Vehicle]):
+		"""
+		Adds vehicles behind the rear vehicle of the fleet.
+
+		:param vehicles: The vehicles to add, ordered from front to rear.
+		"""
+		front_vehicle = self.rear_vehicle
+		self.lc_rows = 0
+		for vehicle in vehicles:
+			self.insert_after(vehicle, front_vehicle)
+			self.state.attach(vehicle)
+			vehicle.lane = self.lane
+			vehicle.front_vehicle = front_vehicle
+			if front_vehicle is not None:
+				front_vehicle.rear_vehicle = vehicle
+			front_vehicle = vehicle
+			if self.platoon_size is not None:
+				self._platoon_candidates[vehicle.id] = vehicle
+		if front_vehicle is not None:
+			front_vehicle.rear_vehicle = None
 
 	def remove_vehicle(self, vehicle: Vehicle):
 		"""
-		Removes the given vehicle from the fleet.
+		Removes the given vehicle from the fleet. A vehicle in a platoon leaves the platoon.
 
 		:param vehicle: The vehicle to remove.
 		"""
-		self.vehicles.remove(vehicle)  # Remove the vehicle from the fleet
-
-		if self.front_vehicle == vehicle:  # Vehicle to remove is the front vehicle
-			if vehicle.rear_vehicle is not None:
-				self.front_vehicle = vehicle.rear_vehicle  # Update the front vehicle
-				return  # No more vehicles in the fleet, return
-			else:
-				self.front_vehicle = None  # No more vehicles in the fleet, update the front vehicle
-				self.rear_vehicle = None
-				return  # No more vehicles in the fleet, return
-
-		elif self.rear_vehicle == vehicle:  # Vehicle to remove is the rear vehicle
-			if vehicle.front_vehicle is not None:
-				self.rear_vehicle = vehicle.front_vehicle  # Update the rear vehicle
-				return  # No more vehicles in the fleet, return
-			else:
-				self.front_vehicle = None
-				self.rear_vehicle = None
-				return  # No more vehicles in the fleet, return
-		else:  # Vehicle to remove is in the middle of the fleet
-			if vehicle.front_vehicle is not None:
-				# Update the front vehicle of the vehicle behind the vehicle to remove
-				vehicle.front_vehicle.rear_vehicle = vehicle.rear_vehicle
-
-			if vehicle.rear_vehicle is not None:
-				# Update the rear vehicle of the vehicle in front of the vehicle to remove
-				vehicle.rear_vehicle.front_vehicle = vehicle.front_vehicle
-
-	def change_lane(self):
-		"""
-		Changes the lane of the vehicles in the fleet.
-		:return:
+		platoon = vehicle.platoon
+		if platoon is not None:
+			self.__add_platoon(platoon.remove_vehicle(vehicle))
+			self.__discard_platoon(platoon)
+		self._platoon_candidates.pop(vehicle.id, None)
+
+		front_vehicle = self.front_of(vehicle)
+		rear_vehicle = self.rear_of(vehicle)
+		self.remove(vehicle)  # Remove the vehicle from the fleet
+		DETACHED.attach(vehicle)  # Move the states of the vehicle out of the storage of the fleet
+		self.lc_rows = 0  # The pending lane changes refer to the previous order of the fleet
+
+		# Link the front and rear vehicle of the removed vehicle
+		if front_vehicle is not None:
+			front_vehicle.rear_vehicle = rear_vehicle
+		if rear_vehicle is not None:
+			rear_vehicle.front_vehicle = front_vehicle
+			if self.platoon_size is not None:
+				self._platoon_candidates[rear_vehicle.id] = rear_vehicle
+		vehicle.front_vehicle = None
+		vehicle.rear_vehicle = None
+
+	def retire_vehicles(self, end: float) -> List[Vehicle]:
+		"""
+		Removes the vehicles which have passed the given position, e.g. the end of the lane. The vehicles leave their
+		platoons, see ``remove_vehicle``.
+
+		:param end: position after which vehicles leave the fleet
+		:return: The removed vehicles ordered from front to rear.
+		"""
+		num = self.sync_state()
+		# Usually the vehicles to remove are at the front, but vehicles which have collided may be out of order
+		retired_index = np.flatnonzero(self.state.position[:num] > end)
+		if len(retired_index) == 0:
+			return []
+		vehicles = self.vehicles
+		retired = [vehicles[i] for i in retired_index.tolist()]
+		for vehicle in retired:
+			self.remove_vehicle(vehicle)
+		return retired
+
+	def change_lane(self) -> List[Vehicle]:
+		"""
+		Changes the lane of the vehicles in the fleet which intend to, see ``lane_change.change_lanes``. Lane changes
+		of all lanes are performed together by ``simulation.change_lanes``.
+
+		:return: The vehicles which have changed lanes.
+		"""
+		return lane_change.change_lanes([self])
+
+	def sync_state(self) -> int:
+		"""
+		Orders the state storage of the fleet from the front vehicle to the rear vehicle if vehicles have been
+		added or removed since the last call.
+
+		:return: The number of vehicles in the fleet.
 		"""
-		for i, vehicle in enumerate(self.lc_vehicle_list):
-			if self.lc_direction_list[i] == 'left':
-				front_vehicle = self.lc_front_vehicle_list[i]
-				vehicle.move_to_lane(front_vehicle, self.lane.left_lane)
-			elif self.lc_direction_list[i] == 'right':
-				front_vehicle = self.lc_front_vehicle_list[i]
-				vehicle.move_to_lane(front_vehicle, self.lane.right_lane)
+		if not self.state.ordered:
+			self.state.compact(self.vehicles)
+		return len(self.vehicles)
+
+	def get_arrays(self, acc: Optional[np.ndarray] = None) -> VehicleArrays:
+		"""
+		Returns the states and parameters of the vehicles as arrays ordered from front to rear. The arrays are views
+		on the state storage of the fleet.
+
+		:param acc: The current accelerations of the vehicles, defaults to the accelerations of the last update.
+		:return: The vehicles of the fleet as arrays.
+		"""
+		num = self.sync_state()
+		state = self.state
+		if self.lane.type == 'Main':
+			desired_speed = state.desired_speed_main[:num]
+		else:
+			desired_speed = state.desired_speed_ramp[:num]
+		if self.lane.type in ('Main', 'Ramp'):
+			obstacle_position = state.obstacle_position[:num]
+			if len(self.lane.obstacles):
+				# The nearest of the obstacle of each vehicle and the next active obstacle of the lane
+				obstacle_position = np.minimum(obstacle_position, self.lane.obstacles.get_next(state.position[:num]))
+		else:
+			# Obstacles are only considered on main lanes and ramps
+			obstacle_position = np.full(num, np.inf)
+		return VehicleArrays(state.position[:num], state.speed[:num], state.acc[:num] if acc is None else acc,
+		                     state.length[:num], desired_speed, state.reaction_time[:num], state.max_acc[:num],
+		                     state.desired_dec[:num], state.jam_distance[:num], obstacle_position,
+		                     np.ones(num, dtype=bool))
+
+	def get_accelerations(self) -> np.ndarray:
+		"""
+		Calculates the accelerations of all vehicles in the fleet with array operations, each vehicle is calculated
+		once. Vehicles follow ``HV.get_acceleration``, except for the members behind the lead vehicle of a platoon,
+		which are controlled by ``Platoon.control``.
+
+		:return: The accelerations of the vehicles ordered from front to rear, shared and read-only.
+		"""
+		num = self.sync_state()
+		profiler.count('get_acceleration', num)
+		key = self.get_cache_key()
+		acc = acceleration_cache.get(self, key, num)
+		if acc is None:
+			acc = self.compute_accelerations(self.get_arrays())
+			acc.flags.writeable = False
+			acceleration_cache.put(self, key, acc)
+		return acc
+
+	def get_cache_key(self) -> tuple:
+		"""The versions of the states and of the obstacles the accelerations of the fleet depend on."""
+		return self.state.version, self.lane.obstacles.version
+
+	def compute_accelerations(self, vehicles: VehicleArrays, selected: Optional[np.ndarray] = None) -> np.ndarray:
+		"""
+		Calculates the accelerations of ``get_accelerations`` without the cache, e.g. for intermediate states within
+		a step.
+
+		:param vehicles: The vehicles of the fleet as arrays, see ``get_arrays``.
+		:param selected: Mask of the vehicles to calculate, all vehicles if None. Platoons must be selected as a whole.
+		:return: The accelerations of the vehicles ordered from front to rear, undefined for unselected vehicles.
+		"""
+		num = len(vehicles.position)
+		platoon_slots = self.get_platoon_slots()
+		if not platoon_slots and selected is None:
+			# The leader of each vehicle is the vehicle in the previous slot, the front vehicle has no leader
+			leaders = vehicles.take(np.arange(-1, num - 1))
+			return follow_acceleration(vehicles, leaders)
+
+		is_follower = np.zeros(num, dtype=bool)
+		for _, slots in platoon_slots:
+			is_follower[slots[1:]] = True
+		index = np.flatnonzero(~is_follower if selected is None else selected & ~is_follower)
+		acc = np.empty(num)
+		acc[index] = follow_acceleration(vehicles.take(index), vehicles.take(index - 1))
+		for platoon, slots in platoon_slots:
+			if selected is None or selected[slots[0]]:
+				acc[slots[1:]] = platoon.control(acc[slots[0]], vehicles.take(slots))
+		return acc
+
+	def get_platoon_slots(self) -> List[Tuple[Platoon, np.ndarray]]:
+		"""
+		Returns the platoons of the fleet with the slots of their members. Platoons whose members are not
+		consecutive vehicles of this lane cannot be controlled as a string and are left to the car-following model.
+
+		:return: The platoons and the slots of their members ordered from front to rear.
+		"""
+		platoon_slots = []
+		for platoon in self.platoons:
+			if len(platoon) < 2 or any(vehicle.lane is not self.lane for vehicle in platoon):
+				continue
+			slots = platoon.get_slots()
+			if np.all(np.diff(slots) == 1):
+				platoon_slots.append((platoon, slots))
+		return platoon_slots
 
 	def update_vehicles(self, dt: float):
 		"""
 		Updates the position and speed of all vehicles in the fleet based on the car-following model and lane changing.
+		The vehicles are advanced with the integration scheme ``self.integrator``.
 
 		:param dt: The time step for the update.
 		"""
-		acc_list = []  # List to store the calculated accelerations for each vehicle
-		platoon = None
-		for i, vehicle in enumerate(self.vehicles):
-			# Check if the vehicle is in a platoon
-			if vehicle.platoon is not None:
-				if vehicle.platoon == platoon:
-					# If the vehicle is in the same platoon as the previous vehicle
-					if vehicle == vehicle.platoon.front_vehicle:
-						# If the vehicle is the front vehicle of the platoon, calculate the acceleration of the platoon
-						acc_list_platoon = vehicle.platoon.get_acceleration()
-						for acc in acc_list_platoon:
-							acc_list.append(acc)
-				else:
-					# If the vehicle is in a different platoon than the previous vehicle
-					platoon = vehicle.platoon
-			# Calculate the acceleration of the vehicle
-			acc_list.append(vehicle.get_acceleration())  # Placeholder for calculating the acceleration
-
-		for i, vehicle in enumerate(self.vehicles):
-			# Update the vehicle's speed and position based on the acceleration
-			acceleration = acc_list[i]
-			vehicle.update(acceleration, dt)
+		if not self.vehicles:
+			return
+		self.update_platoons()
+		position, speed, acc = self.integrate(dt)
+		num = len(acc)
+		state = self.state
+		state.position[:num], state.speed[:num] = position, speed
+		state.acc[:num] = acc
+		state.touch()
+
+		if Vehicle.record_states:
+			for vehicle in self.vehicles:
+				vehicle._restore_states()
+
+	def integrate(self, dt: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+		"""
+		Advances the vehicles of the fleet by one step with the integration scheme ``self.integrator`` without
+		changing their states.
+
+		:param dt: The time step.
+		:return: positions and speeds at the end of the step and accelerations at its start, in list order
+		"""
+		acc = self.get_accelerations()
+		num = len(acc)
+		state = self.state
+		vehicles = self.get_arrays()
+
+		def get_acc(position: np.ndarray, speed: np.ndarray) -> np.ndarray:
+			return self.compute_accelerations(vehicles._replace(position=position, speed=speed))
+
+		position, speed = INTEGRATORS[self.integrator](get_acc, state.position[:num], state.speed[:num], acc, dt,
+		                                               self.lane.max_speed)
+		return position, speed, acc
 
 	def get_lane_change_intention(self, front_veh_list_lc_left: Optional[List[Vehicle]] = None,
 	                              front_veh_list_lc_right: Optional[List[Vehicle]] = None,
 	                              rear_veh_list_lc_left: Optional[List[Vehicle]] = None,
 	                              rear_veh_list_lc_right: Optional[List[Vehicle]] = None):
 		"""
-		Updates the lane change intention of the vehicles in the fleet.
+		Updates the lane change intention of the vehicles in the fleet. Intentions of the previous epoch are
+		discarded, whether they have been performed or not.
 		:param front_veh_list_lc_left: A list of the front vehicles in the adjacent lanes.
 		:param front_veh_list_lc_right: A list of the front vehicles in the adjacent lanes.
 		:param rear_veh_list_lc_left: A list of the rear vehicles in the adjacent lanes.
 		:param rear_veh_list_lc_right: A list of the rear vehicles in the adjacent lanes.
 		:return:
 		"""
-		mobil = MOBIL()  # Create an instance of the MOBIL model
+		self.lc_rows = 0
 		if front_veh_list_lc_left is None and front_veh_list_lc_right is None:
 			# If no adjacent lane, return
 			return
+		num = self.sync_state()
+		if num == 0:
+			return
 
-		if front_veh_list_lc_left is not None and front_veh_list_lc_right is not None:
-			for i, vehicle in enumerate(self.vehicles):
-				if vehicle.platoon is not None:
-					# If the vehicle is in a platoon, skip the vehicle
-					continue
-				front_vehicle_curr_left = front_veh_list_lc_left[i]  # the front vehicle in the left lane
-				front_vehicle_curr_right = front_veh_list_lc_right[i]  # the front vehicle in the right lane
-				rear_vehicle_curr_left = rear_veh_list_lc_left[i]  # the rear vehicle in the left lane
-				rear_vehicle_curr_right = rear_veh_list_lc_right[i]  # the rear vehicle in the right lane
-				if mobil.check_lane_changing(vehicle, front_vehicle_curr_left, rear_vehicle_curr_left) and \
-						mobil.check_lane_changing(vehicle, front_vehicle_curr_right, rear_vehicle_curr_right):
-					incentive_left = mobil.get_incentive(vehicle,
-					                                     front_vehicle_curr_left, rear_vehicle_curr_left)  # Get the incentive to change lanes
-					incentive_right = mobil.get_incentive(vehicle,
-					                                      front_vehicle_curr_right, rear_vehicle_curr_right)
-					if incentive_left > incentive_right:
-						if incentive_left > mobil.delta:
-							# Add the vehicle to the list of vehicles that want to change lanes
-							self.lc_vehicle_list.append(vehicle)
-							self.lc_front_vehicle_list.append(front_vehicle_curr_left)
-							self.lc_direction_list.append('left')
-					else:
-						if incentive_right > mobil.delta:
-							# Add the vehicle to the list of vehicles that want to change lanes
-							self.lc_vehicle_list.append(vehicle)
-							self.lc_front_vehicle_list.append(front_vehicle_curr_right)
-							self.lc_direction_list.append('right')
-
-				elif mobil.check_lane_changing(vehicle, front_vehicle_curr_left, rear_vehicle_curr_left):
-					incentive_left = mobil.get_incentive(vehicle,
-					                                     front_vehicle_curr_left, rear_vehicle_curr_left)
-					if incentive_left > mobil.delta:
-						# Add the vehicle to the list of vehicles that want to change lanes
-						self.lc_vehicle_list.append(vehicle)
-						self.lc_front_vehicle_list.append(front_vehicle_curr_left)
-						self.lc_direction_list.append('left')
-
-				elif mobil.check_lane_changing(vehicle, front_vehicle_curr_right, rear_vehicle_curr_right):
-					incentive_right = mobil.get_incentive(vehicle,
-					                                      front_vehicle_curr_right, rear_vehicle_curr_right)
-					if incentive_right > mobil.delta:
-						# Add the vehicle to the list of vehicles that want to change lanes
-						self.lc_vehicle_list.append(vehicle)
-						self.lc_front_vehicle_list.append(front_vehicle_curr_right)
-						self.lc_direction_list.append('right')
-
-				else:
-					continue
-		elif front_veh_list_lc_left is not None:
-			for i, vehicle in enumerate(self.vehicles):
-				if vehicle.platoon is not None:
-					# If the vehicle is in a platoon, skip the vehicle
-					continue
-				front_vehicle_curr_left = front_veh_list_lc_left[i]
-				rear_vehicle_curr_left = rear_veh_list_lc_left[i]
-				if mobil.check_lane_changing(vehicle, front_vehicle_curr_left, rear_vehicle_curr_left):
-					incentive_left = mobil.get_incentive(vehicle,
-					                                     front_vehicle_curr_left, rear_vehicle_curr_left)
-					if incentive_left > mobil.delta:
-						# Add the vehicle to the list of vehicles that want to change lanes
-						self.lc_vehicle_list.append(vehicle)
-						self.lc_front_vehicle_list.append(front_vehicle_curr_left)
-						self.lc_direction_list.append('left')
-		elif front_veh_list_lc_right is not None:
-			for i, vehicle in enumerate(self.vehicles):
-				if vehicle.platoon is not None:
-					# If the vehicle is in a platoon, skip the vehicle
-					continue
-				front_vehicle_curr_right = front_veh_list_lc_right[i]
-				rear_vehicle_curr_right = rear_veh_list_lc_right[i]
-				if mobil.check_lane_changing(vehicle, front_vehicle_curr_right, rear_vehicle_curr_right):
-					incentive_right = mobil.get_incentive(vehicle,
-					                                      front_vehicle_curr_right, rear_vehicle_curr_right)
-					if incentive_right > mobil.delta:
-						# Add the vehicle to the list of vehicles that want to change lanes
-						self.lc_vehicle_list.append(vehicle)
-						self.lc_front_vehicle_list.append(front_vehicle_curr_right)
-						self.lc_direction_list.append('right')
+		left_index = self.__get_adjacent_slots(front_veh_list_lc_left, rear_veh_list_lc_left)
+		right_index = self.__get_adjacent_slots(front_veh_list_lc_right, rear_veh_list_lc_right)
+		mobil = MOBIL()  # Create an instance of the MOBIL model
+		decision = mobil.get_lane_change_decision(*self.get_lane_change_arrays(left_index, right_index))
+		self.set_lane_change_intention(decision.direction, None if left_index is None else left_index[0],
+		                               None if right_index is None else right_index[0])
+
+	def get_lane_change_arrays(self, left_index: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+	                           right_index: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> tuple:
+		"""
+		Gathers the vehicles of the fleet and their neighbors as arrays for ``MOBIL.get_lane_change_decision``.
+
+		:param left_index: indices of the front and rear vehicles in the left lane (see ``get_adjacent_index``), None
+		                   if there is no left lane
+		:param right_index: indices of the front and rear vehicles in the right lane, None if there is no right lane
+		:return: the vehicles, their front and rear vehicles in the current lane, in the left lane and in the right
+		         lane, the vehicles of a missing lane are None
+		"""
+		num = self.sync_state()
+		ego = self.get_arrays(self.get_accelerations())
+		index = np.arange(num)
+		leader = ego.take(index - 1)  # Front vehicles in the current lane
+		follower = ego.take(index + 1)  # Rear vehicles in the current lane
+		left_leader, left_follower = self.__get_adjacent_arrays(self.lane.left_lane, left_index)
+		right_leader, right_follower = self.__get_adjacent_arrays(self.lane.right_lane, right_index)
+		return ego, leader, follower, left_leader, left_follower, right_leader, right_follower
+
+	def set_lane_change_intention(self, direction: np.ndarray, left_front_index: Optional[np.ndarray] = None,
+	                              right_front_index: Optional[np.ndarray] = None):
+		"""
+		Stores the lane changes chosen by ``MOBIL`` for the vehicles of the fleet into the rows ``lc_direction`` and
+		``lc_front``, replacing those of the previous epoch. Vehicles in a platoon do not change lanes. The rows are
+		valid until vehicles are added to or removed from the fleet.
+
+		:param direction: the direction of each vehicle, see ``LaneChangeDecision``
+		:param left_front_index: indices of the front vehicles in the left lane
+		:param right_front_index: indices of the front vehicles in the right lane
+		"""
+		num = len(direction)
+		if num > len(self.lc_direction):
+			capacity = max(num, 2 * len(self.lc_direction))
+			self.lc_direction = np.zeros(capacity, dtype=np.int8)
+			self.lc_front = np.full(capacity, -1, dtype=np.intp)
+		lc_direction = self.lc_direction[:num]
+		lc_direction[:] = direction
+		vehicles = self.vehicles
+		for i in np.flatnonzero(direction).tolist():
+			if vehicles[i].platoon is not None:
+				# If the vehicle is in a platoon, skip the vehicle
+				lc_direction[i] = LANE_CHANGE_NONE
+		lc_front = self.lc_front[:num]
+		lc_front[:] = -1
+		for side, front_index in ((LANE_CHANGE_LEFT, left_front_index), (LANE_CHANGE_RIGHT, right_front_index)):
+			if front_index is not None:
+				lc_front[lc_direction == side] = front_index[lc_direction == side]
+		self.lc_rows = num
+
+	def get_lane_change_intents(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+		"""
+		Returns the pending lane changes of the fleet.
+
+		:return: the indices of the vehicles which intend to change lanes, their directions (see
+		         ``LaneChangeDecision``) and the indices of their front vehicles in the target lanes (-1 if none)
+		"""
+		index = np.flatnonzero(self.lc_direction[:self.lc_rows])
+		return index, self.lc_direction[index], self.lc_front[index]
+
+	@staticmethod
+	def __get_adjacent_slots(front_vehicle_list: Optional[List[Vehicle]],
+	                         rear_vehicle_list: Optional[List[Vehicle]]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+		"""
+		Converts the front and rear vehicles in the target lane to their indices in the target fleet.
+
+		:param front_vehicle_list: The front vehicle in the target lane of each vehicle.
+		:param rear_vehicle_list: The rear vehicle in the target lane of each vehicle.
+		:return: The indices of the front and rear vehicles, -1 for None, or None if there is no target lane.
+		"""
+		if front_vehicle_list is None:
+			return None
+		num = len(front_vehicle_list)
+		front_index = np.fromiter((-1 if vehicle is None else vehicle._slot for vehicle in front_vehicle_list),
+		                          dtype=np.intp, count=num)
+		rear_index = np.fromiter((-1 if vehicle is None else vehicle._slot for vehicle in rear_vehicle_list),
+		                         dtype=np.intp, count=num)
+		return front_index, rear_index
+
+	@staticmethod
+	def __get_adjacent_arrays(target_lane, adjacent_index: Optional[Tuple[np.ndarray, np.ndarray]]):
+		"""
+		Gathers the front and rear vehicles in the target lane as arrays.
+
+		:param target_lane: The target lane.
+		:param adjacent_index: The indices of the front and rear vehicle in the target lane of each vehicle.
+		:return: The front and rear vehicles as arrays, or None if there is no target lane.
+		"""
+		if adjacent_index is None:
+			return None, None
+		target_vehicles = target_lane.fleet.get_arrays(target_lane.fleet.get_accelerations())
+		front_index, rear_index = adjacent_index
+		return target_vehicles.take(front_index), target_vehicles.take(rear_index)
+
+	def get_adjacent_index(self, target_lane) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Finds the front and rear vehicle in the target lane of every vehicle in the fleet. Both fleets are ordered by
+		position, so all vehicles are searched at once with ``np.searchsorted`` in O(n log m).
+
+		:param target_lane: The target lane.
+		:return: Indices of the front and rear vehicles in the target fleet, -1 if there is no such vehicle.
+		"""
+		num = self.sync_state()
+		num_target = target_lane.fleet.sync_state()
+		position = self.state.position[:num]
+		target_position = target_lane.fleet.state.position[:num_target]
+
+		# Positions decrease from front to rear, so the negative positions are sorted in ascending order.
+		# ``num_ahead`` is the number of vehicles in the target lane which are in front of each vehicle.
+		num_ahead = np.searchsorted(-target_position, -position, side='left')
+		front_index = num_ahead - 1
+		rear_index = np.where(num_ahead < num_target, num_ahead, -1)
+		return front_index, rear_index
 
 	def get_adjacent_vehicle_list(self, target_lane):
 		"""
@@ -241,30 +448,24 @@ class Fleet(object):
 		if target_lane is None:
 			return None, None
 
-		front_vehicle_list = []
-		rear_vehicle_list = []
-		start = 0
-		for vehicle_curr in self.vehicles:
-			# find the front vehicle of vehicle_curr in the target lane according to the vehicle's position
-			front_vehicle_curr = None
-			rear_vehicle_curr = None
-			for i, vehicle_target in enumerate(target_lane.fleet.vehicles[start:]):
-				delta_dist = vehicle_target.position - vehicle_curr.position
-				if delta_dist > 0:
-					front_vehicle_curr = vehicle_target
-				else:
-					start = i - 1
-					rear_vehicle_curr = vehicle_target
-					break
-
-			if front_vehicle_curr is None:
-				# If no front vehicle, set the front vehicle to be the first vehicle in the target lane
-				start = 0
-			front_vehicle_list.append(front_vehicle_curr)
-			rear_vehicle_list.append(rear_vehicle_curr)
-
+		front_index, rear_index = self.get_adjacent_index(target_lane)
+		# Append None so that index -1 refers to a missing vehicle
+		target_vehicles = target_lane.fleet.vehicles + [None]
+		front_vehicle_list = [target_vehicles[i] for i in front_index.tolist()]
+		rear_vehicle_list = [target_vehicles[i] for i in rear_index.tolist()]
 		return front_vehicle_list, rear_vehicle_list
 
+	def find_front_vehicle(self, position: float) -> Optional[Vehicle]:
+		"""
+		Finds the nearest vehicle of the fleet in front of the given position by binary search.
+
+		:param position: The position to search from.
+		:return: The front vehicle or None if no vehicle is in front of the position.
+		"""
+		num = self.sync_state()
+		num_ahead = np.searchsorted(-self.state.position[:num], -position, side='left')
+		return self.vehicles[num_ahead - 1] if num_ahead > 0 else None
+
 	def get_states(self, state_type: float = 'position'):
 		"""
 		Returns a list of the states of the vehicles in the fleet.
@@ -273,35 +474,75 @@ class Fleet(object):
 		:return: A list of the states of the vehicles in the fleet.
 		"""
 		assert state_type in ['position', 'speed', 'acceleration', 'gap']
-		state_list = []
-		# Iterate through the vehicles in the fleet and add the state to the list
-		for vehicle in self.vehicles:
-			if state_type == 'position':
-				state_list.append(vehicle.position)
-			elif state_type == 'speed':
-				state_list.append(vehicle.speed)
-			elif state_type == 'acceleration':
-				state_list.append(vehicle.acc)
-			elif state_type == 'gap':
-				# Calculate the gap between the vehicle and the front vehicle
-				if vehicle.front_vehicle is not None:
-					delta_loc = vehicle.front_vehicle.position - vehicle.position
-					gap = delta_loc - vehicle.length
-					state_list.append(gap)
-				else:
-					state_list.append(-1)
-		return state_list
-
-	def __update_platoon(self):
-		"""
-		Check the state of platoons. If there is a platoon, update the platoon.
-		if the platoon has only one vehicle, remove the platoon.
-		if the platoon is split into two platoons, update the platoon.
+		num = self.sync_state()
+		state = self.state
+		if state_type == 'position':
+			return state.position[:num].tolist()
+		elif state_type == 'speed':
+			return state.speed[:num].tolist()
+		elif state_type == 'acceleration':
+			return state.acc[:num].tolist()
+		# Calculate the gap between the vehicle and the front vehicle, -1 for the front vehicle of the fleet
+		position = state.position[:num]
+		gap = np.full(num, -1.0)
+		gap[1:] = position[:-1] - position[1:] - state.length[1:num]
+		return gap.tolist()
+
+	def update_platoons(self):
 		"""
-		for platoon in self.platoons:
-			if len(platoon.vehicles) == 1:
-				platoon.vehicles[0].platoon = None
-				platoon = None
-			else:
-				# TODO: complete the function to update platoon
-				pass
+		Forms and merges platoons of consecutive CAVs, up to ``platoon_size`` vehicles per platoon.
+
+		Only the vehicles whose front or rear vehicle has changed since the last call, by insertion, removal or lane
+		change, are checked against their neighbors, so the time is proportional to the number of changes rather than
+		to the size of the fleet. A pair which is too close to join is checked again in the next call. Splitting at
+		cut-ins and leaving vehicles are handled right away by ``add_vehicle`` and ``remove_vehicle``.
+		"""
+		if self.platoon_size is None or not self._platoon_candidates:
+			return
+		candidates = self._platoon_candidates
+		self._platoon_candidates = {}
+		for vehicle in candidates.values():
+			for front_vehicle, rear_vehicle in ((vehicle.front_vehicle, vehicle), (vehicle, vehicle.rear_vehicle)):
+				if front_vehicle is None or rear_vehicle is None or \
+						not isinstance(front_vehicle, CAV) or not isinstance(rear_vehicle, CAV):
+					continue
+				if not self.__link_platoon(front_vehicle, rear_vehicle) and \
+						Platoon.get_gap(front_vehicle, rear_vehicle) < Platoon.MIN_DISTANCE:
+					self._platoon_candidates[rear_vehicle.id] = rear_vehicle
+
+	def __link_platoon(self, front_vehicle: Vehicle, rear_vehicle: Vehicle) -> bool:
+		"""
+		Joins two consecutive CAVs into one platoon: forms a new platoon, lets one of them join the platoon of the
+		other, or merges their platoons.
+
+		:param front_vehicle: The front vehicle of the pair.
+		:param rear_vehicle: The rear vehicle of the pair.
+		:return: True if both vehicles are in the same platoon afterwards, False otherwise.
+		"""
+		front_platoon = front_vehicle.platoon
+		rear_platoon = rear_vehicle.platoon
+		if front_platoon is not None and front_platoon is rear_platoon:
+			return True
+		if front_platoon is None and rear_platoon is None:
+			if self.platoon_size < 2 or Platoon.get_gap(front_vehicle, rear_vehicle) < Platoon.MIN_DISTANCE:
+				return False
+			self.__add_platoon(Platoon(front_vehicle, rear_vehicle, self.platoon_size))
+			return True
+		if rear_platoon is None:
+			return front_platoon.add_vehicle(rear_vehicle)
+		if front_platoon is None:
+			return rear_platoon.add_vehicle(front_vehicle)
+		if front_platoon.merge(rear_platoon):
+			self.__discard_platoon(rear_platoon)
+			return True
+		return False
+
+	def __add_platoon(self, platoon: Optional[Platoon]):
+		"""Registers a new platoon of the fleet, None is ignored."""
+		if platoon is not None:
+			self.platoons.append(platoon)
+
+	def __discard_platoon(self, platoon: Platoon):
+		"""Unregisters a platoon of the fleet which has been dissolved."""
+		if not len(platoon) and platoon in self.platoons:
+			self.platoons.remove(platoon)
@@ -0,0 +1,94 @@
+import numpy as np
+from typing import Callable, Tuple
+
+# Accelerations of all vehicles of a lane at the given positions and speeds
+AccelerationFunction = Callable[[np.ndarray, np.ndarray], np.ndarray]
+
+
+def ballistic_update(position, speed, acc, dt: float, max_speed: float):
+	"""
+	Moves vehicles with constant accelerations over a step while keeping their speeds within [0, max_speed]. A
+	vehicle which stops within the step stands still from the stopping time ``-speed / acc`` on, and a vehicle which
+	reaches the speed limit continues at the limit, so no vehicle moves backwards. Works on arrays and scalars.
+
+	:param position: positions of the vehicles
+	:param speed: speeds of the vehicles, within [0, max_speed]
+	:param acc: accelerations of the vehicles
+	:param dt: time step
+	:param max_speed: speed limit
+	:return: positions and speeds at the end of the step
+	"""
+	end_speed = speed + acc * dt
+	with np.errstate(divide='ignore', invalid='ignore'):
+		# Time until the speed reaches its bound, the whole step if it does not
+		t_bound = np.where(end_speed < 0, -speed / acc, np.where(end_speed > max_speed, (max_speed - speed) / acc, dt))
+	t_bound = np.clip(t_bound, 0, dt)
+	bound_speed = np.clip(end_speed, 0, max_speed)
+	position = position + speed * t_bound + 0.5 * acc * t_bound ** 2 + bound_speed * (dt - t_bound)
+	return position, bound_speed
+
+
+def integrate_ballistic(get_acc: AccelerationFunction, position: np.ndarray, speed: np.ndarray, acc: np.ndarray,
+                        dt: float, max_speed: float) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Ballistic scheme: the accelerations at the start of the step are kept over the whole step. First order in the
+	speeds, exact for the positions given the accelerations.
+
+	:param get_acc: accelerations of the vehicles at given positions and speeds
+	:param position: positions at the start of the step
+	:param speed: speeds at the start of the step
+	:param acc: accelerations at the start of the step
+	:param dt: time step
+	:param max_speed: speed limit
+	:return: positions and speeds at the end of the step
+	"""
+	return ballistic_update(position, speed, acc, dt, max_speed)
+
+
+def integrate_heun(get_acc: AccelerationFunction, position: np.ndarray, speed: np.ndarray, acc: np.ndarray,
+                   dt: float, max_speed: float) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Heun's (trapezoidal) scheme: the vehicles move with the mean of the accelerations at the start of the step and
+	at the end of a ballistic predictor step. Second order, one more evaluation of the accelerations per step.
+
+	The parameters are the same as of ``integrate_ballistic``.
+	"""
+	predicted_position, predicted_speed = ballistic_update(position, speed, acc, dt, max_speed)
+	predicted_acc = get_acc(predicted_position, predicted_speed)
+	return ballistic_update(position, speed, 0.5 * (acc + predicted_acc), dt, max_speed)
+
+
+def integrate_rk4(get_acc: AccelerationFunction, position: np.ndarray, speed: np.ndarray, acc: np.ndarray,
+                  dt: float, max_speed: float) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Classical Runge-Kutta scheme of fourth order, three more evaluations of the accelerations per step. The speeds of
+	the stages are kept within [0, max_speed]. Vehicles whose speed would leave the bounds within the step move
+	ballistically with the mean acceleration of the stages, which gives the exact stopping time for that
+	acceleration.
+
+	The parameters are the same as of ``integrate_ballistic``.
+	"""
+	half = 0.5 * dt
+	speed_2 = np.clip(speed + half * acc, 0, max_speed)
+	acc_2 = get_acc(position + half * speed, speed_2)
+	speed_3 = np.clip(speed + half * acc_2, 0, max_speed)
+	acc_3 = get_acc(position + half * speed_2, speed_3)
+	speed_4 = np.clip(speed + dt * acc_3, 0, max_speed)
+	acc_4 = get_acc(position + dt * speed_3, speed_4)
+
+	mean_acc = (acc + 2 * acc_2 + 2 * acc_3 + acc_4) / 6
+	end_position = position + dt * (speed + 2 * speed_2 + 2 * speed_3 + speed_4) / 6
+	end_speed = speed + dt * mean_acc
+	bounded = (end_speed < 0) | (end_speed > max_speed)
+	if np.any(bounded):
+		bounded_position, bounded_speed = ballistic_update(position, speed, mean_acc, dt, max_speed)
+		end_position = np.where(bounded, bounded_position, end_position)
+		end_speed = np.where(bounded, bounded_speed, end_speed)
+	return end_position, end_speed
+
+
+INTEGRATORS = {
+	'ballistic': integrate_ballistic,
+	'heun': integrate_heun,
+	'rk4': integrate_rk4,
+}
@@ -1,6 +1,7 @@
 from typing import Optional
 import unittest
 from abc import ABC, abstractmethod
+from obstacles import ObstacleTable
 
 
 class Lane(ABC):
@@ -26,6 +27,7 @@ class Lane(ABC):
 		self.left_lane: Optional[Lane] = None
 		self.right_lane: Optional[Lane] = None
 		self.fleet = None
+		self.obstacles = ObstacleTable()  # Static and timed obstacles of the lane
 
 
 class MainLane(Lane):
@@ -0,0 +1,165 @@
+import numpy as np
+from vehicle import Vehicle
+from lane import Lane
+from models import LANE_CHANGE_LEFT, LANE_CHANGE_RIGHT
+from profiler import profiler
+from typing import List, NamedTuple, Tuple
+
+
+class LaneChangeIntents(NamedTuple):
+	"""
+	Lane-change intents of one lane-change phase as arrays of equal length, one entry per vehicle. Lanes are indices
+	into the lanes of the phase, vehicles are indices into their lanes ordered from front to rear.
+	"""
+	lane: np.ndarray  # Current lane of the vehicle
+	index: np.ndarray  # Index of the vehicle in its current lane
+	target: np.ndarray  # Target lane of the vehicle
+	front: np.ndarray  # Index of the vehicle in front of the target gap in the target lane, -1 if there is none
+	position: np.ndarray  # Position of the vehicle
+
+
+def collect_intents(fleets) -> Tuple[List[Lane], List[Vehicle], LaneChangeIntents]:
+	"""
+	Gathers the lane-change intents stored by ``Fleet.set_lane_change_intention`` in the given fleets. The gap of each
+	vehicle in its target lane is searched again at the current positions, by binary search for all vehicles with
+	the same target lane at once.
+
+	:param fleets: the fleets whose intents are collected
+	:return: the lanes of the phase (the lanes of the fleets and the target lanes), the vehicles and their intents
+	"""
+	lanes = [fleet.lane for fleet in fleets]
+	lane_index = {id(lane_curr): i for i, lane_curr in enumerate(lanes)}
+	vehicles = []
+	columns = []
+	for i, fleet in enumerate(fleets):
+		lc_index, lc_direction, _ = fleet.get_lane_change_intents()
+		if len(lc_index) == 0:
+			continue
+		fleet.sync_state()  # The fleet has not changed since the intents were chosen, so the indices are its slots
+		fleet_vehicles = fleet.vehicles
+		for direction, target_lane in ((LANE_CHANGE_LEFT, fleet.lane.left_lane),
+		                               (LANE_CHANGE_RIGHT, fleet.lane.right_lane)):
+			index = lc_index[lc_direction == direction]
+			if len(index) == 0:
+				continue
+			if id(target_lane) not in lane_index:
+				lane_index[id(target_lane)] = len(lanes)
+				lanes.append(target_lane)
+			position = fleet.state.position[index]
+			num_target = target_lane.fleet.sync_state()
+			front = np.searchsorted(-target_lane.fleet.state.position[:num_target], -position, side='left') - 1
+			vehicles.extend(fleet_vehicles[k] for k in index.tolist())
+			columns.append((np.full(len(index), i), index, np.full(len(index), lane_index[id(target_lane)]),
+			                front, position))
+	if not columns:
+		empty = np.zeros(0, dtype=np.intp)
+		return lanes, vehicles, LaneChangeIntents(empty, empty, empty, empty, np.zeros(0))
+	return lanes, vehicles, LaneChangeIntents(*(np.concatenate(column) for column in zip(*columns)))
+
+
+def resolve_conflicts(intents: LaneChangeIntents) -> np.ndarray:
+	"""
+	Selects the lane changes which can be performed together. Of several vehicles targeting the same gap, from the
+	same lane or from both sides of the target lane, only the vehicle furthest ahead changes lanes. Two vehicles
+	side by side which would swap their lanes cross each other, and only the vehicle ahead changes lanes. All
+	intents are checked at once, independent of their order.
+
+	:param intents: the intents of the phase
+	:return: whether each lane change is accepted
+	"""
+	lane, index, target, front, position = intents
+	num = len(lane)
+	accepted = np.zeros(num, dtype=bool)
+	if num == 0:
+		return accepted
+
+	# The first vehicle of each gap, ties of positions are broken by lane and index
+	order = np.lexsort((index, lane, -position, front, target))
+	first = np.ones(num, dtype=bool)
+	first[1:] = (target[order[1:]] != target[order[:-1]]) | (front[order[1:]] != front[order[:-1]])
+	accepted[order[first]] = True
+
+	# A vehicle whose target front vehicle moves into its lane and has it as its target rear vehicle is side by side
+	stride = int(max(index.max(), front.max())) + 2
+	key = lane * stride + index
+	key_order = np.argsort(key)
+	sorted_key = key[key_order]
+	found = np.searchsorted(sorted_key, target * stride + front)
+	found = np.minimum(found, num - 1)
+	other = key_order[found]
+	crossing = (front >= 0) & (sorted_key[found] == target * stride + front) & accepted[other] & \
+	           (target[other] == lane) & (front[other] + 1 == index)
+	accepted &= ~crossing
+	return accepted
+
+
+def get_insert_fronts(leaving: np.ndarray, arrival_front: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Finds the vehicles behind which the arriving vehicles of a lane are inserted once the leaving vehicles are gone.
+
+	:param leaving: indices of the vehicles leaving the lane
+	:param arrival_front: target front indices of the arriving vehicles, sorted and distinct
+	:return: for each arriving vehicle the index of the nearest staying vehicle in front of its gap (-1 if none), and
+	         whether the previous arriving vehicle is between that vehicle and the gap, i.e. the vehicle to insert
+	         behind
+	"""
+	front = arrival_front.copy()
+	if len(leaving):
+		leaving = np.sort(leaving)
+		# Start of the run of consecutive leaving vehicles of each leaving vehicle
+		run_start = np.ones(len(leaving), dtype=bool)
+		run_start[1:] = np.diff(leaving) != 1
+		start = leaving[np.maximum.accumulate(np.where(run_start, np.arange(len(leaving)), 0))]
+		found = np.minimum(np.searchsorted(leaving, front), len(leaving) - 1)
+		front = np.where(leaving[found] == front, start[found] - 1, front)
+	behind_arrival = np.zeros(len(front), dtype=bool)
+	behind_arrival[1:] = arrival_front[:-1] >= front[1:]
+	return front, behind_arrival
+
+
+def change_lanes(fleets) -> List[Vehicle]:
+	"""
+	Performs the lane changes intended in the given fleets in two phases. All intents are collected and resolved at
+	once against the positions at the start of the phase (see ``resolve_conflicts``), then the accepted vehicles
+	leave their lanes and are inserted into their target lanes lane by lane. Resolving and relinking cost O(k) for k
+	lane changes, but every lane which a vehicle leaves or enters is reordered by its next ``Fleet.sync_state``, which
+	walks all vehicles of the lane (``FleetState.compact``). An epoch with lane changes therefore costs linear time in
+	the number of vehicles on the lanes involved. The intents are cleared afterwards.
+
+	:param fleets: the fleets whose intents are performed
+	:return: the vehicles which have changed lanes
+	"""
+	lanes, vehicles, intents = collect_intents(fleets)
+	for fleet in fleets:
+		fleet.lc_rows = 0
+	if not vehicles:
+		return []
+	accepted = resolve_conflicts(intents)
+	accepted_index = np.flatnonzero(accepted)
+	moved = [vehicles[k] for k in accepted_index.tolist()]
+
+	# Vehicles of the target lanes before the lane changes, which the front indices refer to
+	arrivals = {}
+	for k in accepted_index[np.argsort(intents.front[accepted_index], kind='stable')].tolist():
+		arrivals.setdefault(int(intents.target[k]), []).append(k)
+	original = {i: lanes[i].fleet.vehicles for i in arrivals}
+
+	for vehicle in moved:
+		vehicle.lane.fleet.remove_vehicle(vehicle)
+	for i, count in zip(*np.unique(intents.lane[accepted], return_counts=True)):
+		lanes[i].fleet.num_lane_changes += int(count)
+	profiler.count('lane_changes', len(moved))
+
+	for i, arriving in arrivals.items():
+		fleet = lanes[i].fleet
+		front_index, behind_arrival = get_insert_fronts(intents.index[accepted & (intents.lane == i)],
+		                                                intents.front[arriving])
+		previous = None
+		for k, front, behind in zip(arriving, front_index.tolist(), behind_arrival.tolist()):
+			if behind:
+				front_vehicle = previous
+			else:
+				front_vehicle = original[i][front] if front >= 0 else None
+			fleet.add_vehicle(vehicles[k], front_vehicle)
+			previous = vehicles[k]
+	return moved
@@ -0,0 +1,272 @@
+import numpy as np
+from structure import VehicleTable
+from lane import Lane
+from typing import Dict, List, Optional, Sequence, Union
+
+
+def _interval_sums(edges: np.ndarray, lower: np.ndarray, upper: np.ndarray,
+                   weights: Optional[np.ndarray] = None) -> np.ndarray:
+	"""
+	Sums the weights of the intervals (lower, upper] over the sorted points ``edges`` they contain, for all
+	intervals at once: each interval adds its weight at its first point and removes it behind its last point.
+
+	:param edges: sorted points
+	:param lower: lower ends of the intervals
+	:param upper: upper ends of the intervals
+	:param weights: weights of the intervals, 1 if None
+	:return: for each point the sum of the weights of the intervals containing it
+	"""
+	first = np.searchsorted(edges, lower, side='right')
+	last = np.searchsorted(edges, upper, side='right')
+	inside = first < last
+	if weights is None:
+		weights = np.ones(len(lower))
+	diff = np.bincount(first[inside], weights[inside], minlength=len(edges) + 1) - \
+	       np.bincount(last[inside], weights[inside], minlength=len(edges) + 1)
+	return np.cumsum(diff)[:len(edges)]
+
+
+class LoopDetectors(object):
+	"""
+	Virtual loop detectors at fixed positions of the lanes. Each step, the vehicles which have passed a detector are
+	counted with their speeds over the step, and the time the detector is covered by a vehicle is summed. For every
+	aggregation period one row per detector is emitted with the count, the flow (veh/h), the time-mean and the
+	harmonic (space-mean) speed (m/s) and the occupancy. The steps and periods are driven by ``OnlineMetrics``.
+	"""
+	FIELDS = ('time', 'lane', 'position', 'count', 'flow', 'time_mean_speed', 'space_mean_speed', 'occupancy')
+
+	def __init__(self, lane_list: List[Lane], positions: Union[Sequence[float], Dict[int, Sequence[float]]]):
+		"""
+		:param lane_list: list of lanes
+		:param positions: positions of the detectors of every lane, or of each lane by its index in ``lane_list``
+		"""
+		if not isinstance(positions, dict):
+			positions = {i: positions for i in range(len(lane_list))}
+		self.positions = [np.sort(np.asarray(positions.get(i, []), dtype=float)) for i in range(len(lane_list))]
+		self.rows = {field: [] for field in self.FIELDS}
+		self._reset()
+
+	def _reset(self):
+		self.elapsed = 0.0
+		self.count = [np.zeros(len(position)) for position in self.positions]
+		self.speed_sum = [np.zeros(len(position)) for position in self.positions]
+		self.inverse_speed_sum = [np.zeros(len(position)) for position in self.positions]
+		self.occupied = [np.zeros(len(position)) for position in self.positions]
+
+	def accumulate(self, i: int, last_position: np.ndarray, position: np.ndarray, length: np.ndarray, dt: float):
+		"""
+		Adds the vehicles of a lane over one step.
+
+		:param i: index of the lane
+		:param last_position: positions of the vehicles at the start of the step
+		:param position: positions of the vehicles at the end of the step
+		:param length: lengths of the vehicles
+		:param dt: time step
+		"""
+		detectors = self.positions[i]
+		if len(detectors) == 0:
+			return
+		speed = (position - last_position) / dt
+		moving = speed > 0
+		self.count[i] += _interval_sums(detectors, last_position[moving], position[moving])
+		self.speed_sum[i] += _interval_sums(detectors, last_position[moving], position[moving], speed[moving])
+		self.inverse_speed_sum[i] += _interval_sums(detectors, last_position[moving], position[moving],
+		                                            1 / speed[moving])
+		self.occupied[i] += _interval_sums(detectors, position - length, position) * dt
+
+	def flush(self, time: float):
+		"""
+		Emits the rows of the current aggregation period and starts a new one.
+
+		:param time: end time of the period
+		"""
+		if self.elapsed <= 0:
+			return
+		for i, detectors in enumerate(self.positions):
+			if len(detectors) == 0:
+				continue
+			count = self.count[i]
+			with np.errstate(divide='ignore', invalid='ignore'):
+				columns = {
+					'time': np.full(len(detectors), time),
+					'lane': np.full(len(detectors), i),
+					'position': detectors,
+					'count': count,
+					'flow': count / self.elapsed * 3600,
+					'time_mean_speed': self.speed_sum[i] / count,
+					'space_mean_speed': count / self.inverse_speed_sum[i],
+					'occupancy': self.occupied[i] / self.elapsed,
+				}
+			for field in self.FIELDS:
+				self.rows[field].append(columns[field])
+		self._reset()
+
+
+class EdieCells(object):
+	"""
+	Edie's generalized traffic variables over space-time cells. Each lane is divided into cells of ``cell_length``
+	meters and time into the aggregation periods of ``OnlineMetrics``. The distance traveled and the time spent by the
+	vehicles in each cell give the flow (veh/h) as distance over cell area, the density (veh/km) as time over cell
+	area and the speed (m/s) as distance over time.
+	"""
+	FIELDS = ('time', 'lane', 'start', 'flow', 'density', 'speed')
+
+	def __init__(self, lane_list: List[Lane], cell_length: float = 100):
+		"""
+		:param lane_list: list of lanes, the cells cover each lane from its start to its end
+		:param cell_length: length of the cells in meters
+		"""
+		self.cell_length = cell_length
+		self.starts = [lane_curr.start + cell_length *
+		               np.arange(int(np.ceil((lane_curr.end - lane_curr.start) / cell_length)))
+		               for lane_curr in lane_list]
+		self.rows = {field: [] for field in self.FIELDS}
+		self._reset()
+
+	def _reset(self):
+		self.elapsed = 0.0
+		self.distance = [np.zeros(len(start)) for start in self.starts]
+		self.time = [np.zeros(len(start)) for start in self.starts]
+
+	def accumulate(self, i: int, last_position: np.ndarray, position: np.ndarray, length: np.ndarray, dt: float):
+		"""
+		Adds the vehicles of a lane over one step, see ``LoopDetectors.accumulate``. A vehicle moves with constant
+		speed over the step, so its distance and time are split between the cells it passes in proportion.
+		"""
+		starts = self.starts[i]
+		num_cells = len(starts)
+		if num_cells == 0:
+			return
+		origin = starts[0]
+		first = np.floor((last_position - origin) / self.cell_length).astype(np.intp)
+		last = np.floor((position - origin) / self.cell_length).astype(np.intp)
+
+		# Vehicles which stay in one cell of the lane
+		within = (first == last) & (first >= 0) & (first < num_cells)
+		self.distance[i] += np.bincount(first[within], position[within] - last_position[within], minlength=num_cells)
+		self.time[i] += np.bincount(first[within], minlength=num_cells) * dt
+
+		# Vehicles which pass cell boundaries: the part in their first and last cell of the lane, and whole cells
+		# in between
+		crossing = (first < last) & (last >= 0) & (first < num_cells)
+		if np.any(crossing):
+			lower = np.maximum(last_position[crossing], origin)
+			upper = np.minimum(position[crossing], origin + num_cells * self.cell_length)
+			time_per_meter = dt / (position[crossing] - last_position[crossing])
+			first = np.clip(first[crossing], 0, num_cells - 1)
+			last = np.clip(last[crossing], 0, num_cells - 1)
+			same = first == last
+			first_distance = np.where(same, upper - lower, origin + (first + 1) * self.cell_length - lower)
+			last_distance = np.where(same, 0, upper - origin - last * self.cell_length)
+			between = last > first + 1
+			for total, weight in ((self.distance[i], 1), (self.time[i], time_per_meter)):
+				weight = np.broadcast_to(weight, first.shape)
+				total += np.bincount(first, first_distance * weight, minlength=num_cells)
+				total += np.bincount(last, last_distance * weight, minlength=num_cells)
+				if np.any(between):
+					diff = np.bincount(first[between] + 1, weight[between], minlength=num_cells + 1) - \
+					       np.bincount(last[between], weight[between], minlength=num_cells + 1)
+					total += np.cumsum(diff)[:num_cells] * self.cell_length
+
+	def flush(self, time: float):
+		"""
+		Emits the rows of the current aggregation period and starts a new one.
+
+		:param time: end time of the period
+		"""
+		if self.elapsed <= 0:
+			return
+		area = self.cell_length * self.elapsed
+		for i, starts in enumerate(self.starts):
+			if len(starts) == 0:
+				continue
+			with np.errstate(divide='ignore', invalid='ignore'):
+				columns = {
+					'time': np.full(len(starts), time),
+					'lane': np.full(len(starts), i),
+					'start': starts,
+					'flow': self.distance[i] / area * 3600,
+					'density': self.time[i] / area * 1000,
+					'speed': self.distance[i] / self.time[i],
+				}
+			for field in self.FIELDS:
+				self.rows[field].append(columns[field])
+		self._reset()
+
+
+class OnlineMetrics(object):
+	"""
+	Traffic metrics computed while the simulation runs, from the state arrays of the lanes, so that trajectories
+	need not be recorded. ``update`` is called after each step with the length of the step. The positions of the
+	vehicles at the end of a step are kept by id, so each step adds the move of every vehicle to the collectors, e.g.
+	``LoopDetectors`` and ``EdieCells``. A vehicle is counted from the first step after it has entered the road. Only
+	the vehicles on the road are kept, so the memory does not grow with the number of retired vehicles.
+	"""
+
+	def __init__(self, lane_list: List[Lane], collectors: Sequence, interval: float = 60):
+		"""
+		:param lane_list: list of lanes with their initial vehicles
+		:param collectors: objects with ``accumulate``, ``flush``, ``elapsed`` and ``rows``, see ``LoopDetectors``
+		:param interval: aggregation period in seconds
+		"""
+		self.collectors = list(collectors)
+		self.interval = interval
+		self.time = 0.0
+		self.period_start = 0.0
+		self.last_position = VehicleTable(np.nan)  # Positions of the vehicles on the road at the end of the last step
+		self._assign_positions(lane_list)
+
+	def update(self, lane_list: List[Lane], dt: float):
+		"""
+		Adds one step of all lanes and emits the rows of the collectors at the end of each aggregation period.
+
+		:param lane_list: list of lanes
+		:param dt: length of the step
+		"""
+		for i, lane_curr in enumerate(lane_list):
+			num = lane_curr.fleet.sync_state()
+			state = lane_curr.fleet.state
+			position = state.position[:num]
+			last_position = self.last_position.get(state.vehicle_id[:num])
+			known = ~np.isnan(last_position)
+			for collector in self.collectors:
+				collector.accumulate(i, last_position[known], position[known], state.length[:num][known], dt)
+		self._assign_positions(lane_list)
+
+		self.time += dt
+		for collector in self.collectors:
+			collector.elapsed += dt
+		if self.time - self.period_start >= self.interval - 1e-9:
+			self.flush()
+
+	def _assign_positions(self, lane_list: List[Lane]):
+		vehicle_id = []
+		position = []
+		for lane_curr in lane_list:
+			num = lane_curr.fleet.sync_state()
+			vehicle_id.append(lane_curr.fleet.state.vehicle_id[:num])
+			position.append(lane_curr.fleet.state.position[:num])
+		self.last_position.assign(np.concatenate(vehicle_id), np.concatenate(position))
+
+	def flush(self):
+		"""Emits the rows of the current aggregation period, e.g. the last incomplete one at the end of a run."""
+		for collector in self.collectors:
+			collector.flush(self.time)
+		self.period_start = self.time
+
+	def get_series(self) -> Dict[str, Dict[str, np.ndarray]]:
+		"""
+		Returns the emitted rows of each collector by the name of its class, one array per field.
+		"""
+		return {type(collector).__name__: {field: np.concatenate(rows) if rows else np.zeros(0)
+		                                   for field, rows in collector.rows.items()}
+		        for collector in self.collectors}
+
+	def save(self, file):
+		"""
+		Writes the emitted rows to one ``.npz`` archive with keys ``<collector>/<field>``.
+
+		:param file: path or binary file object
+		"""
+		np.savez(file, **{'{}/{}'.format(name, field): values for name, series in self.get_series().items()
+		                  for field, values in series.items()})
@@ -1,7 +1,21 @@
 import math
 import numpy as np
 import copy
-from typing import List, Union, Optional, Tuple
+from typing import List, Union, Optional, Tuple, NamedTuple
+from profiler import profiler
+
+# Lane-changing directions used by the batched MOBIL model
+LANE_CHANGE_LEFT = -1
+LANE_CHANGE_NONE = 0
+LANE_CHANGE_RIGHT = 1
+
+
+def copy_vehicle(vehicle):
+	"""
+	Shallow copy of a vehicle used to evaluate hypothetical links, counted by the profiler.
+	"""
+	profiler.count('copy')
+	return copy.copy(vehicle)
 
 
 class IDM(object):
@@ -44,8 +58,132 @@ class IDM(object):
 		return acceleration
 
 
+def idm_acceleration(speed, lead_speed, gap, desired_speed, reaction_time, max_acc, desired_dec, jam_distance):
+	"""
+	Vectorized form of ``IDM.get_acceleration`` which evaluates many vehicles at once.
+
+	All arguments are arrays of the same shape (or scalars). Vehicles without a leader are given an infinite gap,
+	which reduces the model to its free-road term.
+
+	:param speed: speeds of the vehicles
+	:param lead_speed: speeds of the leaders
+	:param gap: net distances to the leaders
+	:param desired_speed: desired speeds in free traffic
+	:param reaction_time: desired time headways
+	:param max_acc: maximum accelerations
+	:param desired_dec: comfortable decelerations
+	:param jam_distance: minimum desired net distances
+	:return: accelerations of the vehicles
+	"""
+	s_star = jam_distance + np.maximum(0, speed * reaction_time + speed * (speed - lead_speed) /
+	                                   (2 * np.sqrt(max_acc * desired_dec)))
+	with np.errstate(divide='ignore', invalid='ignore'):
+		acceleration = max_acc * (1 - (speed / desired_speed) ** 4 - (s_star / gap) ** 2)
+	return acceleration
+
+
+def idm_equilibrium_gap(speed, desired_speed, reaction_time, jam_distance):
+	"""
+	Net distance at which ``IDM.get_acceleration`` is zero for a vehicle following a leader with the same speed.
+
+	:param speed: speeds of the vehicles, below the desired speeds
+	:param desired_speed: desired speeds in free traffic
+	:param reaction_time: desired time headways
+	:param jam_distance: minimum desired net distances
+	:return: equilibrium gaps, infinite at the desired speed
+	"""
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return (jam_distance + speed * reaction_time) / np.sqrt(1 - (speed / desired_speed) ** 4)
+
+
+def obstacle_acceleration(speed, distance, desired_speed, reaction_time, max_acc, desired_dec, min_distance=1):
+	"""
+	Vectorized IDM braking term towards static obstacles (speed 0), such as road merges and traffic lights.
+	Vehicles farther from the obstacle than their desired distance are not affected.
+
+	:param speed: speeds of the vehicles
+	:param distance: distances from the vehicles to their obstacles
+	:param desired_speed: desired speeds in free traffic
+	:param reaction_time: desired time headways
+	:param max_acc: maximum accelerations
+	:param desired_dec: comfortable decelerations
+	:param min_distance: lower bound of the distance to avoid zero division
+	:return: accelerations caused by the obstacles, clipped to [-desired_dec, max_acc]
+	"""
+	s_star = min_distance + np.maximum(0, speed * reaction_time + speed * speed /
+	                                   (2 * np.sqrt(max_acc * desired_dec)))
+	acc_obstacle = np.where(distance < s_star,
+	                        max_acc * (1 - (speed / desired_speed) ** 4 -
+	                                   (s_star / np.maximum(distance, min_distance)) ** 2),
+	                        np.inf)
+	return np.clip(acc_obstacle, -desired_dec, max_acc)
+
+
+class VehicleArrays(NamedTuple):
+	"""
+	States and IDM parameters of a group of vehicles as arrays. ``exists`` marks entries which hold a vehicle,
+	other entries stand for a missing leader or follower.
+	"""
+	position: np.ndarray
+	speed: np.ndarray
+	acc: np.ndarray  # current car-following accelerations
+	length: np.ndarray
+	desired_speed: np.ndarray  # desired speeds of the lane the vehicles are in
+	reaction_time: np.ndarray
+	max_acc: np.ndarray
+	desired_dec: np.ndarray
+	jam_distance: np.ndarray
+	obstacle_position: np.ndarray
+	exists: np.ndarray
+
+	def take(self, index: np.ndarray) -> 'VehicleArrays':
+		"""
+		Gathers the vehicles at the given indices.
+
+		:param index: indices of the vehicles, indices out of range (e.g. -1) give missing vehicles
+		:return: the gathered vehicles
+		"""
+		num = len(self.position)
+		exists = (index >= 0) & (index < num)
+		if num == 0:
+			filler = np.ones(len(index))
+			return VehicleArrays(*([filler] * (len(self) - 1)), exists)
+		index = np.where(exists, index, 0)
+		return VehicleArrays(*(field[index] for field in self[:-1]), exists & self.exists[index])
+
+
+def follow_acceleration(follower: VehicleArrays, leader: VehicleArrays) -> np.ndarray:
+	"""
+	Calculates the accelerations of followers behind the given leaders, which is equivalent to
+	``HV.get_acceleration``: IDM acceleration, clipped to [-desired_dec, max_acc] and limited by obstacles.
+
+	:param follower: the following vehicles
+	:param leader: the leading vehicles, missing leaders give free-road accelerations
+	:return: accelerations of the followers
+	"""
+	gap = np.where(leader.exists, leader.position - follower.position - leader.length, np.inf)
+	lead_speed = np.where(leader.exists, leader.speed, follower.speed)
+	acc = idm_acceleration(follower.speed, lead_speed, gap, follower.desired_speed, follower.reaction_time,
+	                       follower.max_acc, follower.desired_dec, follower.jam_distance)
+	acc = np.clip(acc, -follower.desired_dec, follower.max_acc)
+	acc_obstacle = obstacle_acceleration(follower.speed, follower.obstacle_position - follower.position,
+	                                     follower.desired_speed, follower.reaction_time, follower.max_acc,
+	                                     follower.desired_dec)
+	return np.minimum(acc, acc_obstacle)
+
+
+class LaneChangeDecision(NamedTuple):
+	"""Result of the batched MOBIL model for a group of vehicles."""
+	safe_left: np.ndarray
+	incentive_left: np.ndarray
+	safe_right: np.ndarray
+	incentive_right: np.ndarray
+	direction: np.ndarray  # LANE_CHANGE_LEFT, LANE_CHANGE_NONE or LANE_CHANGE_RIGHT
+
+
 class ACC(object):
-	def __init__(self, desired_speed=25, max_acceleration=3, min_distance=2, time_headway=1.5):
+	def __init__(self, desired_speed=25, max_acceleration=3, min_distance=2, time_headway=1.5,
+	             max_deceleration=3, speed_gain=0.4, gap_gain=0.23, relative_speed_gain=0.07):
 		"""
 		Initializes the ACC model with default values for its parameters.
 
@@ -53,23 +191,105 @@ class ACC(object):
 		:param max_acceleration: float, maximum acceleration of the vehicle in meters per second squared (default: 3 m/s^2)
 		:param min_distance: float, minimum distance to maintain to the vehicle ahead in meters (default: 2 m)
 		:param time_headway: float, desired time headway to the vehicle ahead in seconds (default: 1.5 s)
+		:param max_deceleration: float, maximum deceleration of the vehicle in meters per second squared (default: 3 m/s^2)
+		:param speed_gain: float, gain of the speed error in cruise control (default: 0.4 1/s)
+		:param gap_gain: float, gain of the spacing error in gap control (default: 0.23 1/s^2)
+		:param relative_speed_gain: float, gain of the speed difference to the vehicle ahead in gap control
+		                            (default: 0.07 1/s)
 		"""
 		self.desired_speed = desired_speed
 		self.max_acceleration = max_acceleration
 		self.min_distance = min_distance
 		self.time_headway = time_headway
+		self.max_deceleration = max_deceleration
+		self.speed_gain = speed_gain
+		self.gap_gain = gap_gain
+		self.relative_speed_gain = relative_speed_gain
+
+	def get_spacing_error(self, ego_vehicle_speed, lead_vehicle_distance):
+		"""
+		Deviation of the distance to the vehicle ahead from the constant time gap policy.
+
+		:param ego_vehicle_speed: float or array, speed of the ego vehicle in meters per second
+		:param lead_vehicle_distance: float or array, distance between the ego vehicle and the lead vehicle in meters
+		:return: float or array, spacing error in meters, positive if the ego vehicle is too far behind
+		"""
+		return lead_vehicle_distance - self.min_distance - self.time_headway * ego_vehicle_speed
 
 	def get_acceleration(self, ego_vehicle_speed, lead_vehicle_speed, lead_vehicle_distance):
 		"""
 		Calculates the acceleration of an automated vehicle based on the Adaptive Cruise Control (ACC) model.
 
+		The smaller of the cruise control (towards the desired speed) and the gap control (towards the constant time
+		gap to the vehicle ahead) is applied. Arrays of the same shape can be given to evaluate many vehicles at once.
+
 		:param ego_vehicle_speed: float, speed of the ego vehicle in meters per second
 		:param lead_vehicle_speed: float, speed of the lead vehicle in meters per second
-		:param lead_vehicle_distance: float, distance between the ego vehicle and the lead vehicle in meters
+		:param lead_vehicle_distance: float, distance between the ego vehicle and the lead vehicle in meters, infinite
+		                              without lead vehicle
 		:return: float, acceleration of the ego vehicle in meters per second squared
 		"""
-		# TODO: Complete the ACC car-following function
-		pass
+		acc_cruise = self.speed_gain * (self.desired_speed - ego_vehicle_speed)
+		with np.errstate(invalid='ignore'):
+			acc_gap = (self.gap_gain * self.get_spacing_error(ego_vehicle_speed, lead_vehicle_distance) +
+			           self.relative_speed_gain * (lead_vehicle_speed - ego_vehicle_speed))
+		acc = np.clip(np.fmin(acc_cruise, acc_gap), -self.max_deceleration, self.max_acceleration)
+		return acc if np.ndim(acc) else float(acc)
+
+
+class CACC(ACC):
+	def __init__(self, desired_speed=25, max_acceleration=3, min_distance=2, time_headway=0.6,
+	             max_deceleration=3, speed_gain=0.4, gap_gain=0.2, relative_speed_gain=0.7, acc_gain=1.0):
+		"""
+		Initializes the Cooperative Adaptive Cruise Control (CACC) model of a platoon. Besides the spacing error and
+		the speed difference, each member feeds forward the acceleration of its predecessor, which is received through
+		vehicle-to-vehicle communication and allows a smaller time headway than ``ACC``.
+
+		:param time_headway: float, desired time headway to the predecessor in seconds (default: 0.6 s)
+		:param gap_gain: float, gain of the spacing error (default: 0.2 1/s^2)
+		:param relative_speed_gain: float, gain of the speed difference to the predecessor (default: 0.7 1/s)
+		:param acc_gain: float, gain of the acceleration of the predecessor (default: 1)
+
+		The other parameters are the same as of ``ACC``.
+		"""
+		super().__init__(desired_speed, max_acceleration, min_distance, time_headway, max_deceleration, speed_gain,
+		                 gap_gain, relative_speed_gain)
+		self.acc_gain = acc_gain
+		self._matrices = {}  # Propagation matrices by platoon size
+
+	def get_propagation_matrix(self, num: int) -> np.ndarray:
+		"""
+		Lower triangular matrix ``L`` with ``L[i, j] = acc_gain ** (i - j)`` which maps the feedback terms of the
+		members to their commanded accelerations. The matrices are cached by size.
+
+		:param num: number of members behind the lead vehicle
+		:return: matrix of shape (num, num)
+		"""
+		matrix = self._matrices.get(num)
+		if matrix is None:
+			power = np.arange(num)
+			matrix = np.tril(self.acc_gain ** np.maximum(power[:, None] - power[None, :], 0))
+			self._matrices[num] = matrix
+		return matrix
+
+	def get_accelerations(self, spacing_error: np.ndarray, relative_speed: np.ndarray, lead_acc: float) -> np.ndarray:
+		"""
+		Calculates the commanded accelerations of all members behind the lead vehicle at once.
+
+		The member ``i`` commands ``u[i] = acc_gain * u[i - 1] + gap_gain * e[i] + relative_speed_gain * dv[i]`` with
+		``u[-1] = lead_acc``. The recursion is solved as ``u = L @ feedback + acc_gain ** (i + 1) * lead_acc`` with
+		``L`` from ``get_propagation_matrix``. The commands are not limited, the limits of the vehicles are applied by
+		the caller.
+
+		:param spacing_error: spacing errors of the members (``get_spacing_error``), ordered from front to rear
+		:param relative_speed: speed of the predecessor minus speed of each member
+		:param lead_acc: acceleration of the lead vehicle
+		:return: commanded accelerations of the members
+		"""
+		num = len(spacing_error)
+		feedback = self.gap_gain * spacing_error + self.relative_speed_gain * relative_speed
+		feedforward = self.acc_gain ** np.arange(1, num + 1) * lead_acc
+		return self.get_propagation_matrix(num) @ feedback + feedforward
 
 
 class MOBIL:
@@ -120,17 +340,17 @@ class MOBIL:
 		"""
 		# Get the speed of the target vehicle, the vehicle immediately in front of it in the adjacent lane,
 		# and the vehicle immediately behind it in the current lane.
-		vehicle_after_lc = copy.copy(vehicle)
+		vehicle_after_lc = copy_vehicle(vehicle)
 		delta_acc_lc_rear = 0
 
 		# If there is a vehicle in front of the target vehicle in the adjacent lane, then copy it.
 		if front_vehicle_adjacent is not None:
-			front_vehicle = copy.copy(front_vehicle_adjacent)
+			front_vehicle = copy_vehicle(front_vehicle_adjacent)
 
 			# If there is a vehicle behind the target vehicle in the current lane, then copy it.
 			if rear_vehicle_adjacent is not None:
 				acc_rear_before = rear_vehicle_adjacent.get_acceleration()
-				rear_vehicle = copy.copy(rear_vehicle_adjacent)
+				rear_vehicle = copy_vehicle(rear_vehicle_adjacent)
 				rear_vehicle.front_vehicle = vehicle_after_lc
 				delta_acc_lc_rear = rear_vehicle.get_acceleration() - acc_rear_before
 			else:
@@ -161,7 +381,7 @@ class MOBIL:
 		if vehicle.rear_vehicle is not None:
 			acc_before = vehicle.rear_vehicle.get_acceleration()
 			if vehicle.front_vehicle is not None:
-				rear_vehicle = copy.copy(vehicle.front_vehicle)
+				rear_vehicle = copy_vehicle(vehicle.front_vehicle)
 				delta_acc_rear = rear_vehicle.get_acceleration() - acc_before
 				delta_acc_rear = min(rear_vehicle.max_acc, delta_acc_rear)
 		return delta_acc_rear
@@ -175,7 +395,7 @@ class MOBIL:
 		:return: None
 		"""
 		# Get the speed of the target vehicle, the vehicle immediately in front of it in the adjacent lane,
-		vehicle_curr = copy.copy(vehicle)
+		vehicle_curr = copy_vehicle(vehicle)
 
 		if front_vehicle_adjacent is None:
 			# vehicle has no front vehicle has no need to change lane
@@ -186,7 +406,7 @@ class MOBIL:
 				# vehicle is not the rear vehicle of the lane
 				return False
 
-			front_vehicle = copy.copy(front_vehicle_adjacent)
+			front_vehicle = copy_vehicle(front_vehicle_adjacent)
 			vehicle_curr.front_vehicle = front_vehicle
 
 			# check safety of front vehicle
@@ -195,8 +415,90 @@ class MOBIL:
 
 			# check safety of rear vehicle
 			if rear_vehicle_adjacent is not None:
-				rear_vehicle = copy.copy(rear_vehicle_adjacent)
+				rear_vehicle = copy_vehicle(rear_vehicle_adjacent)
 				rear_vehicle.front_vehicle = vehicle_curr
 				if rear_vehicle.get_acceleration() < self.brake_threshold:
 					return False
 		return True
+
+	def check_lane_changing_batch(self, ego: VehicleArrays, leader: VehicleArrays, follower: VehicleArrays,
+	                              target_leader: VehicleArrays, target_follower: VehicleArrays
+	                              ) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Vectorized form of ``check_lane_changing`` and ``get_incentive`` for lane changes to one side.
+
+		:param ego: vehicles that are checked for a lane change
+		:param leader: front vehicles of the vehicles in the current lane
+		:param follower: rear vehicles of the vehicles in the current lane
+		:param target_leader: front vehicles of the vehicles in the target lane
+		:param target_follower: rear vehicles of the vehicles in the target lane
+		:return: safety mask and incentives of the lane changes
+		"""
+		with np.errstate(invalid='ignore', over='ignore'):
+			acc_lc = follow_acceleration(ego, target_leader)
+			acc_rear_lc = follow_acceleration(target_follower, ego._replace(exists=np.ones_like(ego.exists)))
+
+			# Vehicles without front vehicle in the target lane have no need to change lane
+			safe = target_leader.exists.copy()
+			# The rear vehicle in the target lane must be behind the vehicle
+			safe &= ~(target_follower.exists & (target_follower.position > ego.position))
+			# Safety of the vehicle itself and of the new rear vehicle
+			safe &= ~(acc_lc < self.brake_threshold)
+			safe &= ~(target_follower.exists & (acc_rear_lc < self.brake_threshold))
+
+			delta_acc_lc_rear = np.where(target_leader.exists & target_follower.exists,
+			                             acc_rear_lc - target_follower.acc, 0)
+			delta_acc_curr_rear = np.where(leader.exists & follower.exists,
+			                               np.minimum(leader.max_acc, leader.acc - follower.acc), 0)
+			incentive = acc_lc - ego.acc + self.politeness_factor * (delta_acc_curr_rear + delta_acc_lc_rear)
+		return safe, incentive
+
+	def get_lane_change_decision(self, ego: VehicleArrays, leader: VehicleArrays, follower: VehicleArrays,
+	                             left_leader: Optional[VehicleArrays] = None,
+	                             left_follower: Optional[VehicleArrays] = None,
+	                             right_leader: Optional[VehicleArrays] = None,
+	                             right_follower: Optional[VehicleArrays] = None) -> LaneChangeDecision:
+		"""
+		Evaluates lane changes to both sides for a group of vehicles at once and chooses the direction. The decision
+		is the same as checking each vehicle with ``check_lane_changing`` and ``get_incentive``.
+
+		:param ego: vehicles that are checked for a lane change
+		:param leader: front vehicles of the vehicles in the current lane
+		:param follower: rear vehicles of the vehicles in the current lane
+		:param left_leader: front vehicles in the left lane, None if there is no left lane
+		:param left_follower: rear vehicles in the left lane, None if there is no left lane
+		:param right_leader: front vehicles in the right lane, None if there is no right lane
+		:param right_follower: rear vehicles in the right lane, None if there is no right lane
+		:return: safety masks, incentives and the chosen direction of each vehicle
+		"""
+		num = len(ego.position)
+		no_lane = (np.zeros(num, dtype=bool), np.zeros(num))
+		safe_left, incentive_left = no_lane if left_leader is None else \
+			self.check_lane_changing_batch(ego, leader, follower, left_leader, left_follower)
+		safe_right, incentive_right = no_lane if right_leader is None else \
+			self.check_lane_changing_batch(ego, leader, follower, right_leader, right_follower)
+		return self.choose_direction(safe_left, incentive_left, safe_right, incentive_right)
+
+	def choose_direction(self, safe_left: np.ndarray, incentive_left: np.ndarray, safe_right: np.ndarray,
+	                     incentive_right: np.ndarray) -> LaneChangeDecision:
+		"""
+		Chooses the direction of the lane change of each vehicle from the results of ``check_lane_changing_batch``
+		for both sides. A side without lane is given as unsafe.
+
+		:param safe_left: safety mask of the lane changes to the left
+		:param incentive_left: incentives of the lane changes to the left
+		:param safe_right: safety mask of the lane changes to the right
+		:param incentive_right: incentives of the lane changes to the right
+		:return: safety masks, incentives and the chosen direction of each vehicle
+		"""
+		num = len(safe_left)
+		# If both sides are safe, the side with the larger incentive is chosen
+		both = safe_left & safe_right
+		left_better = incentive_left > incentive_right
+		go_left = (incentive_left > self.delta) & ((both & left_better) | (safe_left & ~safe_right))
+		go_right = (incentive_right > self.delta) & ((both & ~left_better) | (safe_right & ~safe_left))
+
+		direction = np.full(num, LANE_CHANGE_NONE, dtype=np.int8)
+		direction[go_left] = LANE_CHANGE_LEFT
+		direction[go_right] = LANE_CHANGE_RIGHT
+		return LaneChangeDecision(safe_left, incentive_left, safe_right, incentive_right, direction)
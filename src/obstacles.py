@@ -0,0 +1,116 @@
+import numpy as np
+from typing import List, Union
+
+ArrayLike = Union[float, np.ndarray, List[float]]
+
+
+class ObstacleTable(object):
+	"""
+	Static and timed obstacles of one lane, such as lane ends of a lane drop, stop lines of traffic signals or
+	incident blockages. Obstacles stand still at their positions and are active from their start time (inclusive) to
+	their end time (exclusive).
+
+	The obstacles are kept sorted by position. The positions of the obstacles which are active at the current time of
+	the table are rebuilt only when an activation or deactivation time has passed, so the next active obstacle of all
+	vehicles of the lane is found with one ``np.searchsorted`` per query.
+	"""
+
+	def __init__(self):
+		self.position = np.zeros(0)
+		self.start = np.zeros(0)
+		self.end = np.zeros(0)
+		self.time = 0.0  # Current time of the table, advanced with the simulation
+		self.version = 0  # Changes whenever the active obstacles change
+		self._active = np.zeros(0)  # Sorted positions of the active obstacles
+		self._valid = (np.inf, -np.inf)  # Time interval in which the active obstacles do not change
+
+	def __len__(self):
+		return len(self.position)
+
+	def add(self, position: ArrayLike, start: ArrayLike = -np.inf, end: ArrayLike = np.inf):
+		"""
+		Adds obstacles.
+
+		:param position: positions of the obstacles
+		:param start: times from which the obstacles are active, always active if -inf
+		:param end: times from which the obstacles are inactive again, never if inf
+		"""
+		position, start, end = np.broadcast_arrays(np.atleast_1d(np.asarray(position, dtype=float)),
+		                                           np.asarray(start, dtype=float), np.asarray(end, dtype=float))
+		position = np.concatenate([self.position, position])
+		order = np.argsort(position, kind='stable')
+		self.position = position[order]
+		self.start = np.concatenate([self.start, start])[order]
+		self.end = np.concatenate([self.end, end])[order]
+		self._refresh()
+
+	def add_signal(self, position: float, cycle: float, red: float, offset: float = 0, until: float = 3600):
+		"""
+		Adds the stop line of a fixed-time traffic signal as one timed obstacle per red phase.
+
+		:param position: position of the stop line
+		:param cycle: cycle time of the signal
+		:param red: duration of the red phase at the start of each cycle
+		:param offset: start time of the first cycle
+		:param until: end of the last cycle added
+		"""
+		start = np.arange(offset, until, cycle)
+		self.add(np.full(len(start), position), start, np.minimum(start + red, until))
+
+	def clear(self):
+		"""Removes all obstacles."""
+		self.position = np.zeros(0)
+		self.start = np.zeros(0)
+		self.end = np.zeros(0)
+		self._refresh()
+
+	def set_time(self, time: float):
+		"""
+		Sets the current time of the table, the active obstacles are rebuilt if an event has passed.
+
+		:param time: the current time of the simulation
+		"""
+		self.time = time
+		if not self._valid[0] <= time < self._valid[1]:
+			self._refresh()
+
+	def advance(self, dt: float):
+		"""Advances the current time of the table by one step."""
+		self.set_time(self.time + dt)
+
+	def _refresh(self):
+		"""Rebuilds the active obstacles at the current time and the interval until the next event."""
+		time = self.time
+		active = (self.start <= time) & (time < self.end)
+		self._active = self.position[active]
+		events = np.concatenate([self.start, self.end])
+		past = events[events <= time]
+		future = events[events > time]
+		self._valid = (past.max() if len(past) else -np.inf, future.min() if len(future) else np.inf)
+		self.version += 1
+
+	@property
+	def active_positions(self) -> np.ndarray:
+		"""Sorted positions of the obstacles active at the current time."""
+		return self._active
+
+	def get_next(self, position: np.ndarray) -> np.ndarray:
+		"""
+		Finds the nearest active obstacle at or in front of each position.
+
+		:param position: positions of the vehicles, in any order
+		:return: the positions of the obstacles, inf where there is none
+		"""
+		index = np.searchsorted(self._active, position, side='left')
+		return np.append(self._active, np.inf)[index]
+
+
+def advance_obstacles(lane_list: List, dt: float):
+	"""
+	Advances the obstacle tables of the lanes by one time step.
+
+	:param lane_list: list of lanes
+	:param dt: time step
+	"""
+	for lane_curr in lane_list:
+		lane_curr.obstacles.advance(dt)
@@ -0,0 +1,78 @@
+from models import IDM
+from typing import Dict, NamedTuple, Tuple
+
+
+class VehicleParameters(NamedTuple):
+	"""
+	Immutable behaviour parameters of a vehicle type. Equal parameter sets are interned, so that all vehicles created
+	from the same settings share one object.
+	"""
+	desired_speed_main: float = 25  # default desired speed in main lane
+	desired_speed_ramp: float = 16.66  # default desired speed in ramp
+	jam_distance: float = 10  # default safety distance
+	min_gap: float = 0
+	max_acc: float = 2
+	desired_dec: float = 3
+	reaction_time: float = 0
+	length: float = 5
+	target_pos: float = 0
+
+	@classmethod
+	def from_settings(cls, **settings) -> 'VehicleParameters':
+		"""
+		Creates the parameters from the settings of a vehicle type, e.g. ``settings['Vehicle']['HV']``. Missing
+		settings take the default values, unknown settings are ignored.
+
+		:return: the interned parameters
+		"""
+		return cls(**{field: settings.get(field, default) for field, default in cls._field_defaults.items()}).intern()
+
+	def intern(self) -> 'VehicleParameters':
+		"""
+		Returns the shared object equal to these parameters.
+		"""
+		return _INTERNED.setdefault(self, self)
+
+	def replace(self, **changes) -> 'VehicleParameters':
+		"""
+		Returns interned parameters with the given fields changed.
+		"""
+		return self._replace(**changes).intern()
+
+	def get_idm(self, lane_type: str) -> IDM:
+		"""
+		Returns the IDM model of these parameters on the given lane type. Models are created once and shared.
+
+		:param lane_type: type of the lane, the desired speed of the main lane is used for 'Main' and the desired
+		                  speed of the ramp otherwise
+		:return: the IDM model
+		"""
+		key = (self, lane_type)
+		idm = _IDM_CACHE.get(key)
+		if idm is None:
+			desired_speed = self.desired_speed_main if lane_type == 'Main' else self.desired_speed_ramp
+			idm = IDM(desired_speed, self.reaction_time, self.max_acc, self.desired_dec, self.jam_distance)
+			_IDM_CACHE[key] = idm
+		return idm
+
+
+_INTERNED: Dict[VehicleParameters, VehicleParameters] = {}
+_IDM_CACHE: Dict[Tuple[VehicleParameters, str], IDM] = {}
+
+
+class ParameterField(object):
+	"""
+	Descriptor exposing one field of the shared ``VehicleParameters`` of a vehicle. Setting the attribute gives the
+	vehicle a new interned parameter set instead of modifying the shared one.
+	"""
+
+	def __init__(self, field: str):
+		self.field = field
+
+	def __get__(self, vehicle, owner=None):
+		if vehicle is None:
+			return self
+		return getattr(vehicle.params, self.field)
+
+	def __set__(self, vehicle, value):
+		vehicle.params = vehicle.params.replace(**{self.field: value})
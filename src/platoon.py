@@ -1,8 +1,12 @@
 from typing import List, Optional
 from vehicle import *
+from structure import VehicleList
 
 
-class Platoon(object):
+class Platoon(VehicleList):
+	MIN_DISTANCE = 10  # Minimum safety distance for joining the platoon
+	controller = CACC()  # Cooperative adaptive cruise control of the members behind the lead vehicle
+
 	def __init__(self, lead_vehicle: Vehicle, last_vehicle: Vehicle, max_size: int):
 		"""
 		Initializes a new Platoon object.
@@ -11,14 +15,38 @@ class Platoon(object):
 		:param last_vehicle: The rear vehicle of the platoon.
 		:param max_size: The maximum number of vehicles that can be in the platoon.
 		"""
-		self.MIN_DISTANCE = 10  # Minimum safety distance
-		self.vehicles = [lead_vehicle, last_vehicle]  # List of vehicles in the platoon
-		self.num_vehicle = 2  # number of vehicles in the platoon
-		self.lead_vehicle = lead_vehicle  # The leading vehicle in the platoon
-		self.last_vehicle = last_vehicle  # The last vehicle in the platoon
-		self.front_vehicle = lead_vehicle.front_vehicle  # The front vehicle of the platoon
-		self.rear_vehicle = last_vehicle.rear_vehicle  # The rear vehicle of the platoon
+		super().__init__()
+		self.append(lead_vehicle)
+		self.append(last_vehicle)
+		self.__attach(lead_vehicle)
+		self.__attach(last_vehicle)
 		self.max_size = max_size  # The maximum number of vehicles that can be in the platoon
+		lead_vehicle._state.touch()  # The accelerations of the fleet depend on the platoons
+
+	@property
+	def num_vehicle(self) -> int:
+		"""The number of vehicles in the platoon."""
+		return len(self)
+
+	@property
+	def lead_vehicle(self) -> Vehicle:
+		"""The leading vehicle in the platoon."""
+		return self.head
+
+	@property
+	def last_vehicle(self) -> Vehicle:
+		"""The last vehicle in the platoon."""
+		return self.tail
+
+	@property
+	def front_vehicle(self) -> Optional[Vehicle]:
+		"""The front vehicle of the platoon."""
+		return self.lead_vehicle.front_vehicle
+
+	@property
+	def rear_vehicle(self) -> Optional[Vehicle]:
+		"""The rear vehicle of the platoon."""
+		return self.last_vehicle.rear_vehicle
 
 	def is_empty(self) -> bool:
 		"""
@@ -26,80 +54,173 @@ class Platoon(object):
 		"""
 		return len(self.vehicles) >= 1
 
-	def get_acceleration(self):
+	def get_acceleration(self) -> List[float]:
 		"""
-		Updates the position, speed, and acceleration of each vehicle in the platoon based on the current state of the
-		platoon and the road.
+		Calculates the accelerations of the members of the platoon, the lead vehicle follows its own car-following
+		model and the other members are controlled by ``control``.
+
+		:return: The accelerations of the members ordered from front to rear.
 		"""
-		# Update the acceleration, speed, and position of each vehicle in the platoon
 		acc_lead = self.lead_vehicle.get_acceleration()
-		acc_list = self.control()
-		acc_list.insert(0, acc_lead)
-		return acc_list
-
-	def control(self) -> List[float]:
-		"""Control method of the platoon"""
-		# Placeholder for control method, currently replaced with IDM model
-		acc_list = []
-		for i in range(1, len(self.vehicles)):
-			acc_list.append(self.vehicles[i].get_acceleration())
-		return acc_list
+		return [acc_lead] + self.control(acc_lead).tolist()
+
+	def get_slots(self) -> np.ndarray:
+		"""
+		Returns the slots of the members in the state storage of their fleet, which must be synchronized.
+
+		:return: The slots ordered from front to rear.
+		"""
+		return np.fromiter((vehicle._slot for vehicle in self.vehicles), dtype=np.int64, count=len(self))
+
+	def control(self, lead_acc: Optional[float] = None, vehicles: Optional[VehicleArrays] = None) -> np.ndarray:
+		"""
+		Calculates the accelerations of all members behind the lead vehicle at once with the CACC ``controller``
+		from the spacing errors and speed differences to their predecessors in the platoon and the acceleration of
+		the lead vehicle. The accelerations are clipped to [-desired_dec, max_acc] and limited by obstacles like
+		``follow_acceleration``.
+
+		:param lead_acc: The acceleration of the lead vehicle, ``lead_vehicle.get_acceleration()`` if None.
+		:param vehicles: The members as arrays ordered from front to rear, taken from the fleet of the lead vehicle
+		                 if None.
+		:return: The accelerations of the members behind the lead vehicle ordered from front to rear.
+		"""
+		if vehicles is None:
+			fleet = self.lead_vehicle.lane.fleet
+			fleet.sync_state()
+			vehicles = fleet.get_arrays().take(self.get_slots())
+		if lead_acc is None:
+			lead_acc = self.lead_vehicle.get_acceleration()
+		speed = vehicles.speed[1:]
+		gap = vehicles.position[:-1] - vehicles.position[1:] - vehicles.length[:-1]
+		acc = self.controller.get_accelerations(self.controller.get_spacing_error(speed, gap),
+		                                        vehicles.speed[:-1] - speed, lead_acc)
+		acc = np.clip(acc, -vehicles.desired_dec[1:], vehicles.max_acc[1:])
+		acc_obstacle = obstacle_acceleration(speed, vehicles.obstacle_position[1:] - vehicles.position[1:],
+		                                     vehicles.desired_speed[1:], vehicles.reaction_time[1:],
+		                                     vehicles.max_acc[1:], vehicles.desired_dec[1:])
+		return np.minimum(acc, acc_obstacle)
 
 	def add_vehicle(self, vehicle: Vehicle) -> bool:
 		"""
-		Attempts to add a vehicle to the platoon.
+		Attempts to add a vehicle directly behind the last vehicle or directly in front of the lead vehicle of the
+		platoon.
 
 		:param vehicle: The vehicle to add.
 		:return: True if the vehicle was successfully added, False otherwise.
 		"""
-		if not isinstance(vehicle, CAV):
-			return False
 		if not self.__can_join_platoon(vehicle):
-			raise ValueError("Can't Join Platoon!")
-		self.vehicles.append(vehicle)
-		self.num_vehicle += 1
-		self.last_vehicle = vehicle
-		vehicle.platoon = self
+			return False
+		if vehicle.front_vehicle is self.last_vehicle:
+			self.append(vehicle)
+		else:
+			self.insert_after(vehicle, None)  # The vehicle becomes the lead vehicle
+		self.__attach(vehicle)
+		vehicle._state.touch()
 		return True
 
-	def remove_vehicle(self, vehicle: Vehicle):
+	def remove_vehicle(self, vehicle: Vehicle) -> Optional['Platoon']:
 		"""
-		Attempts to remove a vehicle from the platoon.
+		Removes a vehicle from the platoon, e.g. when it leaves the lane. If the vehicle is in the middle of the
+		platoon, the members behind it form a new platoon so that the members of each platoon stay consecutive.
+		A platoon which is left with less than two members is dissolved.
 
 		:param vehicle: The vehicle to remove.
-		:return:
+		:return: The platoon of the members behind the vehicle, None if there is no such platoon.
 		"""
-		if vehicle == self.lead_vehicle:
-			raise ValueError("Cannot remove the front vehicle")  # cannot remove the front vehicle
+		if vehicle not in self:
+			raise ValueError("Vehicle not in the platoon")
+		rear_member = self.rear_of(vehicle)
+		rear_platoon = None
+		if rear_member is not None and vehicle is not self.lead_vehicle:
+			rear_platoon = self.split(rear_member)
+		self.remove(vehicle)
+		self.__detach(vehicle)
+		vehicle._state.touch()
+		if len(self) < 2:
+			self.dissolve()
+		return rear_platoon
 
-		self.vehicles.remove(vehicle)
-		vehicle.platoon = None  # remove the vehicle's platoon reference
-		self.num_vehicle -= 1
+	def split(self, vehicle: Vehicle) -> Optional['Platoon']:
+		"""
+		Splits the platoon in front of the given vehicle, e.g. when another vehicle has cut in. The vehicle and the
+		members behind it form a new platoon, platoons with less than two members are dissolved.
 
-	def split(self, vehicle: Vehicle):
+		:param vehicle: The first member of the rear platoon.
+		:return: The rear platoon, None if it has less than two members.
 		"""
-		Splits the platoon into two platoons. If the member in the platoon raises a
-		request to leave the platoon, the platoon will be split into two platoons.
+		if vehicle not in self:
+			raise ValueError("Vehicle not in the platoon")
+		if vehicle is self.lead_vehicle:
+			raise ValueError("Cannot split the platoon in front of the lead vehicle")
+
+		members = []
+		while vehicle is not None:
+			members.append(vehicle)
+			vehicle = self.rear_of(vehicle)
+		for member in members:
+			self.remove(member)
+			self.__detach(member)
+		if len(self) < 2:
+			self.dissolve()
+
+		if len(members) < 2:
+			return None
+		rear_platoon = Platoon(members[0], members[1], self.max_size)
+		rear_platoon.MIN_DISTANCE = self.MIN_DISTANCE
+		for member in members[2:]:
+			rear_platoon.append(member)
+			rear_platoon.__attach(member)
+		return rear_platoon
+
+	def merge(self, platoon: 'Platoon') -> bool:
 		"""
-		if vehicle == self.lead_vehicle:
-			raise ValueError("Cannot split the front vehicle")
+		Attempts to append the members of the platoon directly behind the last vehicle of this platoon. The merged
+		platoon must not exceed ``max_size``, the other platoon is empty afterwards.
 
-		if vehicle not in self.vehicles:
-			raise ValueError("Vehicle not in the platoon")
+		:param platoon: The platoon behind this platoon.
+		:return: True if the platoons were merged, False otherwise.
+		"""
+		if platoon is self or len(self) + len(platoon) > self.max_size or \
+				platoon.lead_vehicle.front_vehicle is not self.last_vehicle or \
+				self.get_gap(self.last_vehicle, platoon.lead_vehicle) < self.MIN_DISTANCE:
+			return False
+		members = platoon.vehicles
+		VehicleList.__init__(platoon)
+		for member in members:
+			self.append(member)
+			self.__attach(member)
+		self.lead_vehicle._state.touch()
+		return True
 
-		if vehicle == self.last_vehicle:
-			vehicle.platoon = None
-			self.vehicles.remove(vehicle)
-			self.num_vehicle -= 1
-			self.last_vehicle = self.vehicles[-1]
-			return
+	def dissolve(self):
+		"""
+		Releases all members of the platoon.
+		"""
+		for member in self.vehicles:
+			self.__detach(member)
+		VehicleList.__init__(self)
 
-		if vehicle == self.lead_vehicle:
-			vehicle.platoon = None
-			self.vehicles.remove(vehicle)
-			self.num_vehicle -= 1
-			self.lead_vehicle = self.vehicles[0]
-			return
+	@staticmethod
+	def get_gap(front_vehicle: Vehicle, rear_vehicle: Vehicle) -> float:
+		"""
+		Net distance between two vehicles.
+
+		:param front_vehicle: The vehicle in front.
+		:param rear_vehicle: The vehicle behind.
+		:return: The gap in meters.
+		"""
+		return front_vehicle.position - front_vehicle.length - rear_vehicle.position
+
+	def __attach(self, vehicle: Vehicle):
+		"""Marks a vehicle as a member of the platoon."""
+		vehicle.platoon = self
+		vehicle.in_platoon = True
+
+	@staticmethod
+	def __detach(vehicle: Vehicle):
+		"""Marks a vehicle as not being in a platoon."""
+		vehicle.platoon = None
+		vehicle.in_platoon = False
 
 	def __can_join_platoon(self, vehicle: Vehicle) -> bool:
 		"""
@@ -108,7 +229,7 @@ class Platoon(object):
 		:param vehicle: The vehicle to check.
 		:return: True if the vehicle can join the platoon, False otherwise.
 		"""
-		if vehicle.in_platoon:
+		if vehicle.platoon is not None:
 			# Vehicle is already in a platoon
 			return False
 
@@ -120,8 +241,16 @@ class Platoon(object):
 			# Only cars can join the platoon
 			return False
 
-		if vehicle.position > self.front_vehicle.position - vehicle.length - self.MIN_DISTANCE:
-			# Vehicle's speed is too close to the front vehicle
+		if vehicle.front_vehicle is self.last_vehicle and vehicle.lane is self.last_vehicle.lane:
+			gap = self.get_gap(self.last_vehicle, vehicle)
+		elif vehicle.rear_vehicle is self.lead_vehicle and vehicle.lane is self.lead_vehicle.lane:
+			gap = self.get_gap(vehicle, self.lead_vehicle)
+		else:
+			# Members of a platoon are consecutive vehicles of one lane
+			return False
+
+		if gap < self.MIN_DISTANCE:
+			# Vehicle is too close to the platoon
 			return False
 
 		# All safety checks passed
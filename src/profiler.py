@@ -0,0 +1,94 @@
+import json
+import time
+from typing import Optional
+
+
+class Profiler(object):
+	"""
+	Wall time of the phases of the simulation loop and counters of the hot paths.
+
+	The profiler is off by default. Instrumented code checks ``enabled`` before doing any work, so a disabled profiler
+	costs one attribute lookup per phase or counter. Phases are timed with ``tic`` and ``toc``::
+
+		start = profiler.tic()
+		...
+		profiler.toc('update', start)
+	"""
+	PHASES = ('neighbor_search', 'intention', 'change_lane', 'update', 'boundary', 'recording')
+	COUNTERS = ('get_acceleration', 'copy', 'lane_changes')
+
+	def __init__(self):
+		self.enabled = False
+		self.phase_seconds = dict.fromkeys(self.PHASES, 0.0)
+		self.counters = dict.fromkeys(self.COUNTERS, 0)
+		self.num_vehicles = 0  # Vehicles in the system after the last step
+		self.num_epochs = 0
+
+	def enable(self):
+		self.enabled = True
+
+	def disable(self):
+		self.enabled = False
+
+	def reset(self):
+		"""Resets the timers and counters."""
+		self.phase_seconds = dict.fromkeys(self.PHASES, 0.0)
+		self.counters = dict.fromkeys(self.COUNTERS, 0)
+		self.num_vehicles = 0
+		self.num_epochs = 0
+
+	def tic(self) -> float:
+		"""
+		Starts timing a phase.
+
+		:return: the start time, 0 if the profiler is disabled
+		"""
+		return time.perf_counter() if self.enabled else 0.0
+
+	def toc(self, phase: str, start: float):
+		"""
+		Adds the time since ``start`` to a phase.
+
+		:param phase: name of the phase
+		:param start: the start time returned by ``tic``
+		"""
+		if self.enabled:
+			self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + time.perf_counter() - start
+
+	def count(self, counter: str, n: int = 1):
+		"""
+		Increments a counter.
+
+		:param counter: name of the counter
+		:param n: increment
+		"""
+		if self.enabled:
+			self.counters[counter] = self.counters.get(counter, 0) + n
+
+	def to_dict(self) -> dict:
+		"""Returns a snapshot of the timers and counters."""
+		return {
+			'epochs': self.num_epochs,
+			'vehicles': self.num_vehicles,
+			'total_seconds': sum(self.phase_seconds.values()),
+			'phase_seconds': dict(self.phase_seconds),
+			'counters': dict(self.counters),
+		}
+
+	def dump(self, path: str, epoch: Optional[int] = None):
+		"""
+		Appends a snapshot as one line of JSON to a file, so that periodic dumps of a run form a JSON Lines file.
+
+		:param path: path of the file
+		:param epoch: current epoch of the simulation
+		"""
+		snapshot = self.to_dict()
+		if epoch is not None:
+			snapshot['epoch'] = epoch
+		snapshot['time'] = time.time()
+		with open(path, 'a') as f:
+			f.write(json.dumps(snapshot) + '\n')
+
+
+# Profiler shared by the simulation loop, fleets, vehicles and models
+profiler = Profiler()
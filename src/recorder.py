@@ -0,0 +1,480 @@
+import json
+import os
+import numpy as np
+from structure import VehicleTable
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+def iter_lane_states(lane_list: List) -> Iterator[Tuple[int, np.ndarray, Dict[str, np.ndarray]]]:
+	"""
+	Iterates over the states of the vehicles of each lane.
+
+	:param lane_list: the lanes, the lane id of a vehicle is the index of its lane in the list
+	:return: lane id, vehicle ids and states (position, speed, acc and gap) of each non-empty lane
+	"""
+	for lane_id, lane in enumerate(lane_list):
+		fleet = lane.fleet
+		num = fleet.sync_state()
+		if num == 0:
+			continue
+		state = fleet.state
+		position = state.position[:num]
+		gap = np.full(num, np.nan)  # The front vehicle of the lane has no gap
+		gap[1:] = position[:-1] - position[1:] - state.length[1:num]
+		yield lane_id, state.vehicle_id[:num], {'position': position, 'speed': state.speed[:num],
+		                                         'acc': state.acc[:num], 'gap': gap}
+
+
+class TrajectoryRecorder(object):
+	"""
+	Records the trajectories of all vehicles of a simulation into preallocated NumPy buffers.
+
+	Records are stored in chunks of ``chunk_size`` rows (one row per recorded epoch). Columns are assigned by vehicle id
+	the first time a vehicle is recorded and never change, so the column of a vehicle is stable across lane changes. A
+	chunk only has slots for the columns which are on the road during the chunk, i.e. vehicles retired with ``finalize``
+	take no memory in later chunks, so the size of a chunk does not grow in steady-state runs with open boundaries.
+	Apart from the records, only the id and exit epoch of each column are kept per vehicle. Cells of vehicles which are
+	not on the road have the fill value (NaN, lane id -1).
+	"""
+	FIELDS = ('position', 'speed', 'acc', 'gap', 'lane')
+
+	def __init__(self, lane_list: List, interval: int = 1, chunk_size: int = 256, dtype=np.float32):
+		"""
+		Initializes the recorder.
+
+		:param lane_list: the lanes to record, the lane id of a vehicle is the index of its lane in the list
+		:param interval: number of epochs between two records
+		:param chunk_size: number of records per chunk
+		:param dtype: data type of the recorded states
+		"""
+		self.lane_list = lane_list
+		self.interval = interval
+		self.chunk_size = chunk_size
+		self.dtype = np.dtype(dtype)
+		self.epochs: List[int] = []  # Epoch of each record
+		self.chunks: List[Dict[str, np.ndarray]] = []  # Buffers of each chunk, shape (chunk_size, width)
+		self.chunk_columns: List[np.ndarray] = []  # Column of each slot of each chunk, -1 for unused slots
+		self._num_slots = 0  # Number of used slots of the current chunk
+		self._slot_of = np.full(64, -1, dtype=np.intp)  # Slot of each column in the current chunk, -1 if none
+		self.num_columns = 0  # Number of vehicles recorded so far
+		self._vehicle_ids = np.zeros(64, dtype=np.int64)  # Vehicle id of each column
+		self._column_of = VehicleTable(-1, np.intp)  # Column of each vehicle id which has not been finalized
+		self._exit_epochs = np.full(64, -1, dtype=np.int64)  # Epoch in which each column left the road, -1 if not
+
+	@property
+	def num_records(self) -> int:
+		return len(self.epochs)
+
+	@property
+	def vehicle_ids(self) -> np.ndarray:
+		"""Vehicle id of each column."""
+		return self._vehicle_ids[:self.num_columns]
+
+	@property
+	def exit_epochs(self) -> np.ndarray:
+		"""Epoch in which the vehicle of each column has been retired, -1 if it has not left the road."""
+		return self._exit_epochs[:self.num_columns]
+
+	@property
+	def nbytes(self) -> int:
+		"""Memory used by the buffers in bytes."""
+		return sum(buffer.nbytes for chunk in self.chunks for buffer in chunk.values()) + \
+		       sum(columns.nbytes for columns in self.chunk_columns)
+
+	def _fill_value(self, field: str):
+		return -1 if field == 'lane' else np.nan
+
+	def _new_chunk(self, width: int) -> Dict[str, np.ndarray]:
+		chunk = {}
+		for field in self.FIELDS:
+			dtype = np.int8 if field == 'lane' else self.dtype
+			chunk[field] = np.full((self.chunk_size, width), self._fill_value(field), dtype=dtype)
+		return chunk
+
+	def _get_columns(self, vehicle_ids: np.ndarray) -> np.ndarray:
+		"""
+		Returns the columns of the vehicles and assigns new columns to vehicles recorded for the first time.
+
+		:param vehicle_ids: ids of the vehicles
+		:return: columns of the vehicles
+		"""
+		if len(vehicle_ids) == 0:
+			return vehicle_ids.astype(np.intp)
+		columns = self._column_of.get(vehicle_ids)
+		is_new = columns < 0
+		if is_new.any():
+			new_ids = vehicle_ids[is_new]
+			new_columns = np.arange(self.num_columns, self.num_columns + len(new_ids))
+			self._column_of.update(new_ids, new_columns)
+			columns[is_new] = new_columns
+			self.num_columns += len(new_ids)
+			if self.num_columns > len(self._vehicle_ids):
+				vehicle_ids_all = np.zeros(max(self.num_columns, 2 * len(self._vehicle_ids)), dtype=np.int64)
+				vehicle_ids_all[:len(self._vehicle_ids)] = self._vehicle_ids
+				exit_epochs = np.full(len(vehicle_ids_all), -1, dtype=np.int64)
+				exit_epochs[:len(self._exit_epochs)] = self._exit_epochs
+				self._vehicle_ids = vehicle_ids_all
+				self._exit_epochs = exit_epochs
+			self._vehicle_ids[new_columns] = new_ids
+		return columns
+
+	def _start_chunk(self):
+		"""Appends a new chunk with a slot for each column which has not been finalized."""
+		live = np.flatnonzero(self.exit_epochs < 0)
+		self.chunks.append(self._new_chunk(len(live)))
+		self.chunk_columns.append(live)
+		self._num_slots = len(live)
+		self._slot_of = np.full(max(len(self._slot_of), self.num_columns), -1, dtype=np.intp)
+		self._slot_of[live] = np.arange(len(live))
+
+	def _get_slots(self, columns: np.ndarray) -> np.ndarray:
+		"""
+		Returns the slots of the columns in the current chunk and widens the chunk for columns without a slot.
+
+		:param columns: columns of the vehicles
+		:return: slots of the vehicles
+		"""
+		if self.num_columns > len(self._slot_of):
+			slot_of = np.full(max(self.num_columns, 2 * len(self._slot_of)), -1, dtype=np.intp)
+			slot_of[:len(self._slot_of)] = self._slot_of
+			self._slot_of = slot_of
+		slots = self._slot_of[columns]
+		is_new = slots < 0
+		if not is_new.any():
+			return slots
+		new_slots = np.arange(self._num_slots, self._num_slots + np.count_nonzero(is_new))
+		self._slot_of[columns[is_new]] = new_slots
+		slots[is_new] = new_slots
+		self._num_slots += len(new_slots)
+
+		chunk = self.chunks[-1]
+		width = chunk['position'].shape[1]
+		if width < self._num_slots:
+			new_width = max(self._num_slots, 2 * width)
+			for field in self.FIELDS:
+				buffer = np.full((self.chunk_size, new_width), self._fill_value(field), dtype=chunk[field].dtype)
+				buffer[:, :width] = chunk[field]
+				chunk[field] = buffer
+			chunk_columns = np.full(new_width, -1, dtype=np.intp)
+			chunk_columns[:width] = self.chunk_columns[-1]
+			self.chunk_columns[-1] = chunk_columns
+		self.chunk_columns[-1][new_slots] = columns[is_new]
+		return slots
+
+	def record(self, epoch: int) -> bool:
+		"""
+		Records the states of all vehicles if the epoch is a multiple of the recording interval.
+
+		:param epoch: the current epoch
+		:return: True if the states have been recorded
+		"""
+		if epoch % self.interval != 0:
+			return False
+		row = self.num_records % self.chunk_size
+		if row == 0:
+			self._start_chunk()
+
+		for lane_id, vehicle_ids, states in iter_lane_states(self.lane_list):
+			slots = self._get_slots(self._get_columns(vehicle_ids))
+			chunk = self.chunks[-1]
+			for field, values in states.items():
+				chunk[field][row, slots] = values
+			chunk['lane'][row, slots] = lane_id
+
+		self.epochs.append(epoch)
+		return True
+
+	def finalize(self, vehicle_ids: np.ndarray, epoch: int):
+		"""
+		Marks the trajectories of vehicles which have left the road as complete.
+
+		:param vehicle_ids: ids of the retired vehicles
+		:param epoch: the epoch in which the vehicles have been retired
+		"""
+		vehicle_ids = np.asarray(vehicle_ids, dtype=np.int64)
+		self._exit_epochs[self._get_columns(vehicle_ids)] = epoch
+		self._column_of.discard(vehicle_ids)
+
+	def get(self, field: str, vehicle_ids: Optional[np.ndarray] = None) -> np.ndarray:
+		"""
+		Returns the recorded states as one dense array.
+
+		:param field: one of ``TrajectoryRecorder.FIELDS``
+		:param vehicle_ids: ids of the vehicles to return, all recorded vehicles if None
+		:return: array of shape (num_records, num_vehicles)
+		"""
+		assert field in self.FIELDS
+		if vehicle_ids is None:
+			columns = np.arange(self.num_columns)
+		else:
+			column_of = VehicleTable(-1, np.intp)
+			column_of.assign(self.vehicle_ids, np.arange(self.num_columns))
+			columns = column_of.get(vehicle_ids)
+		dtype = np.int8 if field == 'lane' else self.dtype
+		result = np.full((self.num_records, len(columns)), self._fill_value(field), dtype=dtype)
+		for i, chunk in enumerate(self.chunks):
+			rows = slice(i * self.chunk_size, min((i + 1) * self.chunk_size, self.num_records))
+			chunk_columns = self.chunk_columns[i]
+			slot_of = np.full(self.num_columns + 1, -1, dtype=np.intp)  # The last entry for unknown vehicles
+			used = chunk_columns >= 0
+			slot_of[chunk_columns[used]] = np.flatnonzero(used)
+			slots = slot_of[columns]
+			valid = slots >= 0
+			result[rows, valid] = chunk[field][:rows.stop - rows.start, slots[valid]]
+		return result
+
+
+class TrajectoryWriter(object):
+	"""
+	Streams the trajectories of all vehicles to a directory while the simulation runs.
+
+	Records are buffered in memory and flushed every ``chunk_size`` records. A chunk is stored as one ``.npy`` file
+	per field in long format, i.e. one entry per vehicle and record, together with the epochs of its records and
+	the offsets of each record in the entries. ``manifest.json`` describes all flushed chunks and is rewritten
+	after each flush, so the output of an interrupted run can still be read with ``TrajectoryReader``.
+	"""
+	FIELDS = ('vehicle_id', 'lane', 'position', 'speed', 'acc', 'gap')
+	MANIFEST = 'manifest.json'
+
+	def __init__(self, directory: str, lane_list: List, interval: int = 1, chunk_size: int = 1024,
+	             dtype=np.float32):
+		"""
+		Initializes the writer.
+
+		:param directory: the output directory, created if it does not exist
+		:param lane_list: the lanes to record, the lane id of a vehicle is the index of its lane in the list
+		:param interval: number of epochs between two records
+		:param chunk_size: number of records per chunk
+		:param dtype: data type of the recorded states
+		"""
+		os.makedirs(directory, exist_ok=True)
+		self.directory = directory
+		self.lane_list = lane_list
+		self.interval = interval
+		self.chunk_size = chunk_size
+		self.dtype = np.dtype(dtype)
+		self.num_records = 0
+		self.chunks: List[dict] = []  # Manifest entries of the flushed chunks
+		self._buffers: Dict[str, List[np.ndarray]] = {field: [] for field in self.FIELDS}
+		self._epochs: List[int] = []
+		self._counts: List[int] = []  # Number of entries of each buffered record
+		self._exits: List[np.ndarray] = []  # Vehicle ids and epochs of the retired vehicles
+
+	def _dtype(self, field: str):
+		if field == 'vehicle_id':
+			return np.int32
+		elif field == 'lane':
+			return np.int8
+		return self.dtype
+
+	def record(self, epoch: int) -> bool:
+		"""
+		Records the states of all vehicles if the epoch is a multiple of the recording interval.
+
+		:param epoch: the current epoch
+		:return: True if the states have been recorded
+		"""
+		if epoch % self.interval != 0:
+			return False
+		count = 0
+		for lane_id, vehicle_ids, states in iter_lane_states(self.lane_list):
+			num = len(vehicle_ids)
+			self._buffers['vehicle_id'].append(vehicle_ids.astype(np.int32))
+			self._buffers['lane'].append(np.full(num, lane_id, dtype=np.int8))
+			for field, values in states.items():
+				self._buffers[field].append(values.astype(self.dtype))
+			count += num
+		self._epochs.append(epoch)
+		self._counts.append(count)
+		self.num_records += 1
+		if len(self._epochs) == self.chunk_size:
+			self.flush()
+		return True
+
+	def finalize(self, vehicle_ids: np.ndarray, epoch: int):
+		"""
+		Marks the trajectories of vehicles which have left the road as complete. The exits are written with the next
+		chunk.
+
+		:param vehicle_ids: ids of the retired vehicles
+		:param epoch: the epoch in which the vehicles have been retired
+		"""
+		vehicle_ids = np.asarray(vehicle_ids, dtype=np.int64)
+		self._exits.append(np.stack([vehicle_ids, np.full(len(vehicle_ids), epoch, dtype=np.int64)], axis=1))
+
+	def flush(self):
+		"""
+		Writes the buffered records as a new chunk and updates the manifest.
+		"""
+		if not self._epochs and not self._exits:
+			return
+		index = len(self.chunks)
+		prefix = 'chunk_{:05d}'.format(index)
+		for field in self.FIELDS:
+			buffer = self._buffers[field]
+			values = np.concatenate(buffer) if buffer else np.zeros(0, dtype=self._dtype(field))
+			np.save(os.path.join(self.directory, '{}_{}.npy'.format(prefix, field)), values)
+		vehicle_ids = np.concatenate(self._buffers['vehicle_id']) if self._buffers['vehicle_id'] else np.zeros(0)
+		offsets = np.zeros(len(self._counts) + 1, dtype=np.int64)
+		np.cumsum(self._counts, out=offsets[1:])
+		np.save(os.path.join(self.directory, prefix + '_offsets.npy'), offsets)
+		np.save(os.path.join(self.directory, prefix + '_epochs.npy'), np.array(self._epochs, dtype=np.int64))
+		exits = np.concatenate(self._exits) if self._exits else np.zeros((0, 2), dtype=np.int64)
+		np.save(os.path.join(self.directory, prefix + '_exits.npy'), exits)
+
+		self.chunks.append({
+			'prefix': prefix,
+			'num_records': len(self._epochs),
+			'num_entries': int(offsets[-1]),
+			'first_epoch': self._epochs[0] if self._epochs else -1,
+			'last_epoch': self._epochs[-1] if self._epochs else -1,
+			'min_vehicle_id': int(vehicle_ids.min()) if len(vehicle_ids) else -1,
+			'max_vehicle_id': int(vehicle_ids.max()) if len(vehicle_ids) else -1,
+			'num_exits': len(exits),
+		})
+		self._write_manifest()
+		self._buffers = {field: [] for field in self.FIELDS}
+		self._epochs = []
+		self._counts = []
+		self._exits = []
+
+	def _write_manifest(self):
+		manifest = {
+			'fields': list(self.FIELDS),
+			'dtypes': {field: np.dtype(self._dtype(field)).str for field in self.FIELDS},
+			'interval': self.interval,
+			'num_lanes': len(self.lane_list),
+			'num_records': sum(chunk['num_records'] for chunk in self.chunks),
+			'chunks': self.chunks,
+		}
+		path = os.path.join(self.directory, self.MANIFEST)
+		with open(path + '.tmp', 'w') as f:
+			json.dump(manifest, f, indent=2)
+		os.replace(path + '.tmp', path)
+
+	def close(self):
+		"""
+		Flushes the remaining records. The writer can not be used afterwards.
+		"""
+		self.flush()
+		self._write_manifest()
+
+
+class TrajectoryReader(object):
+	"""
+	Lazily reads trajectories written by ``TrajectoryWriter``.
+
+	Chunk files are memory-mapped, and chunks outside the requested time window or vehicle id range are not opened,
+	so slices of long runs can be read without loading the whole output.
+	"""
+
+	def __init__(self, directory: str):
+		"""
+		Opens the output of a run.
+
+		:param directory: the output directory of ``TrajectoryWriter``
+		"""
+		self.directory = directory
+		with open(os.path.join(directory, TrajectoryWriter.MANIFEST), 'r') as f:
+			self.manifest = json.load(f)
+		self.chunks = self.manifest['chunks']
+		self.fields = self.manifest['fields']
+
+	@property
+	def num_records(self) -> int:
+		return self.manifest['num_records']
+
+	def _load(self, chunk: dict, field: str) -> np.ndarray:
+		path = os.path.join(self.directory, '{}_{}.npy'.format(chunk['prefix'], field))
+		return np.load(path, mmap_mode='r')
+
+	@property
+	def epochs(self) -> np.ndarray:
+		"""Epoch of each record."""
+		epoch_list = [np.asarray(self._load(chunk, 'epochs')) for chunk in self.chunks]
+		return np.concatenate(epoch_list) if epoch_list else np.zeros(0, dtype=np.int64)
+
+	@property
+	def exits(self) -> Tuple[np.ndarray, np.ndarray]:
+		"""Ids of the vehicles which have left the road and the epochs in which they have been retired."""
+		exit_list = [np.asarray(self._load(chunk, 'exits')) for chunk in self.chunks if chunk.get('num_exits')]
+		exits = np.concatenate(exit_list) if exit_list else np.zeros((0, 2), dtype=np.int64)
+		return exits[:, 0], exits[:, 1]
+
+	def select(self, fields=None, vehicle_ids=None, lanes=None, start_epoch: Optional[int] = None,
+	           end_epoch: Optional[int] = None) -> Dict[str, np.ndarray]:
+		"""
+		Reads the entries of the given vehicles, lanes and time window in long format.
+
+		:param fields: the fields to read, all fields if None
+		:param vehicle_ids: ids of the vehicles to read, all vehicles if None
+		:param lanes: lane ids to read, all lanes if None
+		:param start_epoch: first epoch to read (inclusive), from the beginning if None
+		:param end_epoch: last epoch to read (exclusive), until the end if None
+		:return: arrays of the entries for each field and the epoch of each entry (key 'epoch')
+		"""
+		fields = self.fields if fields is None else list(fields)
+		if vehicle_ids is not None:
+			vehicle_ids = np.asarray(vehicle_ids)
+		start_epoch = -np.inf if start_epoch is None else start_epoch
+		end_epoch = np.inf if end_epoch is None else end_epoch
+
+		result = {field: [] for field in fields + ['epoch']}
+		for chunk in self.chunks:
+			if chunk['num_entries'] == 0 or chunk['last_epoch'] < start_epoch or chunk['first_epoch'] >= end_epoch:
+				continue
+			if vehicle_ids is not None and (vehicle_ids.max() < chunk['min_vehicle_id'] or
+			                                vehicle_ids.min() > chunk['max_vehicle_id']):
+				continue
+
+			# Restrict the entries to the records in the time window
+			epochs = np.asarray(self._load(chunk, 'epochs'))
+			offsets = np.asarray(self._load(chunk, 'offsets'))
+			first, last = np.searchsorted(epochs, [start_epoch, end_epoch], side='left')
+			entries = slice(offsets[first], offsets[last])
+			if entries.start == entries.stop:
+				continue
+			mask = np.ones(entries.stop - entries.start, dtype=bool)
+			if vehicle_ids is not None:
+				mask &= np.isin(self._load(chunk, 'vehicle_id')[entries], vehicle_ids)
+			if lanes is not None:
+				mask &= np.isin(self._load(chunk, 'lane')[entries], lanes)
+
+			for field in fields:
+				result[field].append(np.asarray(self._load(chunk, field)[entries])[mask])
+			entry_epochs = np.repeat(epochs[first:last], np.diff(offsets[first:last + 1]))
+			result['epoch'].append(entry_epochs[mask])
+
+		for field in result:
+			if result[field]:
+				result[field] = np.concatenate(result[field])
+			else:
+				dtype = np.int64 if field == 'epoch' else np.dtype(self.manifest['dtypes'][field])
+				result[field] = np.zeros(0, dtype=dtype)
+		return result
+
+	def get(self, field: str, vehicle_ids, start_epoch: Optional[int] = None,
+	        end_epoch: Optional[int] = None) -> np.ndarray:
+		"""
+		Reads one field of the given vehicles as a dense array like ``TrajectoryRecorder.get``.
+
+		:param field: the field to read
+		:param vehicle_ids: ids of the vehicles to read
+		:param start_epoch: first epoch to read (inclusive), from the beginning if None
+		:param end_epoch: last epoch to read (exclusive), until the end if None
+		:return: array of shape (num_records, num_vehicles), NaN (lane id -1) where a vehicle was not recorded
+		"""
+		vehicle_ids = np.asarray(vehicle_ids)
+		epochs = self.epochs
+		lo = 0 if start_epoch is None else np.searchsorted(epochs, start_epoch, side='left')
+		hi = len(epochs) if end_epoch is None else np.searchsorted(epochs, end_epoch, side='left')
+		entries = self.select([field, 'vehicle_id'], vehicle_ids, None, start_epoch, end_epoch)
+
+		dtype = np.dtype(self.manifest['dtypes'][field])
+		fill_value = -1 if field == 'lane' else np.nan
+		result = np.full((hi - lo, len(vehicle_ids)), fill_value, dtype=dtype)
+		order = np.argsort(vehicle_ids)
+		columns = order[np.searchsorted(vehicle_ids[order], entries['vehicle_id'])]
+		rows = np.searchsorted(epochs[lo:hi], entries['epoch'])
+		result[rows, columns] = entries[field]
+		return result
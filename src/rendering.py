@@ -0,0 +1,169 @@
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from recorder import TrajectoryRecorder, TrajectoryReader
+from typing import Dict, Iterator, Optional, Sequence, Tuple, Union
+
+Source = Union[TrajectoryRecorder, TrajectoryReader]
+# Fields which are averaged over the samples of a cell, 'density' is derived from the number of samples
+MEAN_FIELDS = ('speed', 'acc', 'gap')
+LABELS = {'speed': 'Speed (m/s)', 'acc': 'Acceleration (m/s$^2$)', 'gap': 'Gap (m)', 'density': 'Density (veh/km)'}
+
+
+def iter_samples(source: Source, fields: Sequence[str], lanes: Optional[Sequence[int]] = None) \
+		-> Iterator[Dict[str, np.ndarray]]:
+	"""
+	Iterates over the recorded samples in long format, one chunk of the recorder or of the output on disk at a time,
+	so the memory does not depend on the length of the run.
+
+	:param source: ``TrajectoryRecorder`` or ``TrajectoryReader``
+	:param fields: the fields to read besides the epoch
+	:param lanes: lane ids to read, all lanes if None
+	:return: arrays of the samples of each field and the epoch of each sample (key 'epoch')
+	"""
+	if isinstance(source, TrajectoryReader):
+		for chunk in source.chunks:
+			if chunk['num_entries']:
+				yield source.select(fields, lanes=lanes, start_epoch=chunk['first_epoch'],
+				                    end_epoch=chunk['last_epoch'] + 1)
+		return
+	epochs = np.asarray(source.epochs)
+	for i, chunk in enumerate(source.chunks):
+		num_rows = min(source.chunk_size, source.num_records - i * source.chunk_size)
+		lane = chunk['lane'][:num_rows]
+		mask = lane >= 0 if lanes is None else np.isin(lane, lanes)
+		rows, slots = np.nonzero(mask)
+		samples = {'epoch': epochs[i * source.chunk_size + rows]}
+		for field in fields:
+			if field == 'vehicle_id':
+				samples[field] = source.vehicle_ids[source.chunk_columns[i][slots]]
+			else:
+				samples[field] = chunk[field][rows, slots]
+		yield samples
+
+
+def get_position_range(source: Source, lanes: Optional[Sequence[int]] = None) -> Tuple[float, float]:
+	"""Smallest and largest recorded position."""
+	low, high = np.inf, -np.inf
+	for samples in iter_samples(source, ['position'], lanes):
+		if len(samples['position']):
+			low = min(low, float(np.nanmin(samples['position'])))
+			high = max(high, float(np.nanmax(samples['position'])))
+	return low, high
+
+
+def space_time_histogram(source: Source, field: str = 'speed', time_bins: int = 200, space_bins: int = 200,
+                         space_range: Optional[Tuple[float, float]] = None,
+                         lanes: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+	"""
+	Bins the recorded samples into space-time cells with ``np.histogram2d``, in one pass over the samples.
+
+	:param source: ``TrajectoryRecorder`` or ``TrajectoryReader``
+	:param field: one of ``MEAN_FIELDS`` for the mean of the samples of each cell (NaN for empty cells), or
+	              'density' for the mean number of vehicles per km and lane in each cell
+	:param time_bins: number of cells along the time axis
+	:param space_bins: number of cells along the road
+	:param space_range: the positions covered, the range of the recorded positions if None
+	:param lanes: lane ids to include, all lanes if None
+	:return: values of shape (time_bins, space_bins), edges of the time cells in epochs and of the space cells
+	"""
+	assert field in MEAN_FIELDS + ('density',)
+	epochs = np.asarray(source.epochs)
+	if space_range is None:
+		space_range = get_position_range(source, lanes)
+	time_edges = np.linspace(epochs[0], epochs[-1] + 1, time_bins + 1) if len(epochs) else np.arange(time_bins + 1)
+	space_edges = np.linspace(space_range[0], space_range[1], space_bins + 1)
+
+	count = np.zeros((time_bins, space_bins))
+	total = np.zeros((time_bins, space_bins))
+	fields = ['position'] if field == 'density' else ['position', field]
+	for samples in iter_samples(source, fields, lanes):
+		count += np.histogram2d(samples['epoch'], samples['position'], [time_edges, space_edges])[0]
+		if field != 'density':
+			total += np.histogram2d(samples['epoch'], samples['position'], [time_edges, space_edges],
+			                        weights=samples[field])[0]
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		if field == 'density':
+			# Samples per record of the cell, divided by the length of the cell and the number of lanes
+			num_records = np.histogram(epochs, time_edges)[0]
+			num_lanes = len(lanes) if lanes is not None else max(1, _count_lanes(source))
+			values = count / num_records[:, None] / (np.diff(space_edges) / 1000) / num_lanes
+		else:
+			values = total / count
+	return values, time_edges, space_edges
+
+
+def _count_lanes(source: Source) -> int:
+	if isinstance(source, TrajectoryRecorder):
+		return len(source.lane_list)
+	return source.manifest['num_lanes']
+
+
+def sample_trajectories(source: Source, num_vehicles: int, decimation: int = 1,
+                        seed: Optional[int] = 0) -> LineCollection:
+	"""
+	Builds the trajectories of a random sample of the vehicles as one ``LineCollection``.
+
+	:param source: ``TrajectoryRecorder`` or ``TrajectoryReader``
+	:param num_vehicles: number of vehicles to draw
+	:param decimation: every ``decimation``-th record is drawn
+	:param seed: seed of the sample
+	:return: the lines in epochs and positions
+	"""
+	if isinstance(source, TrajectoryRecorder):
+		vehicle_ids = source.vehicle_ids
+	else:
+		vehicle_ids = np.unique(np.concatenate([samples['vehicle_id']
+		                                        for samples in iter_samples(source, ['vehicle_id'])] or [[]]))
+	vehicle_ids = np.asarray(vehicle_ids, dtype=np.int64)
+	if len(vehicle_ids) > num_vehicles:
+		vehicle_ids = np.sort(np.random.default_rng(seed).choice(vehicle_ids, num_vehicles, replace=False))
+	epochs = np.asarray(source.epochs)[::decimation]
+	position = source.get('position', vehicle_ids)[::decimation]
+	segments = [np.column_stack([epochs[~np.isnan(column)], column[~np.isnan(column)]]) for column in position.T]
+	return LineCollection([segment for segment in segments if len(segment) > 1], colors='k', linewidths=0.5,
+	                      alpha=0.6)
+
+
+def render_space_time(source: Source, file, fields: Sequence[str] = ('speed', 'density', 'acc'),
+                      time_bins: int = 200, space_bins: int = 200, dt: float = 1,
+                      space_range: Optional[Tuple[float, float]] = None, lanes: Optional[Sequence[int]] = None,
+                      num_overlay: int = 0, decimation: int = 10, dpi: int = 100):
+	"""
+	Renders space-time heatmaps of the given fields, one panel per field, to an image file without a display. The
+	time depends on the number of samples and the number of cells, not on the number of vehicles.
+
+	:param source: ``TrajectoryRecorder`` or ``TrajectoryReader``
+	:param file: path or file object of the image, the format is given by the extension
+	:param fields: fields of ``space_time_histogram``
+	:param time_bins: number of cells along the time axis
+	:param space_bins: number of cells along the road
+	:param dt: duration of an epoch, the time axis is in seconds
+	:param space_range: the positions covered, the range of the recorded positions if None
+	:param lanes: lane ids to include, all lanes if None
+	:param num_overlay: number of sampled vehicles whose trajectories are drawn over the heatmaps
+	:param decimation: every ``decimation``-th record of the overlaid trajectories is drawn
+	:param dpi: resolution of the image
+	"""
+	if space_range is None:
+		space_range = get_position_range(source, lanes)
+	figure = Figure(figsize=(10, 3.5 * len(fields)))
+	FigureCanvasAgg(figure)
+	overlay = sample_trajectories(source, num_overlay, decimation) if num_overlay else None
+	for k, field in enumerate(fields):
+		axes = figure.add_subplot(len(fields), 1, k + 1)
+		values, time_edges, space_edges = space_time_histogram(source, field, time_bins, space_bins, space_range,
+		                                                       lanes)
+		image = axes.imshow(values.T, origin='lower', aspect='auto', interpolation='nearest',
+		                    extent=(time_edges[0] * dt, time_edges[-1] * dt, space_edges[0], space_edges[-1]),
+		                    cmap='RdYlGn' if field == 'speed' else 'viridis')
+		figure.colorbar(image, ax=axes, label=LABELS[field])
+		if overlay is not None:
+			lines = LineCollection([segment * (dt, 1) for segment in overlay.get_segments()], colors='k',
+			                       linewidths=0.5, alpha=0.6)
+			axes.add_collection(lines)
+		axes.set_ylabel('Position (m)')
+	axes.set_xlabel('Time (s)')
+	figure.savefig(file, dpi=dpi, bbox_inches='tight')
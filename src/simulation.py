@@ -4,77 +4,281 @@ from platoon import *
 from lane import *
 from vehicle import *
 from fleet import *
+from recorder import TrajectoryRecorder, TrajectoryWriter, TrajectoryReader
+from boundary import OpenBoundary
+from metrics import OnlineMetrics, LoopDetectors, EdieCells
+from rendering import render_space_time
+from obstacles import advance_obstacles
 from tqdm import tqdm
 import numpy as np
-import matplotlib.pyplot as plt
 import utils
+import equilibrium
+import lane_change
+from profiler import profiler
 import os
+from typing import List, Optional
 
 
-def main():
-	init_speed = 20
-	num_epochs = 1000
-	dt = 0.1
+def build_scenario(settings: dict, num_vehicles: int = 1000, permeability: float = 0,
+                   arrival_rate: float = 1, flow: Optional[float] = None,
+                   distribution: str = 'poisson', density: Optional[float] = None,
+                   platoon_size: Optional[int] = None, integrator: str = 'ballistic') -> List[Lane]:
+	"""
+	Generates the lanes and the initial vehicles of a simulation.
 
+	:param settings: the settings loaded from 'settings.json'
+	:param num_vehicles: number of attempts to generate a vehicle, or the maximum number of vehicles if ``flow`` is
+	                     given
+	:param permeability: penetration rate of CAVs
+	:param arrival_rate: rate of the exponential headway distribution of ``utils.generate_vehicle_main``
+	:param flow: flow per lane in vehicles per hour, if given the lanes are filled in bulk by
+	             ``utils.generate_vehicles`` instead of one vehicle at a time
+	:param distribution: headway distribution used with ``flow``
+	:param density: density per lane in vehicles per kilometer, if given the lanes are filled in the IDM
+	                equilibrium of this density by ``equilibrium.initialize_equilibrium`` and ``num_vehicles`` is
+	                ignored
+	:param platoon_size: maximum number of CAVs in a platoon, None to disable platoon formation
+	:param integrator: integration scheme of the vehicle updates, one of ``integration.INTEGRATORS``
+	:return: list of lanes
+	"""
 	# Generate and initialize lanes
 	lane_list = utils.generate_scenario()
+	for lane_curr in lane_list:
+		lane_curr.fleet.platoon_size = platoon_size
+		lane_curr.fleet.integrator = integrator
 
 	# Generate and initialize vehicles
-	for i in range(1000):
-		utils.generate_vehicle_main(lane_list, settings['Vehicle'])
+	if density is not None:
+		equilibrium.initialize_equilibrium(lane_list, settings['Vehicle'], density=density, permeability=permeability)
+	elif flow is not None:
+		utils.generate_vehicles(lane_list, settings['Vehicle'], flow, permeability, distribution,
+		                        max_vehicles=num_vehicles)
+	else:
+		for i in range(num_vehicles):
+			utils.generate_vehicle_main(lane_list, settings['Vehicle'], permeability, arrival_rate)
+	return lane_list
 
-	# Run simulation
-	vehicle_total_list = []
+
+def step(lane_list: List[Lane], dt: float):
+	"""
+	Advances the simulation by one epoch: lane-changing intention, lane changing and car-following. The phases are
+	timed by ``profiler`` if it is enabled.
+
+	:param lane_list: list of lanes
+	:param dt: time step
+	"""
+	change_lanes(lane_list)
+
+	start = profiler.tic()
 	for lane_curr in lane_list:
-		for vehicle in lane_curr.fleet.vehicles:
-			vehicle_total_list.append(vehicle)
+		lane_curr.fleet.update_vehicles(dt)
+	profiler.toc('update', start)
+	advance_obstacles(lane_list, dt)
+	count_epoch(lane_list)
 
-	position_record = np.zeros((num_epochs, len(vehicle_total_list)))
-	velocity_record = np.zeros((num_epochs, len(vehicle_total_list)))
-	acceleration_record = np.zeros((num_epochs, len(vehicle_total_list)))
-	gap_record = np.zeros((num_epochs, len(vehicle_total_list)))
 
-	for epoch in tqdm(range(num_epochs)):
-		for lane_curr in lane_list:
-			front_veh_list_left, rear_veh_list_left =\
-				lane_curr.fleet.get_adjacent_vehicle_list(lane_curr.left_lane)
-			front_veh_list_right, rear_veh_list_right =\
-				lane_curr.fleet.get_adjacent_vehicle_list(lane_curr.right_lane)
-			lane_curr.fleet.get_lane_change_intention(front_veh_list_left, front_veh_list_right,
-			                                          rear_veh_list_left, rear_veh_list_right)
+def change_lanes(lane_list: List[Lane]) -> List[Vehicle]:
+	"""
+	Lane-changing phases of an epoch: neighbor search, lane-changing intention and lane changing. The intents of all
+	lanes are resolved and performed together, see ``lane_change.change_lanes``.
+
+	:param lane_list: list of lanes
+	:return: the vehicles which have changed lanes
+	"""
+	start = profiler.tic()
+	adjacent_list = [lane_curr.fleet.get_adjacent_vehicle_list(lane_curr.left_lane) +
+	                 lane_curr.fleet.get_adjacent_vehicle_list(lane_curr.right_lane) for lane_curr in lane_list]
+	profiler.toc('neighbor_search', start)
+
+	start = profiler.tic()
+	for lane_curr, adjacent in zip(lane_list, adjacent_list):
+		front_veh_list_left, rear_veh_list_left, front_veh_list_right, rear_veh_list_right = adjacent
+		lane_curr.fleet.get_lane_change_intention(front_veh_list_left, front_veh_list_right,
+		                                          rear_veh_list_left, rear_veh_list_right)
+	profiler.toc('intention', start)
 
+	start = profiler.tic()
+	moved = lane_change.change_lanes([lane_curr.fleet for lane_curr in lane_list])
+	profiler.toc('change_lane', start)
+	return moved
+
+
+def count_epoch(lane_list: List[Lane]):
+	"""
+	Counts an epoch and the number of vehicles in the profiler if it is enabled.
+
+	:param lane_list: list of lanes
+	"""
+	if profiler.enabled:
+		profiler.num_epochs += 1
+		profiler.num_vehicles = sum(len(lane_curr.fleet) for lane_curr in lane_list)
+
+
+class CrossSection(object):
+	"""
+	Counts the vehicles passing a cross-section and averages the speeds of all vehicles over the epochs of a run.
+	Vehicles which start downstream of the cross-section are not counted. Only the ids of the vehicles on the road
+	downstream are kept, so the memory does not grow with the number of retired vehicles.
+	"""
+
+	def __init__(self, lane_list: List[Lane], position: float):
+		"""
+		:param lane_list: list of lanes with their initial vehicles
+		:param position: position of the cross-section
+		"""
+		self.position = position
+		self.num_passed = 0
+		self.speed_sum = 0.0
+		self.speed_count = 0
+		self.downstream = self.get_downstream(lane_list)  # Ids of the vehicles on the road downstream
+
+	def get_downstream(self, lane_list: List[Lane]) -> np.ndarray:
+		"""
+		Returns the ids of the vehicles downstream of the cross-section.
+
+		:param lane_list: list of lanes
+		"""
+		downstream = [np.zeros(0, dtype=np.int64)]
 		for lane_curr in lane_list:
-			lane_curr.fleet.change_lane()
+			num = lane_curr.fleet.sync_state()
+			state = lane_curr.fleet.state
+			downstream.append(state.vehicle_id[:num][state.position[:num] >= self.position])
+		return np.concatenate(downstream)
+
+	def update(self, lane_list: List[Lane], weight: float = 1):
+		"""
+		Counts the vehicles which have passed the cross-section in the last epoch and adds the speeds of all vehicles.
 
+		:param lane_list: list of lanes
+		:param weight: weight of the speeds of the epoch, e.g. its duration if the epochs differ in length
+		"""
 		for lane_curr in lane_list:
-			lane_curr.fleet.update_vehicles(dt)
-
-		for i, vehicle in enumerate(vehicle_total_list):
-			position_record[epoch, i] = vehicle.position
-			velocity_record[epoch, i] = vehicle.speed
-			acceleration_record[epoch, i] = vehicle.acc
-			if vehicle.front_vehicle is not None:
-				gap_record[epoch, i] = vehicle.front_vehicle.position - vehicle.position - vehicle.length
-
-	# plot position, speed, and acceleration of each vehicle in separate axes
-	fig, axs = plt.subplots(4, 1, figsize=(10, 12))
-	for i, vehicle in enumerate(vehicle_total_list):
-		axs[0].plot(position_record[:, i])
-		axs[1].plot(velocity_record[:, i])
-		axs[2].plot(acceleration_record[:, i])
-		axs[3].plot(gap_record[:, i])
-	axs[0].set_title('Position')
-	axs[1].set_title('Velocity')
-	axs[2].set_title('Acceleration')
-	axs[3].set_title('Gap')
-
-	# save figure as png in 'figure/' directory without white space
-	# if figure directory does not exist, create one
+			num = lane_curr.fleet.sync_state()
+			state = lane_curr.fleet.state
+			speed = state.speed[:num]
+			self.speed_sum += float(speed.sum()) * weight
+			self.speed_count += num * weight
+		# Vehicles move forward only, so the vehicles downstream which were not before have passed
+		downstream = self.get_downstream(lane_list)
+		self.num_passed += int(np.count_nonzero(~np.isin(downstream, self.downstream)))
+		self.downstream = downstream
+
+	@property
+	def mean_speed(self) -> float:
+		"""Mean speed of the vehicles over the counted epochs."""
+		return self.speed_sum / self.speed_count if self.speed_count else float('nan')
+
+
+def run_simulation(lane_list: List[Lane], num_epochs: int, dt: float, recorder=None, progress: bool = False,
+                   measure_position: Optional[float] = None, profile_output: Optional[str] = None,
+                   profile_interval: int = 100, boundary: Optional[OpenBoundary] = None,
+                   metrics: Optional[OnlineMetrics] = None) -> dict:
+	"""
+	Runs the simulation and returns summary metrics.
+
+	:param lane_list: list of lanes with their initial vehicles
+	:param num_epochs: number of epochs
+	:param dt: time step
+	:param recorder: ``TrajectoryRecorder`` or ``TrajectoryWriter`` to record trajectories, None to skip recording
+	:param progress: whether to show a progress bar
+	:param measure_position: position of the cross-section where the throughput is counted, the middle of the first
+	                         lane if None
+	:param profile_output: path of a JSON Lines file, if given the profiler is enabled and a snapshot of it is
+	                       appended every ``profile_interval`` epochs and at the end of the run
+	:param profile_interval: number of epochs between two snapshots of the profiler
+	:param boundary: open boundaries retiring and inserting vehicles after each step, None for a closed road
+	:param metrics: online metrics updated after each step, their last incomplete period is emitted at the end
+	:return: throughput (veh/h), mean speed (m/s), number of lane changes and number of vehicles
+	"""
+	if profile_output is not None:
+		profiler.enable()
+	if measure_position is None:
+		measure_position = lane_list[0].start + lane_list[0].length / 2
+	cross_section = CrossSection(lane_list, measure_position)
+
+	for epoch in tqdm(range(num_epochs), disable=not progress):
+		step(lane_list, dt)
+		if boundary is not None:
+			start = profiler.tic()
+			boundary.update(epoch, dt)
+			profiler.toc('boundary', start)
+
+		cross_section.update(lane_list)
+		if metrics is not None:
+			metrics.update(lane_list, dt)
+
+		if recorder is not None:
+			start = profiler.tic()
+			recorder.record(epoch)
+			profiler.toc('recording', start)
+
+		if profile_output is not None and (epoch + 1) % profile_interval == 0:
+			profiler.dump(profile_output, epoch)
+
+	if metrics is not None:
+		metrics.flush()
+	if profile_output is not None:
+		if num_epochs % profile_interval:
+			profiler.dump(profile_output, num_epochs - 1)
+		profiler.disable()
+
+	return {
+		'throughput': cross_section.num_passed / (num_epochs * dt) * 3600,
+		'mean_speed': cross_section.mean_speed,
+		'lane_changes': sum(lane_curr.fleet.num_lane_changes for lane_curr in lane_list),
+		'num_vehicles': sum(len(lane_curr.fleet) for lane_curr in lane_list),
+	}
+
+
+def main():
+	num_epochs = 1000
+	dt = 0.1
+
+	lane_list = build_scenario(settings, platoon_size=settings['Simulation'].get('len_platoon'),
+	                           integrator=settings['Simulation'].get('integrator', 'ballistic'))
+
+	# Run simulation
+	# States are recorded by the recorder, so vehicles do not need to keep their own records
+	Vehicle.record_states = False
+	record_interval = settings['Simulation'].get('record_interval', 1)
+	output_dir = settings['Simulation'].get('output_dir')
+	record_trajectories = settings['Simulation'].get('record_trajectories', True)
+	if not record_trajectories:
+		recorder = None
+	elif output_dir:
+		# Stream trajectories to disk for long runs
+		recorder = TrajectoryWriter(output_dir, lane_list, interval=record_interval)
+	else:
+		recorder = TrajectoryRecorder(lane_list, interval=record_interval)
+
+	metrics = None
+	if settings['Simulation'].get('metrics_output'):
+		metrics = OnlineMetrics(lane_list, [LoopDetectors(lane_list, settings['Simulation'].get('detectors', [])),
+		                                    EdieCells(lane_list, settings['Simulation'].get('cell_length', 100))],
+		                        interval=settings['Simulation'].get('metrics_interval', 60))
+
+	boundary = None
+	if settings['Simulation'].get('open_boundary', False):
+		boundary = OpenBoundary(lane_list, settings['Vehicle'], settings['Simulation'].get('inflow', 0),
+		                        recorder=recorder)
+
+	run_simulation(lane_list, num_epochs, dt, recorder, progress=True, boundary=boundary, metrics=metrics,
+	               profile_output=settings['Simulation'].get('profile_output'),
+	               profile_interval=settings['Simulation'].get('profile_interval', 100))
+	if metrics is not None:
+		metrics.save(settings['Simulation']['metrics_output'])
+	if recorder is None:
+		return
+
+	if output_dir:
+		recorder.close()
+		recorder = TrajectoryReader(output_dir)
+
+	# Space-time heatmaps of speed, density and acceleration with the trajectories of a sample of the vehicles
 	if not os.path.exists('figures/'):
 		os.makedirs('figures/')
-	plt.savefig('figures/position.png', bbox_inches='tight')
-
-	plt.show()
+	render_space_time(recorder, 'figures/space_time.png', dt=dt,
+	                  num_overlay=settings['Simulation'].get('overlay_vehicles', 20))
 
 
 if __name__ == '__main__':
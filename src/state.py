@@ -0,0 +1,138 @@
+import numpy as np
+
+
+class FleetState(object):
+	"""
+	Struct-of-arrays storage of vehicle states.
+
+	Every vehicle owns one slot (row) in exactly one ``FleetState``. The fleet of a lane keeps its vehicles in
+	its own state; vehicles that are not on any lane live in ``DETACHED``. After ``compact()`` the slots
+	``[0, n)`` of a fleet state are ordered from the front vehicle to the rear vehicle, so that car-following
+	can be computed for the whole lane with array operations.
+	"""
+	FIELDS = ('position', 'speed', 'acc', 'length', 'desired_speed_main', 'desired_speed_ramp', 'reaction_time',
+	          'max_acc', 'desired_dec', 'jam_distance', 'obstacle_position')
+	# Columns holding a copy of the ``VehicleParameters`` of each vehicle for vectorized car-following
+	PARAMETER_FIELDS = ('length', 'desired_speed_main', 'desired_speed_ramp', 'reaction_time', 'max_acc',
+	                    'desired_dec', 'jam_distance')
+
+	def __init__(self, capacity: int = 64):
+		"""
+		Initializes an empty state storage.
+
+		:param capacity: initial number of slots, the storage grows automatically when it is full
+		"""
+		self.capacity = capacity
+		self.size = 0  # Number of slots handed out so far (including released ones)
+		self.free_slots = []  # Released slots that can be reused
+		self.ordered = True  # Whether slots [0, size) are ordered from front to rear without holes
+		self.version = 0  # Changes whenever a state is written or a slot is handed out or released
+		for field in self.FIELDS:
+			setattr(self, field, np.zeros(capacity))
+		self.vehicle_id = np.full(capacity, -1, dtype=np.int64)  # Id of the vehicle owning each slot
+
+	def __len__(self):
+		return self.size - len(self.free_slots)
+
+	def _grow(self):
+		"""Doubles the capacity of the storage."""
+		capacity = self.capacity * 2
+		for field in self.FIELDS:
+			column = np.zeros(capacity)
+			column[:self.capacity] = getattr(self, field)
+			setattr(self, field, column)
+		vehicle_id = np.full(capacity, -1, dtype=np.int64)
+		vehicle_id[:self.capacity] = self.vehicle_id
+		self.vehicle_id = vehicle_id
+		self.capacity = capacity
+
+	def allocate(self) -> int:
+		"""
+		Hands out a slot. Values of the slot are not initialized.
+
+		:return: index of the slot
+		"""
+		if self.free_slots:
+			slot = self.free_slots.pop()
+		else:
+			if self.size == self.capacity:
+				self._grow()
+			slot = self.size
+			self.size += 1
+		self.ordered = False
+		self.version += 1
+		return slot
+
+	def release(self, slot: int):
+		"""
+		Returns a slot to the storage.
+
+		:param slot: index of the slot
+		"""
+		self.free_slots.append(slot)
+		self.ordered = False
+		self.version += 1
+
+	def attach(self, vehicle):
+		"""
+		Moves the states of a vehicle from its current storage into this one.
+
+		:param vehicle: the vehicle to move
+		"""
+		source, source_slot = vehicle._state, vehicle._slot
+		if source is self:
+			return
+		slot = self.allocate()
+		if source is not None:
+			for field in self.FIELDS:
+				getattr(self, field)[slot] = getattr(source, field)[source_slot]
+			self.vehicle_id[slot] = source.vehicle_id[source_slot]
+			source.release(source_slot)
+		vehicle._state = self
+		vehicle._slot = slot
+
+	def compact(self, vehicles):
+		"""
+		Reorders the slots so that slot ``i`` belongs to the ``i``-th vehicle and removes released slots.
+
+		:param vehicles: all vehicles of the storage ordered from front to rear
+		"""
+		order = np.fromiter((vehicle._slot for vehicle in vehicles), dtype=np.intp)
+		num = len(order)
+		for field in self.FIELDS:
+			column = getattr(self, field)
+			column[:num] = column[order]
+		self.vehicle_id[:num] = self.vehicle_id[order]
+		for slot, vehicle in enumerate(vehicles):
+			vehicle._slot = slot
+		self.size = num
+		self.free_slots = []
+		self.ordered = True
+		self.version += 1
+
+	def touch(self):
+		"""Marks the states as changed after they have been written through the arrays directly."""
+		self.version += 1
+
+
+class StateField(object):
+	"""
+	Descriptor exposing one column of a ``FleetState`` as an attribute of the vehicle owning the slot.
+	"""
+
+	def __init__(self, field: str):
+		self.field = field
+
+	def __get__(self, vehicle, owner=None):
+		if vehicle is None:
+			return self
+		return getattr(vehicle._state, self.field)[vehicle._slot]
+
+	def __set__(self, vehicle, value):
+		state = vehicle._state
+		getattr(state, self.field)[vehicle._slot] = value
+		state.version += 1
+
+
+# Storage of vehicles which are not in any fleet
+DETACHED = FleetState()
@@ -0,0 +1,321 @@
+import numpy as np
+from lane import Lane
+from vehicle import Vehicle
+from models import VehicleArrays
+from fleet import Fleet
+from structure import VehicleTable
+from integration import ballistic_update
+from profiler import profiler
+from obstacles import advance_obstacles
+import simulation
+from typing import List, Optional, Set
+
+
+def get_coarse_mask(vehicles: VehicleArrays, leaders: VehicleArrays, acc: np.ndarray, acc_change: np.ndarray,
+                    step: float, fine_step: float, max_speed: float, interaction_threshold: float,
+                    acc_change_bound: float) -> np.ndarray:
+	"""
+	Finds the vehicles which can be advanced over a coarse step with their current acceleration.
+
+	A vehicle qualifies if its acceleration and the acceleration of its leader have changed by at most
+	``acc_change_bound`` over the last coarse step, the IDM interaction term ``(s* / s) ** 2`` with its leader is at
+	most ``interaction_threshold`` (it is not in a queue), no obstacle comes within its desired distance and its speed
+	stays within [0, max_speed]. Moreover the gap must stay larger than the jam distance even if the leader brakes
+	with its comfortable deceleration (the lower bound of the car-following accelerations) for the whole step, so the
+	qualifying vehicles cannot collide with their leaders.
+
+	:param vehicles: the vehicles
+	:param leaders: their leaders, missing leaders do not restrict the vehicles
+	:param acc: current accelerations of the vehicles
+	:param acc_change: absolute changes of the accelerations over the last coarse step, NaN if unknown
+	:param step: the coarse step
+	:param fine_step: the step of the vehicles which are not advanced coarsely
+	:param max_speed: the speed limit of the lane
+	:param interaction_threshold: bound of the interaction term
+	:param acc_change_bound: bound of the change of the accelerations
+	:return: mask of the vehicles which can be advanced coarsely
+	"""
+	speed = vehicles.speed
+	travel = speed * step + 0.5 * acc * step ** 2
+	end_speed = speed + acc * step
+	high_speed = np.maximum(speed, end_speed)
+	root = 2 * np.sqrt(vehicles.max_acc * vehicles.desired_dec)
+
+	# Least distance travelled by the leader. The ballistic update of a vehicle coming to a stop may move it back by
+	# up to half its deceleration times the square of the fine step in each fine step.
+	lead_dec = leaders.desired_dec
+	lead_travel = np.where(leaders.speed > lead_dec * step, leaders.speed * step - 0.5 * lead_dec * step ** 2,
+	                       leaders.speed ** 2 / (2 * lead_dec)) - 0.5 * lead_dec * step * fine_step
+	gap = np.where(leaders.exists, leaders.position - leaders.length - vehicles.position, np.inf)
+	safe = gap - travel + lead_travel > vehicles.jam_distance
+
+	lead_speed = np.where(leaders.exists, leaders.speed, speed)
+	s_star = vehicles.jam_distance + np.maximum(0, speed * vehicles.reaction_time + speed * (speed - lead_speed) / root)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		free = (s_star / gap) ** 2 <= interaction_threshold
+
+	# Vehicles without a leader have a smooth leader, unknown changes are not smooth
+	lead_acc_change = np.where(leaders.exists, np.concatenate([[0], acc_change[:-1]]), 0)
+	smooth = (acc_change <= acc_change_bound) & (lead_acc_change <= acc_change_bound)
+
+	# Obstacles only brake vehicles within the desired distance, see ``obstacle_acceleration``
+	obstacle_distance = vehicles.obstacle_position - vehicles.position - travel
+	s_star_obstacle = 1 + high_speed * vehicles.reaction_time + high_speed ** 2 / root
+	clear = obstacle_distance >= s_star_obstacle
+	return safe & free & smooth & clear & (end_speed >= 0) & (end_speed <= max_speed)
+
+
+class MultiRateStepper(object):
+	"""
+	Advances the simulation in coarse steps of ``num_substeps`` fine steps. Lane changes are decided once per coarse
+	step. Vehicles in smooth traffic (see ``get_coarse_mask``) move over the coarse step with their current
+	acceleration, while vehicles in queues, near obstacles, in platoons or which have just changed lanes are advanced
+	in fine steps against the trajectories of their leaders. All vehicles move ballistically, the integration schemes
+	of the fleets are not used.
+	"""
+
+	def __init__(self, dt: float = 0.1, num_substeps: int = 5, interaction_threshold: float = 0.8,
+	             acc_change_bound: float = 0.05):
+		"""
+		:param dt: the fine step
+		:param num_substeps: number of fine steps per coarse step
+		:param interaction_threshold: bound of the IDM interaction term of coarsely advanced vehicles
+		:param acc_change_bound: bound of the change of the accelerations over a coarse step of coarsely advanced
+		                         vehicles and their leaders
+		"""
+		self.dt = dt
+		self.num_substeps = num_substeps
+		self.interaction_threshold = interaction_threshold
+		self.acc_change_bound = acc_change_bound
+		self.num_coarse = 0  # Number of vehicles advanced coarsely in the last step
+		self.last_acc = VehicleTable(np.nan)  # Accelerations at the start of the last coarse step by vehicle id
+
+	def step(self, lane_list: List[Lane], max_dt: Optional[float] = None) -> float:
+		"""
+		Advances the simulation by one coarse step.
+
+		:param lane_list: list of lanes
+		:param max_dt: upper bound of the step, e.g. the time left in a run, the coarse step is shortened to a multiple
+		               of the fine step
+		:return: the time step taken
+		"""
+		num_substeps = self.num_substeps
+		if max_dt is not None:
+			num_substeps = max(1, min(num_substeps, int(round(max_dt / self.dt))))
+		changed = {vehicle.id for vehicle in simulation.change_lanes(lane_list)}
+
+		start = profiler.tic()
+		self.num_coarse = 0
+		for lane_curr in lane_list:
+			self.num_coarse += self.update_fleet(lane_curr.fleet, changed, num_substeps)
+		profiler.toc('update', start)
+		# Vehicles which have left the road are dropped
+		self.last_acc.retain(np.concatenate([lane_curr.fleet.state.vehicle_id[:lane_curr.fleet.sync_state()]
+		                                     for lane_curr in lane_list]))
+		advance_obstacles(lane_list, self.dt * num_substeps)
+		simulation.count_epoch(lane_list)
+		return self.dt * num_substeps
+
+	def update_fleet(self, fleet: Fleet, changed: Optional[Set[int]] = None,
+	                 num_substeps: Optional[int] = None) -> int:
+		"""
+		Advances the vehicles of a fleet by one coarse step.
+
+		:param fleet: the fleet
+		:param changed: ids of the vehicles which have changed lanes in this step
+		:param num_substeps: number of fine steps of the coarse step, ``self.num_substeps`` if None
+		:return: number of vehicles advanced coarsely
+		"""
+		if num_substeps is None:
+			num_substeps = self.num_substeps
+		if not fleet.vehicles:
+			return 0
+		fleet.update_platoons()
+		acc = fleet.get_accelerations()
+		num = len(acc)
+		state = fleet.state
+		step = self.dt * num_substeps
+		vehicle_id = state.vehicle_id[:num]
+		with np.errstate(invalid='ignore'):
+			acc_change = np.abs(acc - self.last_acc.get(vehicle_id))
+		self.last_acc.update(vehicle_id, acc)
+
+		vehicles = fleet.get_arrays()
+		coarse = get_coarse_mask(vehicles, vehicles.take(np.arange(-1, num - 1)), acc, acc_change, step, self.dt,
+		                         fleet.lane.max_speed, self.interaction_threshold, self.acc_change_bound)
+		for _, slots in fleet.get_platoon_slots():
+			coarse[slots] = False
+		if changed:
+			coarse &= ~np.isin(vehicle_id, list(changed))
+		fine = ~coarse
+		position = state.position[:num]
+		speed = state.speed[:num]
+		position_coarse = position[coarse]
+		speed_coarse = speed[coarse]
+		acc_coarse = acc[coarse]
+
+		acc_fine = acc[fine]
+		for i in range(num_substeps if np.any(fine) else 0):
+			if i > 0:
+				# The coarse vehicles are leaders of fine vehicles at their intermediate states
+				t = i * self.dt
+				position[coarse] = position_coarse + speed_coarse * t + 0.5 * acc_coarse * t ** 2
+				speed[coarse] = speed_coarse + acc_coarse * t
+				# Gathering the fine vehicles only pays off if they are few
+				selected = fine if 2 * len(acc_fine) < num else None
+				acc_fine = fleet.compute_accelerations(fleet.get_arrays(), selected)[fine]
+			# Ballistic update of the fine vehicles
+			position[fine], speed[fine] = ballistic_update(position[fine], speed[fine], acc_fine, self.dt,
+			                                               fleet.lane.max_speed)
+		position[coarse] = position_coarse + speed_coarse * step + 0.5 * acc_coarse * step ** 2
+		speed[coarse] = speed_coarse + acc_coarse * step
+		state.acc[:num][fine] = acc_fine
+		state.acc[:num][coarse] = acc_coarse
+		state.touch()
+
+		if Vehicle.record_states:
+			for vehicle in fleet.vehicles:
+				vehicle._restore_states()
+		return int(np.count_nonzero(coarse))
+
+
+class AdaptiveStepper(object):
+	"""
+	Advances the simulation with one global time step which is adapted to the dynamics: the step is a multiple of the
+	base step ``dt`` such that the largest change of acceleration over the step, estimated from the last step, stays
+	below ``acc_change_bound``. A step is shortened (down to ``dt``) if the update would bring any vehicle into
+	contact with its leader, or within its jam distance, within the step.
+	"""
+
+	def __init__(self, dt: float = 0.1, max_dt: float = 1.0, acc_change_bound: float = 0.2, growth: float = 2.0):
+		"""
+		:param dt: the base and smallest step
+		:param max_dt: the largest step
+		:param acc_change_bound: bound of the change of acceleration of any vehicle over one step
+		:param growth: largest factor between two consecutive steps
+		"""
+		self.dt = dt
+		self.max_dt = max_dt
+		self.acc_change_bound = acc_change_bound
+		self.growth = growth
+		self.last_dt = dt
+
+	def step(self, lane_list: List[Lane], max_dt: Optional[float] = None) -> float:
+		"""
+		Advances the simulation by one adaptive step.
+
+		:param lane_list: list of lanes
+		:param max_dt: upper bound of the step, e.g. the time left in a run
+		:return: the time step taken
+		"""
+		simulation.change_lanes(lane_list)
+
+		start = profiler.tic()
+		for lane_curr in lane_list:
+			lane_curr.fleet.update_platoons()
+		dt = self.get_step(lane_list, max_dt)
+		for lane_curr in lane_list:
+			lane_curr.fleet.update_vehicles(dt)
+		profiler.toc('update', start)
+		advance_obstacles(lane_list, dt)
+		simulation.count_epoch(lane_list)
+		self.last_dt = dt
+		return dt
+
+	def get_step(self, lane_list: List[Lane], max_dt: Optional[float] = None) -> float:
+		"""
+		Chooses the next step from the change of the accelerations since the last update and shortens it until no
+		vehicle gets into contact with its leader (see ``is_safe``).
+
+		:param lane_list: list of lanes
+		:param max_dt: upper bound of the step
+		:return: the time step
+		"""
+		rate = 0.0  # Largest change of acceleration per second
+		for lane_curr in lane_list:
+			acc = lane_curr.fleet.get_accelerations()
+			if len(acc):
+				rate = max(rate, float(np.abs(acc - lane_curr.fleet.state.acc[:len(acc)]).max()) / self.last_dt)
+		dt = min(self.max_dt, self.last_dt * self.growth)
+		if rate > 0:
+			dt = min(dt, self.acc_change_bound / rate)
+		if max_dt is not None:
+			dt = min(dt, max_dt)
+		num_steps = max(1, int(dt / self.dt + 1e-9))
+		while num_steps > 1 and not all(self.is_safe(lane_curr.fleet, num_steps * self.dt) for lane_curr in lane_list):
+			num_steps //= 2
+		return num_steps * self.dt
+
+	@staticmethod
+	def is_safe(fleet: Fleet, dt: float) -> bool:
+		"""
+		Checks whether the update of ``Fleet.update_vehicles`` with the given step keeps every vehicle which is
+		behind its leader now behind it during the whole step, and farther than its jam distance if it is now. The
+		step is taken with the integration scheme of the fleet, so the gaps at the end of the step are exact. Within
+		the step each vehicle is taken to move with the constant acceleration which leads to its end position, which
+		is exact for the ballistic and Heun's scheme, and the smallest gap of each pair is found in closed form.
+
+		:param fleet: the fleet
+		:param dt: the time step
+		:return: whether the step is safe
+		"""
+		if len(fleet) < 2:
+			return True
+		end_position, _, acc = fleet.integrate(dt)
+		num = len(acc)
+		state = fleet.state
+		position = state.position[:num]
+		speed = state.speed[:num]
+		acc = 2 * (end_position - position - speed * dt) / dt ** 2
+		gap = position[:-1] - position[1:] - state.length[:num - 1]
+		end_gap = end_position[:-1] - end_position[1:] - state.length[:num - 1]
+		closing_speed = speed[1:] - speed[:-1]
+		closing_acc = acc[1:] - acc[:-1]
+		# The gap is g - c * t - 0.5 * a * t ** 2, its minimum is at the end of the step or at t = -c / a
+		with np.errstate(divide='ignore', invalid='ignore'):
+			t_min = np.where(closing_acc < 0, -closing_speed / closing_acc, np.inf)
+		inner = (t_min > 0) & (t_min < dt)
+		t_min = np.where(inner, t_min, 0)
+		min_gap = np.where(inner, np.minimum(gap - closing_speed * t_min - 0.5 * closing_acc * t_min ** 2, end_gap),
+		                   end_gap)
+		# Gaps larger than the jam distance must stay larger, the others must stay positive
+		jam_distance = state.jam_distance[1:num]
+		bound = np.where(gap > jam_distance, jam_distance, 0)
+		return not np.any((gap > 0) & (min_gap <= bound))
+
+
+def run_stepped(lane_list: List[Lane], stepper, duration: float, measure_position: Optional[float] = None,
+                metrics=None) -> dict:
+	"""
+	Runs the simulation with a stepper until the given time and returns the summary metrics of
+	``simulation.run_simulation``, with the speeds weighted by the lengths of the steps.
+
+	:param lane_list: list of lanes with their initial vehicles
+	:param stepper: ``MultiRateStepper`` or ``AdaptiveStepper``
+	:param duration: simulated time
+	:param measure_position: position of the cross-section where the throughput is counted, the middle of the first
+	                         lane if None
+	:param metrics: ``metrics.OnlineMetrics`` updated after each step
+	:return: throughput (veh/h), mean speed (m/s), number of lane changes, number of vehicles and number of steps
+	"""
+	if measure_position is None:
+		measure_position = lane_list[0].start + lane_list[0].length / 2
+	cross_section = simulation.CrossSection(lane_list, measure_position)
+	elapsed = 0.0
+	num_steps = 0
+	while elapsed < duration - 1e-9:
+		dt = stepper.step(lane_list, duration - elapsed)
+		elapsed += dt
+		num_steps += 1
+		cross_section.update(lane_list, dt)
+		if metrics is not None:
+			metrics.update(lane_list, dt)
+	if metrics is not None:
+		metrics.flush()
+	return {
+		'throughput': cross_section.num_passed / elapsed * 3600 if elapsed else float('nan'),
+		'mean_speed': cross_section.mean_speed,
+		'lane_changes': sum(lane_curr.fleet.num_lane_changes for lane_curr in lane_list),
+		'num_vehicles': sum(len(lane_curr.fleet) for lane_curr in lane_list),
+		'num_steps': num_steps,
+	}
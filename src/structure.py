@@ -0,0 +1,231 @@
+import numpy as np
+from typing import Dict, List, Optional
+
+
+class VehicleNode(object):
+	"""Node of a ``VehicleList``."""
+	__slots__ = ('vehicle', 'front', 'rear')
+
+	def __init__(self, vehicle):
+		self.vehicle = vehicle
+		self.front: Optional[VehicleNode] = None
+		self.rear: Optional[VehicleNode] = None
+
+
+class VehicleList(object):
+	"""
+	Doubly linked list of vehicles ordered from front to rear.
+
+	Nodes are indexed by vehicle id, so that inserting behind a known vehicle, removing a vehicle and membership
+	tests take O(1). The ordered list of vehicles is cached and only rebuilt after the list has been modified.
+	"""
+
+	def __init__(self):
+		self._nodes: Dict[int, VehicleNode] = {}  # vehicle id -> node
+		self._head: Optional[VehicleNode] = None  # node of the front vehicle
+		self._tail: Optional[VehicleNode] = None  # node of the rear vehicle
+		self._vehicles: Optional[List] = None  # cached vehicles ordered from front to rear
+
+	def __len__(self):
+		return len(self._nodes)
+
+	def __contains__(self, vehicle) -> bool:
+		node = self._nodes.get(vehicle.id)
+		return node is not None and node.vehicle is vehicle
+
+	def __iter__(self):
+		return iter(self.vehicles)
+
+	@property
+	def vehicles(self) -> List:
+		"""
+		Vehicles ordered from front to rear. The list is shared until the next modification and must not be
+		modified by the caller.
+		"""
+		if self._vehicles is None:
+			vehicles = []
+			node = self._head
+			while node is not None:
+				vehicles.append(node.vehicle)
+				node = node.rear
+			self._vehicles = vehicles
+		return self._vehicles
+
+	@property
+	def head(self):
+		"""The front vehicle of the list, None if the list is empty."""
+		return self._head.vehicle if self._head is not None else None
+
+	@property
+	def tail(self):
+		"""The rear vehicle of the list, None if the list is empty."""
+		return self._tail.vehicle if self._tail is not None else None
+
+	def front_of(self, vehicle):
+		"""
+		Returns the vehicle in front of the given vehicle in the list.
+
+		:param vehicle: a vehicle in the list
+		:return: the front vehicle, None if the vehicle is the head of the list
+		"""
+		front = self._nodes[vehicle.id].front
+		return front.vehicle if front is not None else None
+
+	def rear_of(self, vehicle):
+		"""
+		Returns the vehicle behind the given vehicle in the list.
+
+		:param vehicle: a vehicle in the list
+		:return: the rear vehicle, None if the vehicle is the tail of the list
+		"""
+		rear = self._nodes[vehicle.id].rear
+		return rear.vehicle if rear is not None else None
+
+	def insert_after(self, vehicle, front_vehicle=None):
+		"""
+		Inserts a vehicle behind the given front vehicle.
+
+		:param vehicle: the vehicle to insert
+		:param front_vehicle: a vehicle in the list, None to insert the vehicle as the head of the list
+		"""
+		if vehicle.id in self._nodes:
+			raise ValueError("Vehicle already in the list")
+		node = VehicleNode(vehicle)
+		if front_vehicle is None:
+			front, rear = None, self._head
+		else:
+			front = self._nodes[front_vehicle.id]
+			rear = front.rear
+		node.front = front
+		node.rear = rear
+		if front is None:
+			self._head = node
+		else:
+			front.rear = node
+		if rear is None:
+			self._tail = node
+		else:
+			rear.front = node
+		self._nodes[vehicle.id] = node
+		self._vehicles = None
+
+	def append(self, vehicle):
+		"""
+		Inserts a vehicle as the tail of the list.
+
+		:param vehicle: the vehicle to insert
+		"""
+		self.insert_after(vehicle, self.tail)
+
+	def remove(self, vehicle):
+		"""
+		Removes a vehicle from the list.
+
+		:param vehicle: the vehicle to remove
+		"""
+		node = self._nodes.pop(vehicle.id, None)
+		if node is None:
+			raise ValueError("Vehicle not in the list")
+		if node.front is None:
+			self._head = node.rear
+		else:
+			node.front.rear = node.rear
+		if node.rear is None:
+			self._tail = node.front
+		else:
+			node.rear.front = node.front
+		node.front = node.rear = None
+		self._vehicles = None
+
+	def get_ids(self) -> np.ndarray:
+		"""
+		Returns the ids of the vehicles ordered from front to rear.
+		"""
+		return np.fromiter((vehicle.id for vehicle in self.vehicles), dtype=np.int64, count=len(self))
+
+
+class VehicleTable(object):
+	"""
+	Values of vehicles by id, stored as arrays sorted by id.
+
+	Arrays indexed by id grow with ``Vehicle.cnt``, i.e. with every vehicle which has entered the road. A table only
+	holds the vehicles it has been given and not dropped since, so it stays bounded in runs with open boundaries
+	if its owner keeps it to the vehicles on the road. Lookups and updates of m vehicles take O(m log n).
+	"""
+
+	def __init__(self, fill_value=np.nan, dtype=float):
+		"""
+		:param fill_value: value of vehicles which are not in the table
+		:param dtype: data type of the values
+		"""
+		self.fill_value = fill_value
+		self.ids = np.zeros(0, dtype=np.int64)
+		self.values = np.zeros(0, dtype=dtype)
+
+	def __len__(self):
+		return len(self.ids)
+
+	def _find(self, ids: np.ndarray):
+		if len(self.ids) == 0:
+			return np.zeros(len(ids), dtype=np.intp), np.zeros(len(ids), dtype=bool)
+		index = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+		return index, self.ids[index] == ids
+
+	def get(self, ids) -> np.ndarray:
+		"""
+		Returns the values of the given vehicles.
+
+		:param ids: vehicle ids
+		:return: their values, ``fill_value`` for vehicles which are not in the table
+		"""
+		ids = np.asarray(ids, dtype=np.int64)
+		index, found = self._find(ids)
+		values = np.full(len(ids), self.fill_value, dtype=self.values.dtype)
+		values[found] = self.values[index[found]]
+		return values
+
+	def assign(self, ids, values):
+		"""
+		Replaces the content of the table.
+
+		:param ids: distinct vehicle ids
+		:param values: their values, or one value for all
+		"""
+		ids = np.asarray(ids, dtype=np.int64)
+		order = np.argsort(ids, kind='stable')
+		self.ids = ids[order]
+		self.values = np.broadcast_to(np.asarray(values, dtype=self.values.dtype), ids.shape)[order]
+
+	def update(self, ids, values):
+		"""
+		Sets the values of the given vehicles and adds the vehicles which are not in the table.
+
+		:param ids: distinct vehicle ids
+		:param values: their values, or one value for all
+		"""
+		ids = np.asarray(ids, dtype=np.int64)
+		values = np.broadcast_to(np.asarray(values, dtype=self.values.dtype), ids.shape)
+		index, found = self._find(ids)
+		self.values[index[found]] = values[found]
+		if not found.all():
+			self.assign(np.concatenate([self.ids, ids[~found]]), np.concatenate([self.values, values[~found]]))
+
+	def discard(self, ids):
+		"""
+		Drops the given vehicles from the table.
+
+		:param ids: vehicle ids, ids which are not in the table are ignored
+		"""
+		keep = ~np.isin(self.ids, ids)
+		self.ids = self.ids[keep]
+		self.values = self.values[keep]
+
+	def retain(self, ids):
+		"""
+		Drops all vehicles but the given ones from the table.
+
+		:param ids: vehicle ids
+		"""
+		keep = np.isin(self.ids, ids)
+		self.ids = self.ids[keep]
+		self.values = self.values[keep]
@@ -0,0 +1,200 @@
+# coding=UTF-8
+import csv
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List
+
+import numpy as np
+
+# Parameters of a scenario which are passed to ``simulation.build_scenario``
+SCENARIO_PARAMETERS = ('num_vehicles', 'permeability', 'arrival_rate', 'flow', 'distribution',
+                       'density')
+METRICS = ('throughput', 'mean_speed', 'lane_changes', 'num_vehicles')
+
+
+def expand_grid(grid: Dict[str, list]) -> List[dict]:
+	"""
+	Expands a parameter grid into the list of all combinations.
+
+	:param grid: values of each parameter, e.g. {'permeability': [0, 0.5], 'seed': [0, 1]}
+	:return: one dict of parameters per scenario, in the order of the grid
+	"""
+	names = list(grid.keys())
+	return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def scenario_key(params: dict) -> str:
+	"""Identifies a scenario in the result table, used to resume sweeps."""
+	return json.dumps(params, sort_keys=True)
+
+
+def seed_rngs(base_seed: int, seed: int):
+	"""
+	Seeds the random number generators used by the simulation. The stream only depends on the base seed of the sweep
+	and the seed of the scenario, so scenarios with the same seed share random numbers across the other parameters
+	and every run can be reproduced on its own.
+
+	:param base_seed: seed of the sweep
+	:param seed: seed of the scenario
+	"""
+	state = np.random.SeedSequence([base_seed, seed]).generate_state(2)
+	np.random.seed(int(state[0]))
+	random.seed(int(state[1]))
+
+
+def run_scenario(params: dict, config: dict) -> dict:
+	"""
+	Runs one scenario of a sweep. Exceptions are caught and reported in the result so that a failed run does not
+	stop the sweep.
+
+	:param params: parameters of the scenario
+	:param config: the sweep configuration
+	:return: parameters, metrics, status and error of the run
+	"""
+	import simulation
+	from vehicle import Vehicle
+
+	result = dict(params)
+	start_time = time.time()
+	try:
+		with open(config.get('settings', 'settings.json'), 'r') as f:
+			settings = json.load(f)
+		seed_rngs(config.get('base_seed', 0), params.get('seed', 0))
+		Vehicle.record_states = False
+
+		scenario_params = {name: params[name] for name in SCENARIO_PARAMETERS if name in params}
+		scenario_params.setdefault('num_vehicles', config.get('num_vehicles', 1000))
+		lane_list = simulation.build_scenario(settings, **scenario_params)
+		metrics = simulation.run_simulation(lane_list, params.get('num_epochs', config.get('num_epochs', 1000)),
+		                                    params.get('dt', config.get('dt', 0.1)),
+		                                    measure_position=config.get('measure_position'))
+		result.update(metrics)
+		result['status'] = 'ok'
+		result['error'] = ''
+	except Exception:
+		result['status'] = 'failed'
+		result['error'] = traceback.format_exc(limit=3).strip().splitlines()[-1]
+	result['runtime'] = time.time() - start_time
+	return result
+
+
+def run_ensemble(params_list: List[dict], config: dict) -> List[dict]:
+	"""
+	Runs scenarios which differ only in their seeds together as the replicas of one ``ensemble.Ensemble``. The
+	results are the same as of ``run_scenario`` for each scenario, the runtime is shared equally.
+
+	:param params_list: parameters of the scenarios
+	:param config: the sweep configuration
+	:return: parameters, metrics, status and error of each run
+	"""
+	import ensemble
+	from vehicle import Vehicle
+
+	params = params_list[0]
+	start_time = time.time()
+	try:
+		with open(config.get('settings', 'settings.json'), 'r') as f:
+			settings = json.load(f)
+		Vehicle.record_states = False
+
+		scenario_params = {name: params[name] for name in SCENARIO_PARAMETERS if name in params}
+		scenario_params.setdefault('num_vehicles', config.get('num_vehicles', 1000))
+		replicas = ensemble.build_ensemble(settings, [replica.get('seed', 0) for replica in params_list],
+		                                   config.get('base_seed', 0), measure_position=config.get('measure_position'),
+		                                   **scenario_params)
+		metrics_list = replicas.run(params.get('num_epochs', config.get('num_epochs', 1000)),
+		                            params.get('dt', config.get('dt', 0.1)))
+		results = [dict(replica, status='ok', error='', **metrics)
+		           for replica, metrics in zip(params_list, metrics_list)]
+	except Exception:
+		error = traceback.format_exc(limit=3).strip().splitlines()[-1]
+		results = [dict(replica, status='failed', error=error) for replica in params_list]
+	for result in results:
+		result['runtime'] = (time.time() - start_time) / len(results)
+	return results
+
+
+def group_replicas(scenarios: List[dict]) -> List[List[dict]]:
+	"""
+	Groups the scenarios which differ only in their seeds, in the order of their first scenario.
+
+	:param scenarios: parameters of the scenarios
+	:return: the groups of scenarios
+	"""
+	groups = {}
+	for params in scenarios:
+		key = scenario_key({name: value for name, value in params.items() if name != 'seed'})
+		groups.setdefault(key, []).append(params)
+	return list(groups.values())
+
+
+def load_results(path: str) -> Dict[str, dict]:
+	"""
+	Loads the result table of a previous sweep.
+
+	:param path: path of the CSV result table
+	:return: rows of successful runs by scenario key
+	"""
+	finished = {}
+	if not os.path.exists(path):
+		return finished
+	with open(path, 'r', newline='') as f:
+		for row in csv.DictReader(f):
+			if row.get('status') == 'ok':
+				finished[row['key']] = row
+	return finished
+
+
+def run_sweep(config: dict) -> str:
+	"""
+	Runs all scenarios of the grid in a process pool and appends one row per run to the result table. Scenarios which
+	already succeeded in the result table are skipped, so an interrupted sweep can be resumed with the same
+	configuration. With ``"ensemble": true`` the scenarios which differ only in their seeds are run together by
+	``run_ensemble``.
+
+	:param config: the sweep configuration, see 'sweep.json'
+	:return: path of the result table
+	"""
+	output = config.get('output', 'sweep_results.csv')
+	grid = config['grid']
+	scenarios = expand_grid(grid)
+	finished = load_results(output)
+	pending = [params for params in scenarios if scenario_key(params) not in finished]
+	print('{} scenarios, {} finished, {} to run'.format(len(scenarios), len(scenarios) - len(pending), len(pending)))
+
+	columns = ['key'] + list(grid.keys()) + list(METRICS) + ['status', 'error', 'runtime']
+	write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+	with open(output, 'a', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+		if write_header:
+			writer.writeheader()
+		use_ensemble = config.get('ensemble', False)
+		with ProcessPoolExecutor(max_workers=config.get('workers')) as executor:
+			if use_ensemble:
+				futures = {executor.submit(run_ensemble, group, config): group for group in group_replicas(pending)}
+			else:
+				futures = {executor.submit(run_scenario, params, config): [params] for params in pending}
+			for future in as_completed(futures):
+				group = futures[future]
+				try:
+					results = future.result() if use_ensemble else [future.result()]
+				except Exception as error:
+					# The worker process itself failed, e.g. it ran out of memory
+					results = [dict(params, status='failed', error=repr(error)) for params in group]
+				for params, result in zip(group, results):
+					result['key'] = scenario_key(params)
+					writer.writerow(result)
+					print('{} {}'.format(result['status'], result['key']))
+				f.flush()
+	return output
+
+
+if __name__ == '__main__':
+	with open(sys.argv[1] if len(sys.argv) > 1 else 'sweep.json', 'r') as f:
+		run_sweep(json.load(f))
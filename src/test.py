@@ -6,6 +6,29 @@ from lane import *
 from fleet import *
 import json
 import utils
+from recorder import TrajectoryRecorder, TrajectoryWriter, TrajectoryReader
+import tempfile
+from cache import acceleration_cache
+import sweep
+import benchmark
+from boundary import OpenBoundary, VehiclePool
+from state import DETACHED
+import demand
+import equilibrium
+import checkpoint
+import decomposition
+import stepping
+import ensemble
+from obstacles import ObstacleTable, advance_obstacles
+import integration
+import lane_change
+import metrics
+import rendering
+import io
+import random
+import simulation
+from profiler import profiler
+import os
 
 NUM_VEHICLES = 5
 INIT_SPEED = 20
@@ -36,6 +59,28 @@ def initialize():
 	return lane_list
 
 
+class SimulationTestCase(unittest.TestCase):
+	"""
+	Base of the tests which run scenarios with the settings of 'settings.json'. The global random generator is seeded
+	with ``seed`` (not if None) and ``Vehicle.record_states`` is set to ``record_states`` (left as is if None) for each
+	test and restored afterwards.
+	"""
+	seed: Optional[int] = 0
+	record_states: Optional[bool] = False
+
+	def setUp(self) -> None:
+		with open('settings.json', 'r') as f:
+			self.settings = json.load(f)
+		if self.seed is not None:
+			np.random.seed(self.seed)
+		self._record_states = Vehicle.record_states
+		if self.record_states is not None:
+			Vehicle.record_states = self.record_states
+
+	def tearDown(self) -> None:
+		Vehicle.record_states = self._record_states
+
+
 class TestFleet(unittest.TestCase):
 
 	def setUp(self):
@@ -62,6 +107,26 @@ class TestFleet(unittest.TestCase):
 		self.assertEqual(len(self.fleet2.vehicles), NUM_VEHICLES - 1)  # Check that the vehicle was removed
 		self.assertEqual(self.fleet2.front_vehicle, vehicle)  # Check that the remaining vehicle is in the fleet
 
+	def test_remove_front_vehicle(self):
+		vehicle = self.fleet2.vehicles[1]
+		self.fleet2.remove_vehicle(self.fleet2.front_vehicle)
+		self.assertIsNone(vehicle.front_vehicle)  # Check that the new front vehicle has no front vehicle
+
+	def test_links(self):
+		vehicle = HV(INIT_SPEED, None, 3000, 0)
+		self.fleet1.add_vehicle(vehicle)  # Add the vehicle as the front vehicle
+		self.fleet1.remove_vehicle(self.fleet1.vehicles[2])
+
+		# Check that the car-following links follow the order of the fleet
+		vehicles = self.fleet1.vehicles
+		self.assertIs(self.fleet1.front_vehicle, vehicle)
+		self.assertIs(self.fleet1.rear_vehicle, vehicles[-1])
+		for front_vehicle, rear_vehicle in zip(vehicles[:-1], vehicles[1:]):
+			self.assertIs(front_vehicle.rear_vehicle, rear_vehicle)
+			self.assertIs(rear_vehicle.front_vehicle, front_vehicle)
+		self.assertIsNone(vehicles[0].front_vehicle)
+		self.assertIsNone(vehicles[-1].rear_vehicle)
+
 
 class VehicleTest(unittest.TestCase):
 	def setUp(self) -> None:
@@ -81,6 +146,18 @@ class VehicleTest(unittest.TestCase):
 		acc_obstacle = vehicle.get_acceleration()
 		self.assertLess(acc_obstacle, acceleration)
 
+	def test_shared_parameters(self):
+		vehicle1, vehicle2 = self.fleet1.vehicles[:2]
+		self.assertFalse(hasattr(vehicle1, '__dict__'))
+		self.assertIs(vehicle1.params, vehicle2.params)
+		self.assertIs(vehicle1.params.get_idm('Main'), vehicle2.params.get_idm('Main'))
+
+		# Changing a parameter of one vehicle does not change the other vehicle
+		vehicle1.max_acc = 1
+		self.assertEqual(vehicle1.max_acc, 1)
+		self.assertNotEqual(vehicle2.max_acc, 1)
+		self.assertEqual(self.fleet1.state.max_acc[vehicle1._slot], 1)
+
 	def test_update(self):
 		dt = 1
 		acc_list = []
@@ -105,5 +182,1019 @@ class VehicleTest(unittest.TestCase):
 		self.assertEqual(vehicle.lane, self.fleet2.lane)
 
 
+class NeighborSearchTest(unittest.TestCase):
+	def setUp(self) -> None:
+		lane_list = initialize()
+		self.fleet1 = lane_list[0].fleet
+		self.fleet2 = lane_list[1].fleet
+
+	def test_get_adjacent_vehicle_list(self):
+		front_vehicle_list, rear_vehicle_list = self.fleet1.get_adjacent_vehicle_list(self.fleet2.lane)
+		for i, vehicle in enumerate(self.fleet1.vehicles):
+			# Compare with a linear scan of the target lane
+			front_vehicles = [v for v in self.fleet2.vehicles if v.position > vehicle.position]
+			rear_vehicles = [v for v in self.fleet2.vehicles if v.position <= vehicle.position]
+			self.assertIs(front_vehicle_list[i], front_vehicles[-1] if front_vehicles else None)
+			self.assertIs(rear_vehicle_list[i], rear_vehicles[0] if rear_vehicles else None)
+
+	def test_get_adjacent_front_vehicle(self):
+		vehicle = self.fleet2.vehicles[-1]
+		self.assertIs(vehicle.get_adjacent_front_vehicle(self.fleet1.lane), self.fleet1.vehicles[-1])
+		self.assertIsNone(self.fleet1.vehicles[0].get_adjacent_front_vehicle(self.fleet2.lane))
+
+
+class FleetStateTest(unittest.TestCase):
+	def setUp(self) -> None:
+		lane_list = initialize()
+		self.fleet1 = lane_list[0].fleet
+
+	def test_get_accelerations(self):
+		self.fleet1.vehicles[2].obstacle_position = self.fleet1.vehicles[2].position + 50
+		self.fleet1.vehicles[3].speed = 30
+		acc_list = [vehicle.get_acceleration() for vehicle in self.fleet1.vehicles]
+
+		# The vectorized accelerations should be the same as the accelerations of each vehicle
+		self.assertTrue(np.allclose(self.fleet1.get_accelerations(), acc_list))
+
+	def test_update_vehicles(self):
+		dt = 0.1
+		acc_list = [vehicle.get_acceleration() for vehicle in self.fleet1.vehicles]
+		position_list = [vehicle.position + vehicle.speed * dt + 0.5 * acc * dt ** 2
+		                 for vehicle, acc in zip(self.fleet1.vehicles, acc_list)]
+		self.fleet1.update_vehicles(dt)
+
+		self.assertTrue(np.allclose(self.fleet1.get_states('position'), position_list))
+		self.assertTrue(np.allclose(self.fleet1.get_states('acceleration'), acc_list))
+		self.assertEqual(len(self.fleet1.vehicles[0].position_record), 1)
+
+	def test_state_after_remove(self):
+		vehicle = self.fleet1.vehicles[1]
+		position = vehicle.position
+		self.fleet1.remove_vehicle(vehicle)
+
+		# The states of the removed vehicle are kept and the fleet storage is reordered
+		self.assertEqual(vehicle.position, position)
+		self.assertEqual(len(self.fleet1.get_states('position')), NUM_VEHICLES - 1)
+		self.assertEqual(self.fleet1.get_states('position')[1], self.fleet1.vehicles[1].position)
+
+
+class MOBILBatchTest(unittest.TestCase):
+	def setUp(self) -> None:
+		lane_list = initialize()
+		self.fleet1 = lane_list[0].fleet
+		self.fleet2 = lane_list[1].fleet
+		for i, vehicle in enumerate(self.fleet1.vehicles):
+			vehicle.speed = 10 + 5 * i  # faster vehicles behind slower ones
+			vehicle.position += 150 * i
+
+	def test_batch_matches_per_vehicle(self):
+		mobil = MOBIL()
+		front_list, rear_list = self.fleet1.get_adjacent_vehicle_list(self.fleet2.lane)
+		self.fleet1.get_lane_change_intention(None, front_list, None, rear_list)
+
+		direction_list = []
+		for i, vehicle in enumerate(self.fleet1.vehicles):
+			if mobil.check_lane_changing(vehicle, front_list[i], rear_list[i]) and \
+					mobil.get_incentive(vehicle, front_list[i], rear_list[i]) > mobil.delta:
+				direction_list.append((vehicle, 'right'))
+
+		self.assertGreater(len(direction_list), 0)
+		index, direction, _ = self.fleet1.get_lane_change_intents()
+		self.assertEqual([(self.fleet1.vehicles[k], 'right' if lc_direction == LANE_CHANGE_RIGHT else 'left')
+		                  for k, lc_direction in zip(index.tolist(), direction.tolist())], direction_list)
+
+
+class AccelerationCacheTest(unittest.TestCase):
+	def setUp(self) -> None:
+		lane_list = initialize()
+		self.fleet1 = lane_list[0].fleet
+		self.fleet2 = lane_list[1].fleet
+		acceleration_cache.reset()
+
+	def test_fleet_cache(self):
+		acc = self.fleet1.get_accelerations()
+		self.assertIs(self.fleet1.get_accelerations(), acc)
+		self.assertEqual(acceleration_cache.hits, NUM_VEHICLES)
+		self.assertEqual(acceleration_cache.misses, NUM_VEHICLES)
+
+		# Updating the vehicles invalidates the cache
+		self.fleet1.update_vehicles(0.1)
+		self.assertIsNot(self.fleet1.get_accelerations(), acc)
+
+	def test_vehicle_cache(self):
+		vehicle = self.fleet1.vehicles[1]
+		acc = vehicle.get_acceleration()
+		self.assertEqual(vehicle.get_acceleration(), acc)
+		self.assertEqual(acceleration_cache.hits, 1)
+
+		# Changing the state of the front vehicle or moving the vehicle invalidates the cache
+		vehicle.front_vehicle.speed = 0
+		self.assertLess(vehicle.get_acceleration(), acc)
+		vehicle.move_to_lane(vehicle.get_adjacent_front_vehicle(self.fleet2.lane), self.fleet2.lane)
+		self.assertEqual(vehicle.get_acceleration(), vehicle._calculate_acceleration())
+		self.assertEqual(acceleration_cache.hits, 1)
+
+
+class RecorderTest(unittest.TestCase):
+	def setUp(self) -> None:
+		self.lane_list = initialize()
+
+	def test_record(self):
+		recorder = TrajectoryRecorder(self.lane_list, interval=2, chunk_size=3)
+		for epoch in range(9):
+			for lane_curr in self.lane_list:
+				lane_curr.fleet.update_vehicles(0.1)
+			recorder.record(epoch)
+
+		self.assertEqual(recorder.num_records, 5)
+		self.assertEqual(recorder.num_columns, NUM_VEHICLES * len(self.lane_list))
+		vehicle = self.lane_list[1].fleet.vehicles[2]
+		self.assertAlmostEqual(recorder.get('position', [vehicle.id])[-1, 0], vehicle.position, places=3)
+		self.assertEqual(recorder.get('lane', [vehicle.id])[0, 0], 1)
+
+	def test_new_vehicle(self):
+		recorder = TrajectoryRecorder(self.lane_list, chunk_size=4)
+		recorder.record(0)
+		vehicle = HV(INIT_SPEED, None, 3000, 0)
+		self.lane_list[0].fleet.add_vehicle(vehicle)
+		recorder.record(1)
+
+		# The new vehicle has no states before it enters the lane
+		position = recorder.get('position', [vehicle.id])
+		self.assertTrue(np.isnan(position[0, 0]))
+		self.assertEqual(position[1, 0], 3000)
+
+
+class TrajectoryWriterTest(unittest.TestCase):
+	def setUp(self) -> None:
+		self.lane_list = initialize()
+		self.directory = tempfile.TemporaryDirectory()
+
+	def tearDown(self) -> None:
+		self.directory.cleanup()
+
+	def test_write_and_read(self):
+		recorder = TrajectoryRecorder(self.lane_list)
+		writer = TrajectoryWriter(self.directory.name, self.lane_list, chunk_size=4)
+		for epoch in range(10):
+			for lane_curr in self.lane_list:
+				lane_curr.fleet.update_vehicles(0.1)
+			recorder.record(epoch)
+			writer.record(epoch)
+		writer.close()
+
+		reader = TrajectoryReader(self.directory.name)
+		self.assertEqual(reader.num_records, 10)
+		self.assertEqual(len(reader.chunks), 3)
+		vehicle_ids = [vehicle.id for vehicle in self.lane_list[2].fleet.vehicles]
+		self.assertTrue(np.array_equal(reader.get('speed', vehicle_ids), recorder.get('speed', vehicle_ids)))
+
+		# Read a time window of one lane
+		entries = reader.select(['position'], lanes=[2], start_epoch=3, end_epoch=6)
+		self.assertEqual(len(entries['position']), 3 * NUM_VEHICLES)
+		self.assertTrue(np.all((entries['epoch'] >= 3) & (entries['epoch'] < 6)))
+
+
+class SweepTest(SimulationTestCase):
+	seed = None  # Each run is seeded
+	record_states = None  # Switched off by the runs
+
+	def setUp(self) -> None:
+		super().setUp()
+		self.directory = tempfile.TemporaryDirectory()
+		self.config = {
+			'output': os.path.join(self.directory.name, 'results.csv'),
+			'workers': 2,
+			'num_epochs': 5,
+			'num_vehicles': 20,
+			'grid': {'permeability': [0, 0.5, 'invalid'], 'seed': [0, 1]},
+		}
+
+	def tearDown(self) -> None:
+		super().tearDown()
+		self.directory.cleanup()
+
+	def test_run_and_resume(self):
+		self.assertEqual(len(sweep.expand_grid(self.config['grid'])), 6)
+		sweep.run_sweep(self.config)
+		finished = sweep.load_results(self.config['output'])
+		self.assertEqual(len(finished), 4)  # Runs with an invalid permeability fail
+
+		# Only the failed runs are repeated
+		sweep.run_sweep(self.config)
+		with open(self.config['output'], 'r') as f:
+			self.assertEqual(len(f.readlines()), 1 + 6 + 2)
+
+	def test_reproducible(self):
+		params = {'permeability': 0.5, 'seed': 3}
+		result1 = sweep.run_scenario(params, self.config)
+		result2 = sweep.run_scenario(params, self.config)
+		self.assertEqual(result1['status'], 'ok')
+		self.assertEqual(result1['mean_speed'], result2['mean_speed'])
+
+	def test_ensemble(self):
+		scenarios = sweep.expand_grid({'permeability': [0.5], 'seed': [0, 1, 2]})
+		self.assertEqual(len(sweep.group_replicas(scenarios)), 1)
+		results = sweep.run_ensemble(scenarios, self.config)
+		for params, result in zip(scenarios, results):
+			expected = sweep.run_scenario(params, self.config)
+			self.assertEqual({name: result[name] for name in sweep.METRICS},
+			                 {name: expected[name] for name in sweep.METRICS})
+
+
+class ProfilerTest(SimulationTestCase):
+	seed = None
+	record_states = None
+
+	def setUp(self) -> None:
+		super().setUp()
+		self.directory = tempfile.TemporaryDirectory()
+		profiler.reset()
+
+	def tearDown(self) -> None:
+		super().tearDown()
+		self.directory.cleanup()
+		profiler.disable()
+		profiler.reset()
+
+	def test_disabled(self):
+		lane_list = benchmark.build_benchmark_scenario(30, 3, 'high', self.settings)
+		simulation.step(lane_list, 0.1)
+		self.assertEqual(profiler.to_dict()['total_seconds'], 0)
+		self.assertEqual(sum(profiler.counters.values()), 0)
+
+	def test_dump(self):
+		Vehicle.record_states = False
+		lane_list = benchmark.build_benchmark_scenario(30, 3, 'high', self.settings)
+		path = os.path.join(self.directory.name, 'profile.json')
+		result = simulation.run_simulation(lane_list, 25, 0.1, TrajectoryRecorder(lane_list), profile_output=path,
+		                                   profile_interval=10)
+		self.assertFalse(profiler.enabled)
+		with open(path, 'r') as f:
+			snapshots = [json.loads(line) for line in f]
+		self.assertEqual([snapshot['epoch'] for snapshot in snapshots], [9, 19, 24])
+		self.assertEqual(snapshots[-1]['epochs'], 25)
+		self.assertEqual(snapshots[-1]['vehicles'], 30)
+		self.assertEqual(snapshots[-1]['counters']['lane_changes'], result['lane_changes'])
+		self.assertGreaterEqual(snapshots[-1]['counters']['get_acceleration'], 25 * 30)
+		self.assertTrue(all(snapshots[-1]['phase_seconds'][phase] > 0 for phase in profiler.PHASES
+		                    if phase != 'boundary'))  # Closed road
+
+
+class OpenBoundaryTest(SimulationTestCase):
+	def test_pool(self):
+		pool = VehiclePool()
+		vehicle = HV(10, None, 0, 0, **self.settings['Vehicle']['HV'])
+		vehicle_id = vehicle.id
+		pool.release(vehicle)
+		self.assertEqual(len(pool), 1)
+		reused = pool.acquire(HV, 20, None, 5, 0, **self.settings['Vehicle']['HV'])
+		self.assertIs(reused, vehicle)
+		self.assertNotEqual(reused.id, vehicle_id)
+		self.assertEqual((reused.position, reused.speed), (5, 20))
+		self.assertIsNot(pool.acquire(CAV, 20, None, 5, 0, **self.settings['Vehicle']['CAV']), vehicle)
+
+	def test_steady_state(self):
+		lane_list = utils.generate_scenario(3, length=1000, start=0, end=1000)
+		recorder = TrajectoryRecorder(lane_list)
+		boundary = OpenBoundary(lane_list, self.settings['Vehicle'], inflow=1800, recorder=recorder)
+		sizes = []
+		for epoch in range(3000):
+			simulation.step(lane_list, 0.1)
+			boundary.update(epoch, 0.1)
+			recorder.record(epoch)
+			for lane_curr in lane_list:
+				self.assertTrue(all(vehicle.position <= lane_curr.end for vehicle in lane_curr.fleet))
+			if epoch % 500 == 499:
+				sizes.append((DETACHED.size, sum(lane_curr.fleet.state.capacity for lane_curr in lane_list)))
+		self.assertGreater(boundary.num_retired, 0)
+		self.assertEqual(boundary.num_inserted - boundary.num_retired,
+		                 sum(len(lane_curr.fleet) for lane_curr in lane_list))
+		self.assertEqual(sizes[-1], sizes[-2])  # No growth in steady state
+
+		# Retired vehicles are marked in the recorder and not recorded afterwards
+		retired = recorder.exit_epochs >= 0
+		self.assertEqual(np.count_nonzero(retired), boundary.num_retired)
+		position = recorder.get('position')
+		epochs = np.array(recorder.epochs)
+		for column in np.flatnonzero(retired)[:10]:
+			self.assertTrue(np.all(np.isnan(position[epochs >= recorder.exit_epochs[column], column])))
+
+	def test_recorder_memory(self):
+		lane_list = utils.generate_scenario(3, length=1000, start=0, end=1000)
+		recorder = TrajectoryRecorder(lane_list, chunk_size=100)
+		boundary = OpenBoundary(lane_list, self.settings['Vehicle'], inflow=1500, recorder=recorder)
+		for epoch in range(3000):
+			simulation.step(lane_list, 0.1)
+			boundary.update(epoch, 0.1)
+			recorder.record(epoch)
+
+		# Chunks only hold the vehicles on the road, not the retired ones
+		chunk_bytes = [sum(buffer.nbytes for buffer in chunk.values()) for chunk in recorder.chunks]
+		steady = chunk_bytes[10:]
+		self.assertLessEqual(max(steady), 2 * min(steady))
+		self.assertLess(recorder.chunks[-1]['position'].shape[1], recorder.num_columns / 2)
+
+		# Retired vehicles are still returned for the chunks they were on the road
+		column = int(np.flatnonzero(recorder.exit_epochs >= 0)[0])
+		position = recorder.get('position', recorder.vehicle_ids[[column]])[:, 0]
+		self.assertGreater(np.count_nonzero(~np.isnan(position)), 0)
+		self.assertTrue(np.all(np.isnan(position[np.array(recorder.epochs) >= recorder.exit_epochs[column]])))
+
+
+	def test_bounded_tables(self):
+		lane_list = utils.generate_scenario(3, length=1000, start=0, end=1000)
+		recorder = TrajectoryRecorder(lane_list, chunk_size=100)
+		boundary = OpenBoundary(lane_list, self.settings['Vehicle'], inflow=1500, recorder=recorder)
+		stepper = stepping.MultiRateStepper()
+		cross_section = simulation.CrossSection(lane_list, 500)
+		online = metrics.OnlineMetrics(lane_list, [metrics.LoopDetectors(lane_list, [500])])
+		first_id = Vehicle.cnt
+		num_vehicles = 0  # Largest number of vehicles on the road
+		for epoch in range(1500):
+			num_vehicles = max(num_vehicles, sum(len(lane_curr.fleet) for lane_curr in lane_list))
+			dt = stepper.step(lane_list)
+			boundary.update(epoch, dt)
+			recorder.record(epoch)
+			cross_section.update(lane_list, dt)
+			online.update(lane_list, dt)
+
+		# The tables by vehicle id only hold vehicles which are on the road
+		self.assertGreater(boundary.num_retired, num_vehicles)
+		self.assertGreater(Vehicle.cnt - first_id, 2 * num_vehicles)
+		self.assertLessEqual(len(stepper.last_acc), num_vehicles)
+		self.assertLessEqual(len(cross_section.downstream), num_vehicles)
+		self.assertLessEqual(len(online.last_position), num_vehicles)
+		self.assertLessEqual(len(recorder._column_of), num_vehicles)
+		self.assertGreater(cross_section.num_passed, boundary.num_retired)
+
+
+class DemandTest(SimulationTestCase):
+	record_states = None
+
+	def test_headways(self):
+		for distribution in demand.HEADWAY_DISTRIBUTIONS:
+			headways = demand.draw_headways(20000, 1200, distribution, min_headway=1, samples=[1, 2, 3, 6])
+			self.assertAlmostEqual(headways.mean(), 3, delta=0.1)
+		self.assertGreaterEqual(demand.draw_headways(1000, 1200, 'shifted_exponential', min_headway=1).min(), 1)
+		with self.assertRaises(ValueError):
+			demand.draw_headways(10, 1200, 'uniform')
+
+	def test_zero_flow(self):
+		for distribution in demand.HEADWAY_DISTRIBUTIONS:
+			self.assertTrue(np.all(np.isinf(demand.draw_headways(5, 0, distribution, samples=[1, 2]))))
+		lane_list = utils.generate_scenario()
+		self.assertEqual(utils.generate_vehicles(lane_list, self.settings['Vehicle'], 0), [])
+		self.assertEqual(sum(len(lane_curr.fleet) for lane_curr in simulation.build_scenario(self.settings, flow=0)), 0)
+
+	def test_fill_lanes(self):
+		lane_list = utils.generate_scenario()
+		vehicles = utils.generate_vehicles(lane_list, self.settings['Vehicle'], 3000, permeability=0.5)
+		self.assertEqual(len(vehicles), sum(len(lane_curr.fleet) for lane_curr in lane_list))
+		for lane_curr in lane_list:
+			fleet = lane_curr.fleet
+			positions = np.array([vehicle.position for vehicle in fleet])
+			self.assertTrue(np.all(positions >= lane_curr.start) and np.all(positions <= lane_curr.end))
+			for vehicle in fleet:
+				self.assertIs(vehicle.lane, lane_curr)
+				self.assertIs(vehicle.front_vehicle, fleet.front_of(vehicle))
+				self.assertIs(vehicle.rear_vehicle, fleet.rear_of(vehicle))
+				if vehicle.front_vehicle is not None:
+					gap = vehicle.front_vehicle.position - vehicle.position - vehicle.front_vehicle.length
+					self.assertGreaterEqual(gap, vehicle.jam_distance - 1e-9)
+
+		# Filling again adds vehicles behind the rear vehicles up to the limit
+		vehicles = utils.generate_vehicles(lane_list, self.settings['Vehicle'], 3000, max_vehicles=0)
+		self.assertEqual(vehicles, [])
+		self.assertEqual(utils.generate_vehicle_ramp(lane_list, self.settings['Vehicle'], 0), [])  # No ramps
+
+	def test_arrival_stream(self):
+		stream = demand.ArrivalStream(1800, batch_size=16)
+		num = sum(stream.take(t * 0.1) for t in range(1, 36001))
+		self.assertAlmostEqual(num / 1800, 1, delta=0.1)
+		self.assertEqual(demand.ArrivalStream(0).take(100), 0)
+
+
+class EquilibriumTest(SimulationTestCase):
+	record_states = None
+
+	def test_density(self):
+		lane_list = utils.generate_scenario()
+		result = equilibrium.initialize_equilibrium(lane_list, self.settings['Vehicle'], density=30, permeability=0.3)
+		self.assertAlmostEqual(result['density'], 30)
+		for lane_curr in lane_list:
+			acc = lane_curr.fleet.get_accelerations()
+			self.assertLess(np.abs(acc[1:]).max(), 1e-9)  # Only the front vehicle is not in equilibrium
+			self.assertAlmostEqual(len(lane_curr.fleet) / (lane_curr.end - lane_curr.start) * 1000, 30, delta=1)
+
+	def test_ramp(self):
+		lane_list = utils.generate_scenario(2)
+		ramp = Ramp(length=1000, start=2500, end=3500)
+		ramp.fleet = Fleet(ramp)
+		ramp.left_lane, lane_list[-1].right_lane = lane_list[-1], ramp
+		lane_list.append(ramp)
+		result = equilibrium.initialize_equilibrium(lane_list, self.settings['Vehicle'], density=30, permeability=0.3)
+		self.assertEqual(set(result['lane_types']), {'Main', 'Ramp'})
+		self.assertEqual(result['speed'], result['lane_types']['Main']['speed'])
+		self.assertGreater(len(ramp.fleet), 0)
+		self.assertLess(np.abs(ramp.fleet.get_accelerations()[1:]).max(), 1e-9)
+
+		# Lanes which have vehicles are not filled again
+		with self.assertRaises(ValueError):
+			equilibrium.initialize_equilibrium(lane_list, self.settings['Vehicle'], density=30)
+
+	def test_flow(self):
+		configs = self.settings['Vehicle']
+		free = equilibrium.equilibrium_speed(configs, flow=1500)
+		congested = equilibrium.equilibrium_speed(configs, flow=1500, branch='congested')
+		self.assertGreater(free, congested)
+		params = equilibrium.class_parameters(configs)
+		for speed in (free, congested):
+			self.assertAlmostEqual(3600 * speed / equilibrium.mean_spacing(speed, params), 1500, places=6)
+		with self.assertRaises(ValueError):
+			equilibrium.equilibrium_speed(configs, flow=10000)
+		with self.assertRaises(ValueError):
+			equilibrium.equilibrium_speed(configs, density=1000)
+
+	def test_perturbation(self):
+		lane_list = utils.generate_scenario()
+		equilibrium.initialize_equilibrium(lane_list, self.settings['Vehicle'], density=40, gap_noise=5,
+		                                   speed_noise=1)
+		for lane_curr in lane_list:
+			for vehicle in lane_curr.fleet:
+				if vehicle.front_vehicle is not None:
+					gap = vehicle.front_vehicle.position - vehicle.position - vehicle.front_vehicle.length
+					self.assertGreaterEqual(gap, vehicle.jam_distance)
+				self.assertGreaterEqual(vehicle.speed, 0)
+
+
+class CheckpointTest(SimulationTestCase):
+	seed = 1
+
+	@staticmethod
+	def get_states(lane_list):
+		return [[(vehicle.id, type(vehicle), vehicle.position, vehicle.speed, vehicle.acc, vehicle.params,
+		          getattr(vehicle.front_vehicle, 'id', None), getattr(vehicle.rear_vehicle, 'id', None))
+		         for vehicle in lane_curr.fleet] for lane_curr in lane_list]
+
+	def test_restore(self):
+		lane_list = simulation.build_scenario(self.settings, flow=2500, permeability=0.3)
+		for epoch in range(20):
+			simulation.step(lane_list, 0.1)
+		platoon = Platoon(*lane_list[0].fleet.vehicles[:2], max_size=5)
+		for vehicle in platoon:
+			vehicle.platoon = platoon
+		lane_list[0].fleet.platoons.append(platoon)
+		buffer = io.BytesIO()
+		checkpoint.save_checkpoint(buffer, lane_list, 20, policy='baseline')
+		numbers = (np.random.random(), random.random())
+
+		buffer.seek(0)
+		restored, epoch, metadata = checkpoint.load_checkpoint(buffer)
+		self.assertEqual((epoch, metadata), (20, {'policy': 'baseline'}))
+		self.assertEqual(numbers, (np.random.random(), random.random()))
+		self.assertEqual(self.get_states(restored), self.get_states(lane_list))
+		self.assertIs(restored[1].left_lane, restored[0])
+		self.assertIs(restored[1].right_lane, restored[2])
+		platoon = restored[0].fleet.platoons[0]
+		self.assertEqual(list(platoon.get_ids()), list(lane_list[0].fleet.platoons[0].get_ids()))
+		self.assertIs(platoon.lead_vehicle.platoon, platoon)
+
+		# Both runs continue identically
+		for epoch in range(30):
+			simulation.step(lane_list, 0.1)
+			simulation.step(restored, 0.1)
+		self.assertEqual(self.get_states(restored), self.get_states(lane_list))
+		self.assertEqual([lane_curr.fleet.num_lane_changes for lane_curr in restored],
+		                 [lane_curr.fleet.num_lane_changes for lane_curr in lane_list])
+
+	def test_pending_lane_changes(self):
+		lane_list = simulation.build_scenario(self.settings, flow=2500, permeability=0.3)
+		for vehicle in lane_list[1].fleet.vehicles[::3]:
+			vehicle.desired_speed_main = 15
+		for lane_curr in lane_list:
+			front_left, rear_left, front_right, rear_right = \
+				lane_curr.fleet.get_adjacent_vehicle_list(lane_curr.left_lane) + \
+				lane_curr.fleet.get_adjacent_vehicle_list(lane_curr.right_lane)
+			lane_curr.fleet.get_lane_change_intention(front_left, front_right, rear_left, rear_right)
+		rows = checkpoint.get_lane_change_rows(lane_list)
+		self.assertGreater(len(rows), 0)
+
+		buffer = io.BytesIO()
+		checkpoint.save_checkpoint(buffer, lane_list)
+		buffer.seek(0)
+		restored, _, _ = checkpoint.load_checkpoint(buffer)
+		np.testing.assert_array_equal(checkpoint.get_lane_change_rows(restored), rows)
+		moved = lane_change.change_lanes([lane_curr.fleet for lane_curr in lane_list])
+		moved_restored = lane_change.change_lanes([lane_curr.fleet for lane_curr in restored])
+		self.assertGreater(len(moved), 0)
+		self.assertEqual([vehicle.id for vehicle in moved_restored], [vehicle.id for vehicle in moved])
+
+
+	def test_open_boundary(self):
+		def run(lane_list, boundary, epochs):
+			for epoch in epochs:
+				simulation.step(lane_list, 0.1)
+				boundary.update(epoch, 0.1)
+			return [[(type(vehicle), vehicle.position, vehicle.speed, vehicle.acc) for vehicle in lane_curr.fleet]
+			        for lane_curr in lane_list], (boundary.time, boundary.queue, boundary.num_inserted,
+			                                      boundary.num_retired, boundary.num_dropped)
+
+		lane_list = utils.generate_scenario(3, length=1000, start=0, end=1000)
+		boundary = OpenBoundary(lane_list, self.settings['Vehicle'], inflow=2500, permeability=0.3, max_queue=2)
+		run(lane_list, boundary, range(300))
+		buffer = io.BytesIO()
+		checkpoint.save_checkpoint(buffer, lane_list, 300, boundary=boundary)
+		expected = run(lane_list, boundary, range(300, 600))
+		self.assertGreater(boundary.num_retired, 0)
+
+		# A restored run with new boundaries of the same settings continues as the uninterrupted run
+		buffer.seek(0)
+		restored_boundary = OpenBoundary(lane_list, self.settings['Vehicle'], inflow=2500, permeability=0.3,
+		                                 max_queue=2)
+		restored, epoch, _ = checkpoint.load_checkpoint(buffer, boundary=restored_boundary)
+		self.assertIs(restored_boundary.lane_list, restored)
+		self.assertEqual(run(restored, restored_boundary, range(epoch, 600)), expected)
+
+		# Checkpoints without boundaries cannot be restored into boundaries
+		buffer = io.BytesIO()
+		checkpoint.save_checkpoint(buffer, restored)
+		buffer.seek(0)
+		with self.assertRaises(ValueError):
+			checkpoint.load_checkpoint(buffer, boundary=restored_boundary)
+
+
+class DecompositionTest(SimulationTestCase):
+	seed = 2
+
+	def test_matches_single_process(self):
+		lane_list = simulation.build_scenario(self.settings, flow=2500, permeability=0.3)
+		for lane_curr in lane_list:
+			for vehicle in lane_curr.fleet.vehicles[::3]:
+				vehicle.desired_speed_main = 15  # Slow vehicles make the others change lanes
+		buffer = io.BytesIO()
+		checkpoint.save_checkpoint(buffer, lane_list)
+		buffer.seek(0)
+		single, _, _ = checkpoint.load_checkpoint(buffer, restore_rng=False)
+
+		metrics = simulation.run_simulation(single, 100, 0.1)
+		metrics_decomposed, decomposed = decomposition.run_decomposed(lane_list, 100, 0.1, num_workers=3)
+		self.assertGreater(metrics['lane_changes'], 0)
+		self.assertEqual(metrics_decomposed, metrics)
+		self.assertEqual(CheckpointTest.get_states(decomposed), CheckpointTest.get_states(single))
+
+	def test_platoons_not_supported(self):
+		lane_list = simulation.build_scenario(self.settings, flow=2500)
+		lane_list[0].fleet.platoons.append(Platoon(*lane_list[0].fleet.vehicles[:2], max_size=5))
+		with self.assertRaises(ValueError):
+			decomposition.DecomposedSimulation(lane_list)
+
+
+class CACCTest(SimulationTestCase):
+	seed = 1
+
+	def setUp(self) -> None:
+		super().setUp()
+		self.lane_list = simulation.build_scenario(self.settings, flow=2500, permeability=1)
+		self.fleet = self.lane_list[0].fleet
+		members = self.fleet.vehicles[2:8]
+		self.platoon = Platoon(members[0], members[1], max_size=10)
+		for vehicle in members[2:]:
+			self.platoon.append(vehicle)
+			vehicle.platoon = self.platoon
+		self.fleet.platoons.append(self.platoon)
+
+	def test_matrix_matches_recursion(self):
+		controller = CACC(acc_gain=0.8)
+		spacing_error, relative_speed = np.random.randn(2, 7)
+		acc = controller.get_accelerations(spacing_error, relative_speed, -1.5)
+		acc_prev = -1.5
+		for i in range(7):
+			acc_prev = (controller.acc_gain * acc_prev + controller.gap_gain * spacing_error[i] +
+			            controller.relative_speed_gain * relative_speed[i])
+			self.assertAlmostEqual(acc[i], acc_prev)
+
+	def test_fleet_accelerations(self):
+		acc = self.fleet.get_accelerations()
+		slots = self.platoon.get_slots()
+		np.testing.assert_array_equal(acc[slots[1:]], self.platoon.control(acc[slots[0]]))
+		for vehicle in self.fleet.vehicles:
+			if vehicle.platoon is None or vehicle is self.platoon.lead_vehicle:
+				self.assertAlmostEqual(acc[vehicle._slot], vehicle.get_acceleration())
+
+	def test_vehicle_accelerations(self):
+		# The per-vehicle path controls the followers of the platoon like the fleet
+		acc = self.fleet.get_accelerations()
+		for vehicle in self.platoon.vehicles[1:]:
+			self.assertAlmostEqual(vehicle.get_acceleration(), acc[vehicle._slot])
+
+	def test_platoon_converges(self):
+		controller = Platoon.controller
+		min_gap = np.inf
+		for epoch in range(1000):
+			self.fleet.update_vehicles(0.1)
+			position = np.array([vehicle.position for vehicle in self.platoon])
+			gap = position[:-1] - position[1:] - 4
+			min_gap = min(min_gap, gap.min())
+		speed = np.array([vehicle.speed for vehicle in self.platoon])
+		self.assertGreater(min_gap, 0)
+		np.testing.assert_allclose(gap, controller.min_distance + controller.time_headway * speed[1:], atol=0.1)
+
+
+class PlatoonFormationTest(SimulationTestCase):
+	seed = 1
+
+	def setUp(self) -> None:
+		super().setUp()
+		self.lane_list = simulation.build_scenario(self.settings, flow=2500, permeability=0.6, platoon_size=4)
+		self.fleet = self.lane_list[0].fleet
+
+	def check_platoons(self, fleet):
+		members = 0
+		for platoon in fleet.platoons:
+			self.assertTrue(2 <= len(platoon) <= platoon.max_size)
+			for front_vehicle, rear_vehicle in zip(platoon.vehicles, platoon.vehicles[1:]):
+				self.assertIs(front_vehicle.rear_vehicle, rear_vehicle)
+			for vehicle in platoon:
+				self.assertIsInstance(vehicle, CAV)
+				self.assertIs(vehicle.platoon, platoon)
+				self.assertTrue(vehicle.in_platoon)
+			members += len(platoon)
+		self.assertEqual(members, sum(vehicle.platoon is not None for vehicle in fleet.vehicles))
+
+	def test_formation(self):
+		self.fleet.update_platoons()
+		self.assertTrue(self.fleet.platoons)
+		self.check_platoons(self.fleet)
+		# Consecutive CAVs far enough apart are in the same platoon unless it would exceed the size limit
+		for front_vehicle, rear_vehicle in zip(self.fleet.vehicles, self.fleet.vehicles[1:]):
+			if isinstance(front_vehicle, CAV) and isinstance(rear_vehicle, CAV) and \
+					Platoon.get_gap(front_vehicle, rear_vehicle) >= Platoon.MIN_DISTANCE and \
+					front_vehicle.platoon is not rear_vehicle.platoon:
+				size = sum(len(vehicle.platoon) if vehicle.platoon else 1 for vehicle in (front_vehicle, rear_vehicle))
+				self.assertGreater(size, 4)
+		# Only pairs which are too close to join are checked again
+		for vehicle in self.fleet._platoon_candidates.values():
+			self.assertLess(Platoon.get_gap(vehicle.front_vehicle, vehicle), Platoon.MIN_DISTANCE)
+
+	def test_split_and_leave(self):
+		self.fleet.update_platoons()
+		platoon = next(platoon for platoon in self.fleet.platoons if len(platoon) == 4)
+		members = platoon.vehicles
+
+		# A vehicle cutting in splits the platoon
+		vehicle = HV(0, None, members[1].position - 5, 0, **self.settings['Vehicle']['HV'])
+		self.fleet.add_vehicle(vehicle, members[1])
+		self.assertEqual(platoon.vehicles, members[:2])
+		self.assertEqual(members[2].platoon.vehicles, members[2:])
+		self.check_platoons(self.fleet)
+
+		# A leaving member dissolves a platoon of two
+		self.fleet.remove_vehicle(members[3])
+		self.assertIsNone(members[2].platoon)
+		self.assertFalse(members[2].in_platoon)
+		self.assertIsNone(members[3].platoon)
+		self.check_platoons(self.fleet)
+
+	def test_lane_changes(self):
+		for epoch in range(100):
+			simulation.step(self.lane_list, 0.1)
+			for lane_curr in self.lane_list:
+				self.check_platoons(lane_curr.fleet)
+
+
+class SteppingTest(SimulationTestCase):
+	seed = 1
+
+	def build_lane(self):
+		# Lane changes may leave overlapping vehicles regardless of the step, so collisions are checked on one lane
+		lane_list = utils.generate_scenario(1)
+		utils.generate_vehicles(lane_list, self.settings['Vehicle'], 2000, 0.3)
+		for vehicle in lane_list[0].fleet.vehicles[::3]:
+			vehicle.desired_speed_main = 15
+		return lane_list
+
+	def assert_no_collisions(self, lane_list):
+		for lane_curr in lane_list:
+			gap = lane_curr.fleet.get_states('gap')[1:]
+			self.assertTrue(all(g > 0 for g in gap))
+
+	def test_multirate_matches_fixed_without_coarse_vehicles(self):
+		lane_list = benchmark.build_benchmark_scenario(200, 1, 'high', self.settings)
+		reference = benchmark.build_benchmark_scenario(200, 1, 'high', self.settings)
+		stepper = stepping.MultiRateStepper(0.1, 5, interaction_threshold=-1)
+		for epoch in range(20):
+			self.assertAlmostEqual(stepper.step(lane_list), 0.5)
+			self.assertEqual(stepper.num_coarse, 0)
+		simulation.run_simulation(reference, 100, 0.1)
+		np.testing.assert_allclose(lane_list[0].fleet.get_states('position'),
+		                           reference[0].fleet.get_states('position'))
+
+	def test_multirate(self):
+		lane_list = self.build_lane()
+		stepper = stepping.MultiRateStepper()
+		num_coarse = 0
+		for epoch in range(60):
+			stepper.step(lane_list)
+			num_coarse += stepper.num_coarse
+			self.assert_no_collisions(lane_list)
+		self.assertGreater(num_coarse, 0)
+
+		lane_list = simulation.build_scenario(self.settings, flow=2500, permeability=0.3, platoon_size=4)
+		metrics = stepping.run_stepped(lane_list, stepping.MultiRateStepper(), 10)
+		self.assertEqual(metrics['num_steps'], 20)
+		self.assertGreater(metrics['lane_changes'], 0)
+
+	def test_adaptive(self):
+		lane_list = self.build_lane()
+		stepper = stepping.AdaptiveStepper(0.1, 1.0)
+		metrics = stepping.run_stepped(lane_list, stepper, 30)
+		self.assertLess(metrics['num_steps'], 300)
+		self.assert_no_collisions(lane_list)
+
+		# A step is shortened if a vehicle would run into its leader
+		fleet = lane_list[0].fleet
+		leader, follower = fleet.vehicles[:2]
+		follower.position = leader.position - leader.length - 5
+		follower.speed = leader.speed + 10
+		self.assertFalse(stepping.AdaptiveStepper.is_safe(fleet, 1.0))
+		self.assertTrue(stepping.AdaptiveStepper.is_safe(fleet, 0.1))
+
+		# Long steps are checked with the integration scheme which takes them
+		for integrator in ('heun', 'rk4'):
+			with self.subTest(integrator=integrator):
+				np.random.seed(0)
+				lane_list = self.build_lane()
+				lane_list[0].fleet.integrator = integrator
+				stepper = stepping.AdaptiveStepper(0.1, 2.0, acc_change_bound=2.0)
+				elapsed = 0.0
+				while elapsed < 30 - 1e-9:
+					elapsed += stepper.step(lane_list, 30 - elapsed)
+					self.assert_no_collisions(lane_list)
+
+
+class LaneChangeTest(SimulationTestCase):
+	seed = 2
+
+	def test_resolve_conflicts(self):
+		# Lanes 0 and 2 move into lane 1: vehicles 0 and 1 of lane 0 and vehicle 0 of lane 2 target the gap behind
+		# vehicle 3 of lane 1, vehicle 2 of lane 0 targets another gap
+		intents = lane_change.LaneChangeIntents(lane=np.array([0, 0, 2, 0]), index=np.array([1, 0, 0, 2]),
+		                                        target=np.array([1, 1, 1, 1]), front=np.array([3, 3, 3, 5]),
+		                                        position=np.array([90., 95, 92, 70]))
+		np.testing.assert_array_equal(lane_change.resolve_conflicts(intents), [False, True, False, True])
+
+		# Vehicles side by side swap their lanes, the vehicle ahead moves
+		intents = lane_change.LaneChangeIntents(lane=np.array([0, 1]), index=np.array([4, 2]),
+		                                        target=np.array([1, 0]), front=np.array([2, 3]),
+		                                        position=np.array([50., 52]))
+		np.testing.assert_array_equal(lane_change.resolve_conflicts(intents), [False, True])
+		intents = intents._replace(front=np.array([2, 1]))  # Another vehicle is between them
+		np.testing.assert_array_equal(lane_change.resolve_conflicts(intents), [True, True])
+
+	def test_get_insert_fronts(self):
+		front, behind_arrival = lane_change.get_insert_fronts(np.array([3, 2, 6]), np.array([-1, 1, 3, 6]))
+		np.testing.assert_array_equal(front, [-1, 1, 1, 5])
+		np.testing.assert_array_equal(behind_arrival, [False, False, True, False])
+
+	def test_change_lanes(self):
+		lane_list = simulation.build_scenario(self.settings, flow=2500, permeability=0.3)
+		for lane_curr in lane_list:
+			for vehicle in lane_curr.fleet.vehicles[::3]:
+				vehicle.desired_speed_main = 15
+		num_vehicles = sum(len(lane_curr.fleet) for lane_curr in lane_list)
+		num_moved = 0
+		for epoch in range(100):
+			moved = simulation.change_lanes(lane_list)
+			num_moved += len(moved)
+			for vehicle in moved:
+				self.assertIn(vehicle, vehicle.lane.fleet)
+			for lane_curr in lane_list:
+				self.assertEqual(len(lane_curr.fleet.get_lane_change_intents()[0]), 0)
+				self.assertTrue(np.all(np.diff(lane_curr.fleet.get_states('position')) <= 0))
+				vehicles = lane_curr.fleet.vehicles
+				self.assertTrue(all(vehicle.front_vehicle is front for front, vehicle in zip(vehicles, vehicles[1:])))
+				lane_curr.fleet.update_vehicles(0.1)
+		self.assertGreater(num_moved, 0)
+		self.assertEqual(sum(lane_curr.fleet.num_lane_changes for lane_curr in lane_list), num_moved)
+		self.assertEqual(sum(len(lane_curr.fleet) for lane_curr in lane_list), num_vehicles)
+
+
+class MetricsTest(SimulationTestCase):
+	def test_constant_speed(self):
+		lane_list = utils.generate_scenario(1)
+		detectors = metrics.LoopDetectors(lane_list, [50])
+		cells = metrics.EdieCells(lane_list, 100)
+		# One vehicle of length 4 at 10 m/s from 45 m to 145 m
+		for step in range(100):
+			position = np.array([45 + step + 1.0])
+			for collector in (detectors, cells):
+				collector.accumulate(0, position - 1, position, np.array([4.0]), 0.1)
+				collector.elapsed += 0.1
+		detectors.flush(10)
+		cells.flush(10)
+		self.assertEqual(detectors.rows['count'][0][0], 1)
+		self.assertAlmostEqual(detectors.rows['flow'][0][0], 360)
+		self.assertAlmostEqual(detectors.rows['space_mean_speed'][0][0], 10)
+		self.assertAlmostEqual(detectors.rows['occupancy'][0][0], 0.04)
+		start = cells.rows['start'][0]
+		flow = cells.rows['flow'][0]
+		density = cells.rows['density'][0]
+		self.assertAlmostEqual(flow[start == 0][0], 55 / 1000 * 3600)  # 55 m of 100 m x 10 s
+		self.assertAlmostEqual(density[start == 100][0], 4.5)  # 4.5 s of 100 m x 10 s
+		self.assertAlmostEqual(cells.rows['speed'][0][start == 100][0], 10)
+
+	def test_matches_trajectories(self):
+		lane_list = simulation.build_scenario(self.settings, flow=2000, permeability=0.3)
+		recorder = TrajectoryRecorder(lane_list)
+		recorder.record(-1)
+		online = metrics.OnlineMetrics(lane_list, [metrics.LoopDetectors(lane_list, [500, 1000]),
+		                                           metrics.EdieCells(lane_list, 250)], interval=10)
+		result = simulation.run_simulation(lane_list, 250, 0.1, recorder=recorder, measure_position=1000,
+		                                   metrics=online)
+		series = online.get_series()
+		detectors = series['LoopDetectors']
+		self.assertEqual(len(detectors['time']), 3 * 2 * 3)
+		self.assertAlmostEqual(detectors['count'][detectors['position'] == 1000].sum(),
+		                       result['throughput'] * 25 / 3600)
+
+		# Distance traveled within the lanes from the recorded trajectories
+		position = np.clip(recorder.get('position'), lane_list[0].start, lane_list[0].end)
+		cells = series['EdieCells']
+		distance = cells['flow'] * 250 * np.where(cells['time'] > 22, 5, 10) / 3600
+		# The positions are recorded as float32
+		self.assertAlmostEqual(distance.sum() / np.nansum(np.diff(position, axis=0)), 1, places=5)
+
+
+class RenderingTest(unittest.TestCase):
+	def setUp(self) -> None:
+		self.lane_list = initialize()
+		self.directory = tempfile.TemporaryDirectory()
+		self.recorder = TrajectoryRecorder(self.lane_list, chunk_size=4)
+		writer = TrajectoryWriter(self.directory.name, self.lane_list, chunk_size=4)
+		for epoch in range(10):
+			for lane_curr in self.lane_list:
+				lane_curr.fleet.update_vehicles(0.1)
+			self.recorder.record(epoch)
+			writer.record(epoch)
+		writer.close()
+		self.reader = TrajectoryReader(self.directory.name)
+
+	def tearDown(self) -> None:
+		self.directory.cleanup()
+
+	def test_histogram(self):
+		space_range = rendering.get_position_range(self.recorder)
+		self.assertEqual(space_range, rendering.get_position_range(self.reader))
+		for field in ('speed', 'density'):
+			values, time_edges, space_edges = rendering.space_time_histogram(self.recorder, field, 5, 8, space_range)
+			np.testing.assert_allclose(values, rendering.space_time_histogram(self.reader, field, 5, 8, space_range)[0])
+			self.assertEqual(values.shape, (5, 8))
+		# Mean number of vehicles per km and lane over the road equals the number of vehicles per lane
+		self.assertAlmostEqual(values.mean() * (space_range[1] - space_range[0]) / 1000, NUM_VEHICLES)
+
+	def test_render(self):
+		path = os.path.join(self.directory.name, 'space_time.png')
+		rendering.render_space_time(self.reader, path, time_bins=5, space_bins=8, num_overlay=3, decimation=2)
+		with open(path, 'rb') as f:
+			self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+
+
+class IntegrationTest(SimulationTestCase):
+	seed = None  # Each run is seeded
+
+	def run_lane(self, integrator, dt, duration=30):
+		np.random.seed(1)
+		lane_list = utils.generate_scenario(1)
+		utils.generate_vehicles(lane_list, self.settings['Vehicle'], 2000, 0.3)
+		lane_list[0].fleet.integrator = integrator
+		for epoch in range(int(round(duration / dt))):
+			simulation.step(lane_list, dt)
+			self.assertTrue(np.all(lane_list[0].fleet.get_arrays().speed >= 0))
+		return np.array(lane_list[0].fleet.get_states('position'))
+
+	def test_ballistic_update(self):
+		# Stops after 0.5 s and stands still for the rest of the step
+		position, speed = integration.ballistic_update(0, 2, -4, 1, 30)
+		self.assertAlmostEqual(position, 0.5)
+		self.assertEqual(speed, 0)
+		# Reaches the speed limit after 1 s and cruises for the rest of the step
+		position, speed = integration.ballistic_update(np.zeros(2), np.array([28, 10]), np.array([2, 2]), 2, 30)
+		np.testing.assert_allclose(position, [59, 24])
+		np.testing.assert_allclose(speed, [30, 14])
+
+		lane_list = utils.generate_scenario(1)
+		vehicle = HV(2, lane_list[0], 100, 0, **self.settings['Vehicle']['HV'])
+		vehicle.update(-4, 1)
+		self.assertAlmostEqual(vehicle.position, 100.5)
+		self.assertEqual(vehicle.speed, 0)
+
+	def test_accuracy(self):
+		reference = self.run_lane('rk4', 0.05)
+		errors = {(integrator, dt): np.max(np.abs(self.run_lane(integrator, dt) - reference))
+		          for integrator, dt in [('ballistic', 0.1), ('ballistic', 0.5), ('heun', 0.5), ('rk4', 0.5)]}
+		self.assertLess(errors['heun', 0.5], errors['ballistic', 0.5])
+		self.assertLess(errors['rk4', 0.5], errors['ballistic', 0.1])
+
+
+class EnsembleTest(SimulationTestCase):
+	seed = None
+
+	def setUp(self) -> None:
+		super().setUp()
+		self.params = {'flow': 1800, 'permeability': 0.3, 'num_vehicles': 100, 'platoon_size': 4}
+
+	@staticmethod
+	def get_states(lane_list):
+		return [(lane_curr.fleet.get_states('position'), lane_curr.fleet.get_states('speed'))
+		        for lane_curr in lane_list]
+
+	def test_matches_separate_runs(self):
+		seeds = [0, 1, 2]
+		for integrator in ('ballistic', 'rk4'):
+			expected = []
+			for seed in seeds:
+				sweep.seed_rngs(0, seed)
+				lane_list = simulation.build_scenario(self.settings, integrator=integrator, **self.params)
+				boundary = OpenBoundary(lane_list, self.settings['Vehicle'], 1500, 0.3)
+				result = simulation.run_simulation(lane_list, 60, 0.1, boundary=boundary)
+				expected.append((result, self.get_states(lane_list)))
+
+			replicas = ensemble.build_ensemble(self.settings, seeds, inflow=1500, integrator=integrator, **self.params)
+			results = replicas.run(60, 0.1)
+			for (result, states), replica_result, replica in zip(expected, results, replicas.replicas):
+				self.assertEqual(replica_result, result)
+				self.assertEqual(self.get_states(replica.lane_list), states)
+			self.assertGreater(sum(result['lane_changes'] for result in results), 0)
+
+
+class ObstacleTest(unittest.TestCase):
+	def test_table(self):
+		table = ObstacleTable()
+		table.add([1000, 500], end=[np.inf, 20])  # Lane end and an incident cleared after 20 s
+		table.add_signal(800, cycle=60, red=30, until=120)
+		np.testing.assert_array_equal(table.get_next(np.array([0, 600, 900, 1200])), [500, 800, 1000, np.inf])
+		version = table.version
+		table.set_time(10)
+		self.assertEqual(table.version, version)  # No event has passed
+		table.set_time(25)
+		np.testing.assert_array_equal(table.get_next(np.array([0, 600])), [800, 800])
+		table.set_time(45)
+		np.testing.assert_array_equal(table.get_next(np.array([0, 600])), [1000, 1000])
+		table.advance(15)
+		np.testing.assert_array_equal(table.active_positions, [800, 1000])
+
+	def test_fleet_matches_vehicles(self):
+		lane_list = initialize()
+		lane_list[0].obstacles.add(2030)
+		lane_list[0].obstacles.add_signal(1830, cycle=60, red=30)
+		fleet = lane_list[0].fleet
+		acc = fleet.get_accelerations()
+		np.testing.assert_allclose(acc, [vehicle.get_acceleration() for vehicle in fleet])
+		self.assertEqual(acc[0], -fleet.vehicles[0].desired_dec)
+
+		# The signal turns green
+		advance_obstacles(lane_list, 30)
+		acc_green = fleet.get_accelerations()
+		self.assertGreater(acc_green[1], acc[1])
+		np.testing.assert_allclose(acc_green, [vehicle.get_acceleration() for vehicle in fleet])
+
+	def test_lane_drop(self):
+		lane_list = initialize()
+		lane_list[0].obstacles.add(2500)
+		lane_list[2].obstacles.add(2200, 0, 20)
+		for epoch in range(300):
+			simulation.step(lane_list, 0.1)
+		self.assertLess(max(lane_list[0].fleet.get_states('position')), 2500)
+		self.assertAlmostEqual(lane_list[0].obstacles.time, 30)
+
+		buffer = io.BytesIO()
+		checkpoint.save_checkpoint(buffer, lane_list)
+		buffer.seek(0)
+		restored, _, _ = checkpoint.load_checkpoint(buffer, restore_rng=False)
+		for lane_curr, lane_restored in zip(lane_list, restored):
+			np.testing.assert_array_equal(lane_restored.obstacles.active_positions,
+			                              lane_curr.obstacles.active_positions)
+			self.assertEqual(len(lane_restored.obstacles), len(lane_curr.obstacles))
+
+
+class BenchmarkTest(SimulationTestCase):
+	seed = None
+	record_states = None  # Switched off by the runs
+
+	def test_run_case(self):
+		result = benchmark.run_case(30, 3, 'high', num_epochs=3, num_warmup=1, dt=0.1)
+		self.assertEqual(result['name'], '30veh-3lane-high')
+		self.assertEqual(set(result['phase_seconds']), set(benchmark.PHASES))
+		self.assertGreater(result['steps_per_second'], 0)
+
+	def test_compare(self):
+		baseline = {'results': [{'name': 'a', 'steps_per_second': 100}, {'name': 'b', 'steps_per_second': 100}]}
+		results = {'results': [{'name': 'a', 'steps_per_second': 90}, {'name': 'b', 'steps_per_second': 50},
+		                       {'name': 'c', 'steps_per_second': 10}]}
+		comparison = benchmark.compare(results, baseline, tolerance=0.2)
+		self.assertEqual([entry['regression'] for entry in comparison], [False, True])
+
+
 if __name__ == '__main__':
 	unittest.main()
@@ -5,27 +5,29 @@ from lane import *
 from vehicle import *
 from fleet import *
 import numpy as np
+import demand
 from typing import List, Optional, Tuple, Union
 
 
-def generate_scenario():
+def generate_scenario(num_lane: int = 3, length: float = 3500, start: float = -500, end: float = 3500):
+	"""
+	Generate lanes, their fleets and the relationships between neighboring lanes.
+
+	:param num_lane: number of main lanes, ordered from left to right
+	:param length: length of the lanes
+	:param start: start point of the lanes
+	:param end: end point of the lanes
+	:return: list of lanes
+	"""
 	# Generate and initialize lanes
 	lane_list = []
-
-	# Example lane creation
-	lane1 = MainLane(length=3500, start=-500, end=3500, lane_type='Main')
-	lane2 = MainLane(length=3500, start=-500, end=3500, lane_type='Main')
-	lane3 = MainLane(length=3500, start=-500, end=3500, lane_type='Main')
-
-	# Set neighboring lanes
-	lane1.right_lane = lane2  # Set the neighboring lane to the right of lane1
-	lane2.left_lane = lane1  # Set the neighboring lane to the left of lane2
-	lane2.right_lane = lane3  # Set the neighboring lane to the right of lane2
-	lane3.left_lane = lane2  # Set the neighboring lane to the left of lane3
-
-	lane_list.append(lane1)  # Add lane1 to the lane list
-	lane_list.append(lane2)  # Add lane2 to the lane list
-	lane_list.append(lane3)  # Add lane3 to the lane list
+	for i in range(num_lane):
+		lane_curr = MainLane(length=length, start=start, end=end, lane_type='Main')
+		if lane_list:
+			# Set neighboring lanes
+			lane_list[-1].right_lane = lane_curr  # Set the neighboring lane to the right of the previous lane
+			lane_curr.left_lane = lane_list[-1]  # Set the neighboring lane to the left of the current lane
+		lane_list.append(lane_curr)  # Add the lane to the lane list
 
 	# Generate and initialize fleets
 	for lane_curr in lane_list:
@@ -35,23 +37,35 @@ def generate_scenario():
 	return lane_list
 
 
-def generate_vehicles():
-	"""generate vehicles by specific distribution and 'safety_check()' """
-	# TODO: generate vehicles based on specific distribution
+def generate_vehicles(lane_list: List[Lane], configs: dict, flow: float, permeability: float = 0,
+                      distribution: str = 'poisson', **kwargs) -> List[Vehicle]:
+	"""
+	Generate vehicles on all main lanes by a headway distribution. The arrival stream of each lane is drawn at once
+	and checked against the jam distance with array operations, see ``demand.fill_lanes``.
 
-	pass
+	:param lane_list: list of lanes
+	:param configs: settings of vehicle
+	:param flow: arrival rate per lane in vehicles per hour
+	:param permeability: penetration rate of CAVs
+	:param distribution: 'poisson', 'shifted_exponential' or 'empirical'
+	:param kwargs: further arguments of ``demand.fill_lane``, e.g. ``speed``, ``min_headway`` or ``samples``
+	:return: the generated vehicles
+	"""
+	return demand.fill_lanes(lane_list, configs, flow, permeability, lane_types=('Main',), distribution=distribution,
+	                         **kwargs)
 
 
-def generate_vehicle_main(lane_list: List[Lane], configs: dict, permeability: float = 0):
+def generate_vehicle_main(lane_list: List[Lane], configs: dict, permeability: float = 0, arrival_rate: float = 1):
 	"""
 	Generate vehicles on main lane
 	:param configs: settings of vehicle
 	:param lane_list:  list of main lane
 	:param permeability: permeability of generating vehicles
+	:param arrival_rate: rate of the exponential headway distribution, larger rates give denser traffic
 	:return:
 	"""
 	can_add_list = []
-	lambda_param = 1
+	lambda_param = arrival_rate
 	speed = 15
 	headway = np.random.exponential(1 / lambda_param) * 50
 	headway = np.clip(headway, 20, 100)
@@ -93,15 +107,21 @@ def generate_vehicle_main(lane_list: List[Lane], configs: dict, permeability: fl
 			lane_curr.fleet.add_vehicle(vehicle_curr, last_vehicle)
 
 
-def generate_vehicle_ramp(lane_list: List[Lane], configs, permeability):
+def generate_vehicle_ramp(lane_list: List[Lane], configs, permeability, flow: float = 600,
+                          distribution: str = 'poisson', **kwargs) -> List[Vehicle]:
 	"""
-	Generate vehicles on ramp
-	:param lane_list:
-	:param configs:
-	:param permeability:
-	:return:
+	Generate vehicles on ramp by a headway distribution, see ``generate_vehicles``.
+
+	:param lane_list: list of lanes, only ramps are filled
+	:param configs: settings of vehicle
+	:param permeability: penetration rate of CAVs
+	:param flow: arrival rate per ramp in vehicles per hour
+	:param distribution: 'poisson', 'shifted_exponential' or 'empirical'
+	:param kwargs: further arguments of ``demand.fill_lane``
+	:return: the generated vehicles
 	"""
-	pass
+	return demand.fill_lanes(lane_list, configs, flow, permeability, lane_types=('Ramp',), distribution=distribution,
+	                         **kwargs)
 
 
 def safety_check(front_vehicle: Vehicle, rear_vehicle: Vehicle):
@@ -3,16 +3,49 @@ import numpy as np
 from models import *
 import copy
 from lane import Lane
+from state import DETACHED, StateField
+from cache import acceleration_cache
+from profiler import profiler
+from integration import ballistic_update
+from parameters import VehicleParameters, ParameterField
 from typing import Optional
 
 
 class Vehicle(object):
+	__slots__ = ('_state', '_slot', '_params', '_acc_cache', 'id', 'lane', 'front_vehicle', 'rear_vehicle', 'platoon',
+	             'position_record', 'speed_record', 'acc_record', 'in_platoon', 'lane_change_indicator')
 	cnt = 0
+	record_states = True  # Whether each vehicle keeps its own lists of states, see ``_restore_states``
+	type = ''  # Overwritten by each vehicle type
+
+	# States are stored in the struct-of-arrays storage of the fleet
+	position = StateField('position')
+	speed = StateField('speed')
+	acc = StateField('acc')
+	obstacle_position = StateField('obstacle_position')
+
+	# Parameters are shared by all vehicles with the same settings
+	desired_speed_main = ParameterField('desired_speed_main')
+	desired_speed_ramp = ParameterField('desired_speed_ramp')
+	jam_distance = ParameterField('jam_distance')
+	min_gap = ParameterField('min_gap')
+	max_acc = ParameterField('max_acc')
+	desired_dec = ParameterField('desired_dec')
+	reaction_time = ParameterField('reaction_time')
+	length = ParameterField('length')
+	target_pos = ParameterField('target_pos')
 
 	def __init__(self, init_speed: int, init_lane: Optional[Lane],
 	             init_pos: int, init_acc: float, **settings) -> None:
+		# slot in the state storage, moved into the fleet storage once the vehicle is added to a fleet
+		self._state = None
+		self._slot = -1
+		DETACHED.attach(self)
+
 		# initial state
 		self.id = Vehicle.cnt
+		self._state.vehicle_id[self._slot] = self.id
+		Vehicle.cnt += 1
 		self.speed = init_speed
 		self.lane = init_lane
 		self.position = init_pos
@@ -22,34 +55,65 @@ class Vehicle(object):
 		self.front_vehicle: Optional[Vehicle] = None
 		self.rear_vehicle: Optional[Vehicle] = None
 		self.platoon = None
-		self.position_record = []
-		self.speed_record = []
-		self.acc_record = []
+		if Vehicle.record_states:
+			self.position_record = []
+			self.speed_record = []
+			self.acc_record = []
+		else:
+			self.position_record = self.speed_record = self.acc_record = None
 		self.in_platoon = False
-		self.obstacle_position: float = float('inf')
+		self.obstacle_position = float('inf')
+		self._acc_cache = None  # Memoized acceleration, see ``AccelerationCache``
 
 		# Parameters to overwrite
 		self.lane_change_indicator = False
-		self.type = ''
 
 		# fetch from settings
-		self.desired_speed_main = settings.get('desired_speed_main', 25)  # default desired speed in main lane
-		self.desired_speed_ramp = settings.get('desired_speed_ramp', 16.66)  # default desired speed in ramp
-		self.jam_distance = settings.get('jam_distance', 10)  # default safety distance
-		self.min_gap = settings.get('min_gap', 0)
-		self.max_acc = settings.get('max_acc', 2)
-		self.desired_dec = settings.get('desired_dec', 3)
-		self.reaction_time = settings.get('reaction_time', 0)
-		self.length = settings.get('length', 5)
-		self.target_pos = settings.get('target_pos', 0)
+		self.params = VehicleParameters.from_settings(**settings)
+
+	@property
+	def params(self) -> VehicleParameters:
+		"""The shared behaviour parameters of the vehicle."""
+		return self._params
+
+	@params.setter
+	def params(self, params: VehicleParameters):
+		self._params = params
+		# Copy the parameters into the state storage for vectorized car-following
+		state = self._state
+		for field in state.PARAMETER_FIELDS:
+			getattr(state, field)[self._slot] = getattr(params, field)
+		state.version += 1
 
 	def get_acceleration(self) -> float:
 		"""
-		Calculates the acceleration of the vehicle based on the Intelligent Driver Model (IDM).
+		Returns the acceleration of the vehicle calculated by the car-following model of the vehicle type. The result
+		is memoized until the states of the vehicle or its front vehicle change.
 
 		:return: The acceleration of the vehicle in meters per second squared.
 		"""
-		raise NotImplemented
+		profiler.count('get_acceleration')
+		# The acceleration only depends on the states of the vehicle and its front vehicle, on the lane and on the
+		# platoon, whose members share the state storage of the fleet
+		front_vehicle = self.front_vehicle
+		key = (self._state, self._state.version, self._slot, self.lane, self.platoon,
+		       None if self.lane is None else self.lane.obstacles.version,
+		       None if front_vehicle is None else front_vehicle._state,
+		       None if front_vehicle is None else front_vehicle._state.version,
+		       None if front_vehicle is None else front_vehicle._slot)
+		acc = acceleration_cache.get(self, key)
+		if acc is None:
+			acc = self._calculate_acceleration()
+			acceleration_cache.put(self, key, acc)
+		return acc
+
+	def _calculate_acceleration(self) -> float:
+		"""
+		Calculates the acceleration of the vehicle without the cache. Overwritten by each vehicle type.
+
+		:return: The acceleration of the vehicle in meters per second squared.
+		"""
+		raise NotImplementedError
 
 	def update(self, acc: float, time_step: float):
 		"""
@@ -58,19 +122,12 @@ class Vehicle(object):
 		:param acc: The acceleration of the vehicle in meters per second squared.
 		:param time_step: The time step of the simulation in seconds.
 		"""
-		# Update the position of the vehicle based on the current speed and time step
-		self.position += self.speed * time_step + 0.5 * acc * time_step ** 2
-
-		# Update the speed of the vehicle based on the provided acceleration and time step
-		self.speed += acc * time_step
+		# Ballistic update, a vehicle stopping or reaching the speed limit within the step stays at the bound
+		position, speed = ballistic_update(self.position, self.speed, acc, time_step, self.lane.max_speed)
+		self.position = float(position)
+		self.speed = float(speed)
 		self.acc = acc
 
-		# Ensure the speed is within the valid range
-		if self.speed < 0:
-			self.speed = 0  # Set the speed to 0 if it becomes negative
-		elif self.speed > self.lane.max_speed:
-			self.speed = self.lane.max_speed  # Limit the speed to the maximum speed of the lane
-
 		self._restore_states()
 
 	def move_to_lane(self, front_vehicle, new_lane: Lane):
@@ -80,10 +137,12 @@ class Vehicle(object):
 		:param front_vehicle: the front vehicle in the new lane
 		:param new_lane: the new lane to move to
 		"""
-		if front_vehicle.lane != new_lane:
+		if front_vehicle is None or front_vehicle.lane != new_lane or \
+				(front_vehicle.rear_vehicle is not None and front_vehicle.rear_vehicle.position > self.position):
 			# This circumstance happens when the front vehicle moves to other lanes \
-			# before lane changing of ego vehicle
-			# If the front vehicle is not in the new lane, get new front vehicle in the target lane
+			# before lane changing of ego vehicle, or another vehicle has moved in behind it
+			# If the front vehicle is not in the new lane, get new front vehicle in the target lane, so that the
+			# vehicles of the lane stay ordered by position
 			front_vehicle = self.get_adjacent_front_vehicle(new_lane)
 
 		# Remove the vehicle from its current lane
@@ -104,33 +163,53 @@ class Vehicle(object):
 		:return: The lead vehicle in the target lane or None if no lead vehicle is found.
 		"""
 
-		# Initialize the lead vehicle and minimum distance to infinity and target vehicle to None
-		lead_vehicle = None
-		min_distance = float('inf')
-
-		# Loop through all the vehicles in the target lane
-		for vehicle in target_lane.fleet.vehicles:
-
-			# Calculate the relative distance between the current vehicle and the target vehicle
-			relative_dist = vehicle.position - self.position
-
-			# If the relative distance is greater than 0 and less than the minimum distance so far
-			if 0 < relative_dist < min_distance:
-				# Update the minimum distance and the lead vehicle
-				min_distance = relative_dist
-				lead_vehicle = vehicle
-
-		# Return the lead vehicle or None if no lead vehicle is found
-		return lead_vehicle
+		# The target fleet is ordered by position, so the lead vehicle is found by binary search
+		return target_lane.fleet.find_front_vehicle(self.position)
 
 	def _restore_states(self):
 		"""
-		Restore the states of the vehicle to the previous step
+		Restore the states of the vehicle to the previous step. Disabled if ``Vehicle.record_states`` is False, e.g.
+		when the states are recorded by ``TrajectoryRecorder``.
 		"""
+		if not Vehicle.record_states:
+			return
+		if self.position_record is None:
+			self.position_record = []
+			self.speed_record = []
+			self.acc_record = []
 		self.position_record.append(self.position)
 		self.speed_record.append(self.speed)
 		self.acc_record.append(self.acc)
 
+	def _get_acceleration_idm(self) -> float:
+		"""
+		Calculates the acceleration of the vehicle based on the Intelligent Driver Model (IDM), limited by obstacles.
+
+		:return: The acceleration of the vehicle in meters per second squared.
+		"""
+		v = self.speed
+		s = self.front_vehicle.position - self.position - self.front_vehicle.length if self.front_vehicle else np.inf
+		v_lead = self.front_vehicle.speed if self.front_vehicle else None
+
+		# The ego vehicle has a front vehicle
+		if v_lead is not None:
+			idm = self.params.get_idm(self.lane.type)
+			acc = idm.get_acceleration(v, v_lead, s)
+		else:
+			# The ego vehicle has no front vehicle
+			if self.lane.type == 'Main':
+				acc = self.max_acc * (1 - (v / self.desired_speed_main) ** 4)
+			else:
+				acc = self.max_acc * (1 - (v / self.desired_speed_ramp) ** 4)
+		if acc > self.max_acc:
+			acc = self.max_acc
+		elif acc < -self.desired_dec:
+			acc = -self.desired_dec
+
+		acc_obstacle = self._get_acceleration_obstacle()
+		acc = min(acc, acc_obstacle)
+		return acc
+
 	def _get_acceleration_obstacle(self):
 		"""
 		Calculate the acceleration caused by obstacles, such as road merge, traffic lights, and ramps.
@@ -147,7 +226,11 @@ class Vehicle(object):
 		                            (2 * np.sqrt(self.max_acc * self.desired_dec)))
 
 		# Calculate the distance between the vehicle and the obstacle. Vehicle length is not considered here.
-		obstacle_distance = self.obstacle_position - self.position
+		obstacle_position = self.obstacle_position
+		if self.lane is not None and len(self.lane.obstacles):
+			# The next active obstacle of the lane
+			obstacle_position = min(obstacle_position, float(self.lane.obstacles.get_next(self.position)))
+		obstacle_distance = obstacle_position - self.position
 
 		# If the distance between the vehicle and the obstacle less than the desired distance
 		if obstacle_distance < s_star:
@@ -165,65 +248,49 @@ class Vehicle(object):
 
 
 class HV(Vehicle):
+	__slots__ = ()
+	type = 'HV'
+
 	def __init__(self, init_speed: int, init_lane: Optional[Lane],
 	             init_pos: int, init_acc: float, **settings) -> None:
 		super().__init__(init_speed, init_lane, init_pos, init_acc, **settings)
-		self.type = 'HV'
 
-	def get_acceleration(self) -> float:
+	def _calculate_acceleration(self) -> float:
 		"""
-		Calculates the acceleration of the vehicle based on the Intelligent Driver Model (IDM).
+		Calculates the acceleration of the vehicle based on the Intelligent Driver Model (IDM) without the cache.
 
 		:return: The acceleration of the vehicle in meters per second squared.
 		"""
-		v = self.speed
-		s = self.front_vehicle.position - self.position - self.front_vehicle.length if self.front_vehicle else np.inf
-		v_lead = self.front_vehicle.speed if self.front_vehicle else None
-
-		# The ego vehicle has a front vehicle
-		if v_lead is not None:
-
-			# change later
-			if self.lane.type == 'Main':
-				idm = IDM(self.desired_speed_main, self.reaction_time, self.max_acc, self.desired_dec,
-				          self.jam_distance)
-			else:
-				idm = IDM(self.desired_speed_ramp, self.reaction_time, self.max_acc, self.desired_dec,
-				          self.jam_distance)
-			acc = idm.get_acceleration(v, v_lead, s)
-		else:
-			# The ego vehicle has no front vehicle
-			if self.lane.type == 'Main':
-				acc = self.max_acc * (1 - (v / self.desired_speed_main) ** 4)
-			else:
-				acc = self.max_acc * (1 - (v / self.desired_speed_ramp) ** 4)
-		if acc > self.max_acc:
-			acc = self.max_acc
-		elif acc < -self.desired_dec:
-			acc = -self.desired_dec
-
-		acc_obstacle = self._get_acceleration_obstacle()
-		acc = min(acc, acc_obstacle)
-		return acc
+		return self._get_acceleration_idm()
 
 
 class CAV(Vehicle):
+	__slots__ = ()
+	type = 'CAV'
+
 	def __init__(self, init_speed: int, init_lane: Optional[Lane],
 	             init_pos: int, init_acc: float, **settings) -> None:
 		super().__init__(init_speed, init_lane, init_pos, init_acc, **settings)
-		self.type = 'CAV'
 
-	def get_acceleration(self) -> float:
+	def _calculate_acceleration(self) -> float:
 		"""
-		Calculate acceleration based on connected IDM car-following model
-		:return:
+		Calculates the acceleration like ``Fleet.compute_accelerations``: members behind the lead vehicle of a platoon
+		which is controlled as a string are controlled by ``Platoon.control``, other CAVs follow the IDM. The
+		accelerations of platoon members are taken from the cached accelerations of their fleet.
+
+		:return: The acceleration of the vehicle in meters per second squared.
 		"""
-		# TODO: Complete the car-following model in `models.py`
-		pass
+		platoon = self.platoon
+		if platoon is not None and self.lane is not None and self is not platoon.lead_vehicle:
+			acc = self.lane.fleet.get_accelerations()  # Orders the slots of the fleet
+			return float(acc[self._slot])
+		return self._get_acceleration_idm()
 
 
 class Truck(Vehicle):
+	__slots__ = ()
+	type = 'Truck'
+
 	def __init__(self, init_speed: int, init_lane: Optional[Lane],
 	             init_pos: int, init_acc: float, **settings) -> None:
 		super().__init__(init_speed, init_lane, init_pos, init_acc, **settings)
-		self.type = 'Truck'